@@ -1,9 +1,40 @@
 from http.server import BaseHTTPRequestHandler
 import json
+import gzip
 import os
+import time
+import threading
+from collections import OrderedDict
 import requests
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeout
 from groq import Groq
 
+TREE_FETCH_CONCURRENCY = int(os.environ.get("TREE_FETCH_CONCURRENCY", "8"))
+TREE_CACHE_SIZE = int(os.environ.get("TREE_CACHE_SIZE", "64"))
+TREE_SKIP_DIRS = {".git", "node_modules", "__pycache__"}
+# Shared budget for the summary, paper and tree calls; the extension gives up at 30s.
+RESPONSE_DEADLINE_S = float(os.environ.get("RESPONSE_DEADLINE_S", "25"))
+LLM_MODEL = os.environ.get("LLM_MODEL", "llama-3.3-70b-versatile")
+
+# Built tree payloads keyed by (owner/repo, tree SHA, format); a tree SHA never
+# changes content, so entries only leave the cache by LRU eviction.
+_tree_cache = OrderedDict()
+_tree_cache_lock = threading.Lock()
+
+# One Groq client per warm instance, so its connection pool outlives a request
+_groq_client = None
+_groq_client_lock = threading.Lock()
+
+
+def _get_groq_client(api_key):
+    global _groq_client
+    with _groq_client_lock:
+        if _groq_client is None or _groq_client.api_key != api_key:
+            _groq_client = Groq(api_key=api_key, timeout=RESPONSE_DEADLINE_S)
+        return _groq_client
+
+
 class handler(BaseHTTPRequestHandler):
     def _set_cors_headers(self):
         """Set CORS headers for all responses"""
@@ -63,13 +94,19 @@ class handler(BaseHTTPRequestHandler):
                 self.send_error_response(400, f"Missing required fields: {', '.join(missing_fields)}")
                 return
             
+            # "nested" (default) or "compact" — see _build_compact_tree
+            tree_format = data.get('tree_format', 'nested')
+            if tree_format not in ('nested', 'compact'):
+                self.send_error_response(400, f"Unsupported tree_format: {tree_format}")
+                return
+            
             # Initialize Groq client
             api_key = os.environ.get("API_KEY") or os.environ.get("GROQ_API_KEY")
             if not api_key:
                 self.send_error_response(500, "API_KEY or GROQ_API_KEY environment variable not set")
                 return
             
-            client = Groq(api_key=api_key)
+            client = _get_groq_client(api_key)
             
             # Create a formatted file structure string
             structure_text = "Repository Structure:\n"
@@ -91,18 +128,6 @@ class handler(BaseHTTPRequestHandler):
                 f"Provide a comprehensive summary explaining what this project does and its key characteristics."
             )
             
-            try:
-                summary_completion = client.chat.completions.create(
-                    messages=[{"role": "user", "content": summary_prompt}],
-                    model="llama-3.3-70b-versatile",
-                    temperature=0.3,
-                    max_tokens=500
-                )
-                summary = summary_completion.choices[0].message.content
-            except Exception as e:
-                self.send_error_response(500, f"Error generating summary: {str(e)}")
-                return
-            
             # Generate project paper
             paper_prompt = (
                 f"Write a one-page project overview for {data['owner']}/{data['repo']}.\n\n"
@@ -118,131 +143,280 @@ class handler(BaseHTTPRequestHandler):
                 f"README: {data.get('readme', 'Not available')[:4000]}"
             )
             
-            try:
-                paper_completion = client.chat.completions.create(
-                    messages=[{"role": "user", "content": paper_prompt}],
-                    model="llama-3.3-70b-versatile",
-                    temperature=0.3,
-                    max_tokens=1500
-                )
-                project_paper = paper_completion.choices[0].message.content
-            except Exception as e:
-                project_paper = "Error generating detailed report: " + str(e)
+            # Summary, paper and tree are independent — run them concurrently
+            # under one deadline instead of paying for three calls in series.
+            deadline = time.monotonic() + RESPONSE_DEADLINE_S
+            pool = ThreadPoolExecutor(max_workers=3)
+            futures = {
+                pool.submit(self._fetch_repo_tree, data['owner'], data['repo'], tree_format): "tree_data",
+                pool.submit(self._complete, client, summary_prompt, 500): "summary",
+                pool.submit(self._complete, client, paper_prompt, 1500): "project_paper",
+            }
             
-            # Fetch repository tree
-            tree_data = self._fetch_repo_tree(data['owner'], data['repo'])
+            # Clients that accept NDJSON get each field as soon as it is ready
+            # (usually the tree first); everyone else gets the usual JSON body.
+            stream = "application/x-ndjson" in self.headers.get('Accept', '')
+            if stream:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self._set_cors_headers()
+                self.end_headers()
             
-            # Send successful response
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self._set_cors_headers()
-            self.end_headers()
+            results = {}
+            try:
+                for future in as_completed(futures, timeout=max(0.0, deadline - time.monotonic())):
+                    key = futures[future]
+                    try:
+                        results[key] = future.result()
+                    except Exception as e:
+                        results[key] = e
+                    if stream:
+                        self._write_line(self._result_field(data['repo'], key, results[key]))
+            except FuturesTimeout:
+                pass
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
+            
+            for key in futures.values():
+                if key not in results:
+                    results[key] = TimeoutError(f"timed out after {RESPONSE_DEADLINE_S:.0f}s")
+                    if stream:
+                        self._write_line(self._result_field(data['repo'], key, results[key]))
             
             response = {
-                "summary": summary,
-                "project_paper": project_paper,
-                "tree_data": tree_data,
                 "owner": data['owner'],
                 "repo": data['repo'],
                 "description": data['description']
             }
-            self.wfile.write(json.dumps(response).encode())
+            if stream:
+                response["done"] = True
+                self._write_line(response)
+                return
+            
+            summary = results["summary"]
+            if isinstance(summary, Exception):
+                status = 504 if isinstance(summary, TimeoutError) else 500
+                self.send_error_response(status, f"Error generating summary: {str(summary)}")
+                return
+            
+            for key in ("summary", "project_paper", "tree_data"):
+                response.update(self._result_field(data['repo'], key, results[key]))
+            
+            # Send successful response
+            self._send_json(200, response)
             
         except Exception as e:
             self.send_error_response(500, f"Internal server error: {str(e)}")
     
-    def _fetch_repo_tree(self, owner, repo):
-        """Fetch repository tree from GitHub API"""
+    def _complete(self, client, prompt, max_tokens):
+        """Run one chat completion and return its text"""
+        completion = client.chat.completions.create(
+            messages=[{"role": "user", "content": prompt}],
+            model=LLM_MODEL,
+            temperature=0.3,
+            max_tokens=max_tokens
+        )
+        return completion.choices[0].message.content
+    
+    def _result_field(self, repo, key, value):
+        """Response field for one concurrent result, turning failures into the usual fallbacks"""
+        if not isinstance(value, Exception):
+            return {key: value}
+        if key == "summary":
+            return {"error": f"Error generating summary: {str(value)}", "status": 500}
+        if key == "project_paper":
+            return {key: "Error generating detailed report: " + str(value)}
+        return {key: {
+            "name": repo,
+            "type": "directory",
+            "icon": "📁",
+            "children": [{"name": f"Error: {str(value)}", "type": "file", "icon": "⚠️", "children": []}]
+        }}
+    
+    def _write_line(self, payload):
+        """Write one NDJSON line and flush it to the client"""
+        self.wfile.write(json.dumps(payload).encode() + b"\n")
+        self.wfile.flush()
+    
+    def _fetch_repo_tree(self, owner, repo, tree_format="nested"):
+        """Fetch repository tree from GitHub API, cached per (repo, tree SHA, format)"""
         try:
             headers = {"Accept": "application/vnd.github.v3+json"}
             github_token = os.environ.get("GITHUB_TOKEN")
             if github_token:
                 headers["Authorization"] = f"token {github_token}"
             
-            tree_response = requests.get(
-                f"https://api.github.com/repos/{owner}/{repo}/git/trees/main?recursive=1",
-                headers=headers,
-                timeout=15
-            )
-            
-            if not tree_response.ok:
+            # The root listing is cheap and gives the tree SHA to key the cache on
+            root = self._get_root_tree(owner, repo, "main", headers)
+            if root is None:
                 # Try master branch
-                tree_response = requests.get(
-                    f"https://api.github.com/repos/{owner}/{repo}/git/trees/master?recursive=1",
-                    headers=headers,
-                    timeout=15
-                )
-            
-            if tree_response.ok:
-                tree_json = tree_response.json()
-                if not tree_json.get("truncated", False):
-                    return self._build_tree_structure(repo, tree_json.get("tree", []))
-                else:
-                    return {
-                        "name": repo,
-                        "type": "directory",
-                        "icon": "📁",
-                        "children": [{"name": "Repository too large", "type": "file", "icon": "⚠️", "children": []}]
-                    }
-            else:
+                root = self._get_root_tree(owner, repo, "master", headers)
+
+            if root is None:
                 return {
                     "name": repo,
                     "type": "directory",
                     "icon": "📁",
-                    "children": [{"name": "Failed to fetch tree", "type": "file", "icon": "❌", "children": []}]
+                    "children": [{"name": "Failed to fetch tree", "type": "file", "icon": "❌"}]
                 }
+            
+            cache_key = (f"{owner}/{repo}", root["sha"], tree_format)
+            with _tree_cache_lock:
+                if cache_key in _tree_cache:
+                    _tree_cache.move_to_end(cache_key)
+                    return _tree_cache[cache_key]
+            
+            items = self._fetch_tree_entries(owner, repo, root, headers)
+            if tree_format == "compact":
+                tree_data = self._build_compact_tree(repo, items)
+            else:
+                tree_data = self._build_tree_structure(repo, items)
+            
+            with _tree_cache_lock:
+                _tree_cache[cache_key] = tree_data
+                while len(_tree_cache) > TREE_CACHE_SIZE:
+                    _tree_cache.popitem(last=False)
+            return tree_data
         except Exception as e:
             return {
                 "name": repo,
                 "type": "directory",
                 "icon": "📁",
-                "children": [{"name": f"Error: {str(e)}", "type": "file", "icon": "⚠️", "children": []}]
+                "children": [{"name": f"Error: {str(e)}", "type": "file", "icon": "⚠️"}]
             }
     
+    def _get_tree(self, owner, repo, sha, headers, recursive):
+        """Fetch one git tree object, optionally recursive"""
+        url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{sha}"
+        response = requests.get(url + ("?recursive=1" if recursive else ""), headers=headers, timeout=15)
+        response.raise_for_status()
+        return response.json()
+    
+    def _get_root_tree(self, owner, repo, ref, headers):
+        """Non-recursive root tree for ref, or None if the ref can't be fetched"""
+        try:
+            return self._get_tree(owner, repo, ref, headers, False)
+        except requests.RequestException:
+            return None
+
+    def _fetch_tree_entries(self, owner, repo, root, headers):
+        """Full flat tree listing below the root tree object.
+
+        When GitHub truncates the recursive listing, subtrees are fetched by
+        SHA in parallel (TREE_FETCH_CONCURRENCY at a time) and merged; a
+        subtree that is itself truncated is split into its children again.
+        """
+        tree_json = self._get_tree(owner, repo, root["sha"], headers, True)
+        if not tree_json.get("truncated", False):
+            return tree_json.get("tree", [])
+
+        entries = []
+        with ThreadPoolExecutor(max_workers=TREE_FETCH_CONCURRENCY) as pool:
+            pending = {}
+            for item in root.get("tree", []):
+                entries.append(item)
+                if item.get("type") == "tree":
+                    pending[pool.submit(self._get_tree, owner, repo, item["sha"], headers, True)] = (item["path"] + "/", True)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    prefix, recursive = pending.pop(future)
+                    subtree = future.result()
+                    if recursive and subtree.get("truncated", False):
+                        pending[pool.submit(self._get_tree, owner, repo, subtree["sha"], headers, False)] = (prefix, False)
+                        continue
+                    for item in subtree.get("tree", []):
+                        path = prefix + item.get("path", "")
+                        entries.append({**item, "path": path})
+                        if not recursive and item.get("type") == "tree":
+                            pending[pool.submit(self._get_tree, owner, repo, item["sha"], headers, True)] = (path + "/", True)
+        return entries
+
+    def _visible_entries(self, items):
+        """(path, parent_path, name, is_dir) for every entry outside TREE_SKIP_DIRS.
+
+        Single pass over the listing. GitHub lists parents before children, so
+        a skipped directory is dropped together with its subtree by a set
+        lookup; missing parents are synthesised to cover any gaps.
+        """
+        entries = []
+        dirs = {""}
+        skipped = set()
+
+        def add(path, is_dir):
+            parent, _, name = path.rpartition("/")
+            if parent not in dirs and parent not in skipped:
+                add(parent, True)
+            if parent in skipped or (is_dir and name.lower() in TREE_SKIP_DIRS):
+                if is_dir:
+                    skipped.add(path)
+                return
+            if is_dir:
+                if path in dirs:
+                    return
+                dirs.add(path)
+            entries.append((path, parent, name, is_dir))
+
+        for item in items:
+            path = item.get("path", "")
+            if path:
+                add(path, item.get("type") == "tree")
+        return entries
+    
     def _build_tree_structure(self, repo_name, items):
-        """Build hierarchical tree structure from flat GitHub tree"""
+        """Build hierarchical tree structure from flat GitHub tree.
+
+        Files carry only name and type; clients fall back to default icons.
+        """
         tree_data = {
             "name": repo_name,
             "type": "directory",
-            "icon": "📁",
             "children": []
         }
         
         dir_mapping = {"": tree_data}
-        items.sort(key=lambda x: (x.get("type", "") != "tree", x.get("path", "")))
-        
-        for item in items:
-            path = item.get("path", "")
-            if any(skip in path.lower() for skip in [".git/", "node_modules/", "__pycache__/"]):
-                continue
-            
-            parts = path.split("/")
-            is_dir = item.get("type") == "tree"
-            parent_path = "/".join(parts[:-1])
-            
+        for path, parent_path, name, is_dir in self._visible_entries(items):
             if is_dir:
-                dir_node = {
-                    "name": parts[-1],
-                    "type": "directory",
-                    "icon": "📁",
-                    "children": []
-                }
-                dir_mapping[path] = dir_node
-                parent = dir_mapping.get(parent_path, tree_data)
-                parent["children"].append(dir_node)
+                node = {"name": name, "type": "directory", "children": []}
+                dir_mapping[path] = node
             else:
-                file_node = {
-                    "name": parts[-1],
-                    "type": "file",
-                    "icon": "📄",
-                    "children": []
-                }
-                parent = dir_mapping.get(parent_path, tree_data)
-                parent["children"].append(file_node)
+                node = {"name": name, "type": "file"}
+            dir_mapping[parent_path]["children"].append(node)
         
         self._sort_tree(tree_data)
         return tree_data
     
+    def _build_compact_tree(self, repo_name, items):
+        """Build the compact flat tree encoding ("flat-v1").
+
+        Node i is named names[name[i]], has parent index parent[i] (-1 for the
+        root at index 0) and is a directory when dir[i] is 1. Names are
+        interned, nodes are in listing order with parents before children,
+        and clients sort for display.
+        """
+        names = []
+        name_ids = {}
+        parents = [-1]
+        name_col = []
+        dir_col = [1]
+        node_index = {"": 0}
+
+        def intern(name):
+            idx = name_ids.get(name)
+            if idx is None:
+                idx = name_ids[name] = len(names)
+                names.append(name)
+            return idx
+
+        name_col.append(intern(repo_name))
+        for path, parent_path, name, is_dir in self._visible_entries(items):
+            parents.append(node_index[parent_path])
+            name_col.append(intern(name))
+            dir_col.append(1 if is_dir else 0)
+            if is_dir:
+                node_index[path] = len(parents) - 1
+        return {"format": "flat-v1", "names": names, "parent": parents, "name": name_col, "dir": dir_col}
+    
     def _sort_tree(self, node):
         """Sort tree nodes recursively"""
         if node.get("children"):
@@ -250,6 +424,22 @@ class handler(BaseHTTPRequestHandler):
             for child in node["children"]:
                 self._sort_tree(child)
     
+    def _send_json(self, status_code, payload):
+        """Send a JSON response, gzip-compressed when the client accepts it"""
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        gzipped = "gzip" in self.headers.get('Accept-Encoding', '') and len(body) > 1024
+        if gzipped:
+            body = gzip.compress(body, compresslevel=6)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self._set_cors_headers()
+        self.end_headers()
+        self.wfile.write(body)
+    
     def send_error_response(self, status_code, message):
         """Send error response with CORS headers"""
         self.send_response(status_code)
@@ -1,12 +1,40 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Response
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse
 from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any, Tuple
+from contextvars import ContextVar, copy_context
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeout
+from collections import OrderedDict
+from contextlib import contextmanager
 import os
+import io
+import json
 import time
+import shutil
+import base64
 import hashlib
+import hmac
 import uuid
+import cProfile
+import pstats
+import functools
+import tempfile
+import threading
+import random
+import zlib
+import queue
+import math
+import asyncio
+import mmap
+import re
+import subprocess
+import importlib
+import importlib.util
+import numpy as np
 import requests as http_requests
 import traceback
 
@@ -18,25 +46,128 @@ JINA_API_KEY = os.environ.get("JINA_API_KEY")
 QDRANT_URL = os.environ.get("QDRANT_URL")
 QDRANT_API_KEY = os.environ.get("QDRANT_API_KEY")
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "xtension_profiles"))
+PROFILE_MAX_KEEP = int(os.environ.get("PROFILE_MAX_KEEP", "50"))
+TREE_FETCH_CONCURRENCY = int(os.environ.get("TREE_FETCH_CONCURRENCY", "8"))
+CONTEXT_DEADLINE_S = float(os.environ.get("CONTEXT_DEADLINE_S", "8"))
+CONTEXT_CACHE_SIZE = int(os.environ.get("CONTEXT_CACHE_SIZE", "128"))
+REF_CACHE_TTL_S = float(os.environ.get("REF_CACHE_TTL_S", "60"))
+BLOB_STORE_DIR = os.environ.get("BLOB_STORE_DIR", os.path.join(tempfile.gettempdir(), "xtension_blobs"))
+BLOB_STORE_MAX_BYTES = int(os.environ.get("BLOB_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+INDEX_STATE_DIR = os.environ.get("INDEX_STATE_DIR", os.path.join(tempfile.gettempdir(), "xtension_index_state"))
+INDEX_FIRST_TIER_FILES = int(os.environ.get("INDEX_FIRST_TIER_FILES", "50"))
+INDEX_BATCH_FILES = int(os.environ.get("INDEX_BATCH_FILES", "50"))
+INDEX_EARLY_BATCH_FILES = int(os.environ.get("INDEX_EARLY_BATCH_FILES", "10"))
+INDEX_MAX_FILES = int(os.environ.get("INDEX_MAX_FILES", "3000"))
+INDEX_MAX_BYTES = int(os.environ.get("INDEX_MAX_BYTES", str(40 * 1024 * 1024)))
+INDEX_MAX_TOKENS = int(os.environ.get("INDEX_MAX_TOKENS", "10000000"))
 
 EMBEDDING_MODEL = "jina-embeddings-v2-base-code"
 EMBEDDING_DIM = 768
 FILES_COLLECTION = "xtension_files"
 CHUNKS_COLLECTION = "xtension_chunks"
+MANIFEST_COLLECTION = "xtension_manifests"
+PATHS_COLLECTION = "xtension_repo_paths"
+COLLECTION_LAYOUT = os.environ.get("COLLECTION_LAYOUT", "tenant")
+DEDICATED_MIN_FILES = int(os.environ.get("DEDICATED_MIN_FILES", "0"))
+MANIFEST_CACHE_TTL_S = float(os.environ.get("MANIFEST_CACHE_TTL_S", "60"))
+DEFAULT_BRANCH_TTL_S = float(os.environ.get("DEFAULT_BRANCH_TTL_S", "600"))
+INDEX_TTL_S = float(os.environ.get("INDEX_TTL_S", str(30 * 24 * 3600)))
+INDEX_STORAGE_BUDGET_BYTES = int(os.environ.get("INDEX_STORAGE_BUDGET_BYTES", "0"))
+INDEX_GC_INTERVAL_S = float(os.environ.get("INDEX_GC_INTERVAL_S", "3600"))
+INDEX_ACCESS_FLUSH_S = float(os.environ.get("INDEX_ACCESS_FLUSH_S", "300"))
+GITHUB_WEBHOOK_SECRET = os.environ.get("GITHUB_WEBHOOK_SECRET")
+LOCAL_REPOS_DIR = os.environ.get("LOCAL_REPOS_DIR")
+QUERY_BATCH_MAX = int(os.environ.get("QUERY_BATCH_MAX", "20"))
+QUERY_BATCH_CONCURRENCY = int(os.environ.get("QUERY_BATCH_CONCURRENCY", "4"))
+QUERY_CONCURRENCY = int(os.environ.get("QUERY_CONCURRENCY", "16"))
+QUERY_QUEUE = int(os.environ.get("QUERY_QUEUE", "64"))
+SUMMARIZE_CONCURRENCY = int(os.environ.get("SUMMARIZE_CONCURRENCY", "4"))
+SUMMARIZE_QUEUE = int(os.environ.get("SUMMARIZE_QUEUE", "8"))
+ADMISSION_MAX_WAIT_S = float(os.environ.get("ADMISSION_MAX_WAIT_S", "10"))
+INDEX_CONCURRENCY = int(os.environ.get("INDEX_CONCURRENCY", "2"))
+INDEX_QUEUE = int(os.environ.get("INDEX_QUEUE", "16"))
+SUMMARIZE_INDEX_WAIT_S = float(os.environ.get("SUMMARIZE_INDEX_WAIT_S", "45"))
+INDEX_YIELD_MAX_S = float(os.environ.get("INDEX_YIELD_MAX_S", "10"))
+QUERY_DEADLINE_S = float(os.environ.get("QUERY_DEADLINE_S", "20"))
+QUERY_DEADLINE_MAX_S = float(os.environ.get("QUERY_DEADLINE_MAX_S", "60"))
+QUERY_LLM_MIN_S = float(os.environ.get("QUERY_LLM_MIN_S", "3"))
+QUERY_TWO_STAGE_MIN_S = float(os.environ.get("QUERY_TWO_STAGE_MIN_S", "1.5"))
+LLM_TIMEOUT_S = float(os.environ.get("LLM_TIMEOUT_S", "60"))
+LLM_PRIMARY_MODEL = os.environ.get("LLM_PRIMARY_MODEL", "openai/gpt-oss-120b")
+LLM_FALLBACK_MODEL = os.environ.get("LLM_FALLBACK_MODEL", "openai/gpt-oss-20b")  # "" disables fallback
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "8"))
+LLM_PRIMARY_CONCURRENCY = int(os.environ.get("LLM_PRIMARY_CONCURRENCY", "4"))
+LLM_FALLBACK_CONCURRENCY = int(os.environ.get("LLM_FALLBACK_CONCURRENCY", "6"))
+LLM_FALLBACK_WAIT_S = float(os.environ.get("LLM_FALLBACK_WAIT_S", "2"))
+LLM_FALLBACK_LATENCY_S = float(os.environ.get("LLM_FALLBACK_LATENCY_S", "15"))
+LLM_PROBE_INTERVAL_S = float(os.environ.get("LLM_PROBE_INTERVAL_S", "30"))
+LLM_CONTEXT_TOKENS = int(os.environ.get("LLM_CONTEXT_TOKENS", "131072"))
+LLM_MAX_TOKENS = int(os.environ.get("LLM_MAX_TOKENS", "8192"))
+LLM_MIN_TOKENS = int(os.environ.get("LLM_MIN_TOKENS", "256"))
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1") == "1"
+WARMUP_RETRIES = int(os.environ.get("WARMUP_RETRIES", "3"))
+WARMUP_RECHECK_S = float(os.environ.get("WARMUP_RECHECK_S", "30"))
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "xtension_snapshots"))
+WEBHOOK_DEBOUNCE_S = float(os.environ.get("WEBHOOK_DEBOUNCE_S", "30"))
+WEBHOOK_MAX_DELAY_S = float(os.environ.get("WEBHOOK_MAX_DELAY_S", "300"))
+WEBHOOK_MAX_RETRIES = int(os.environ.get("WEBHOOK_MAX_RETRIES", "5"))
+QDRANT_PREFER_GRPC = os.environ.get("QDRANT_PREFER_GRPC", "").lower() in ("1", "true", "yes")
+WRITE_CONCURRENCY = int(os.environ.get("WRITE_CONCURRENCY", "4"))
+WRITE_BATCH_BYTES = int(os.environ.get("WRITE_BATCH_BYTES", str(4 * 1024 * 1024)))
+EMBED_CONCURRENCY = int(os.environ.get("EMBED_CONCURRENCY", "4"))
+EMBED_BATCH_TOKENS = int(os.environ.get("EMBED_BATCH_TOKENS", "16000"))
+EMBED_BATCH_MAX_ITEMS = int(os.environ.get("EMBED_BATCH_MAX_ITEMS", "128"))
+EMBED_MAX_RETRIES = int(os.environ.get("EMBED_MAX_RETRIES", "5"))
+EMBED_BACKOFF_S = float(os.environ.get("EMBED_BACKOFF_S", "1"))
 
 for var, name in [(GROQ_API_KEY, "GROQ_API_KEY"), (JINA_API_KEY, "JINA_API_KEY"),
                   (QDRANT_URL, "QDRANT_URL"), (QDRANT_API_KEY, "QDRANT_API_KEY")]:
     if not var:
         print(f"Warning: {name} not set")
 
-try:
-    from qdrant_client import QdrantClient
-    from qdrant_client.models import (
-        Distance, VectorParams, PointStruct,
-        Filter, FieldCondition, MatchValue, PayloadSchemaType
+# ─── Lazy imports ──────────────────────────────────────────────────────────
+#
+# qdrant_client's models take over a second to import and groq a few hundred
+# ms; neither is needed to bind the port. Their names are bound to proxies
+# that import the real object on first use (the startup warm-up below does
+# that in the background), so the code uses them as if imported normally.
+
+
+class _LazyName:
+    def __init__(self, module: str, name: str):
+        self._module, self._name, self._obj = module, name, None
+
+    def _load(self):
+        if self._obj is None:
+            self._obj = getattr(importlib.import_module(self._module), self._name)
+        return self._obj
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+QdrantClient = _LazyName("qdrant_client", "QdrantClient")
+(Distance, VectorParams, Batch, PointStruct, Filter, FieldCondition, MatchValue, MatchAny,
+ PayloadSchemaType, FilterSelector, HnswConfigDiff, KeywordIndexParams, PointsQuery,
+ IsEmptyCondition, PayloadField) = (
+    _LazyName("qdrant_client.models", name) for name in (
+        "Distance", "VectorParams", "Batch", "PointStruct", "Filter", "FieldCondition", "MatchValue",
+        "MatchAny", "PayloadSchemaType", "FilterSelector", "HnswConfigDiff", "KeywordIndexParams",
+        "QueryRequest", "IsEmptyCondition", "PayloadField",
     )
-except ImportError:
-    QdrantClient = None
+)
+
+
+def _module_available(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+if not _module_available("qdrant_client"):
     print("Warning: qdrant-client not installed")
 
 # ─── App + CORS ────────────────────────────────────────────────────────────
@@ -44,21 +175,19 @@ except ImportError:
 app = FastAPI()
 
 
+def _add_cors_headers(response: Response) -> Response:
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
+    response.headers["Access-Control-Allow-Headers"] = "*"
+    response.headers["Access-Control-Allow-Credentials"] = "false"
+    return response
+
+
 class CustomCORSMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         if request.method == "OPTIONS":
-            response = Response()
-            response.headers["Access-Control-Allow-Origin"] = "*"
-            response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-            response.headers["Access-Control-Allow-Headers"] = "*"
-            response.headers["Access-Control-Allow-Credentials"] = "false"
-            return response
-        response = await call_next(request)
-        response.headers["Access-Control-Allow-Origin"] = "*"
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-        response.headers["Access-Control-Allow-Headers"] = "*"
-        response.headers["Access-Control-Allow-Credentials"] = "false"
-        return response
+            return _add_cors_headers(Response())
+        return _add_cors_headers(await call_next(request))
 
 
 app.add_middleware(
@@ -72,6 +201,244 @@ app.add_middleware(
 app.add_middleware(CustomCORSMiddleware)
 
 
+# ─── Profiling ─────────────────────────────────────────────────────────────
+#
+# Send `X-Profile: <ADMIN_TOKEN>` on any request to run it under cProfile.
+# Every @profiled function executed on behalf of that request — including
+# background tasks it schedules — writes its own .prof file into
+# PROFILE_DIR/<profile_id>/. The id is returned in the X-Profile-Id header.
+
+_profile_id: ContextVar[Optional[str]] = ContextVar("profile_id", default=None)
+# time.monotonic() when an admission-controlled request arrived, before any queueing
+_request_arrived_at: ContextVar[Optional[float]] = ContextVar("request_arrived_at", default=None)
+_profile_local = threading.local()
+
+
+def _require_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(404, "Admin endpoints disabled (ADMIN_TOKEN not set)")
+    if request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        raise HTTPException(403, "Invalid admin token")
+
+
+class ProfilingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        if not ADMIN_TOKEN or request.headers.get("X-Profile") != ADMIN_TOKEN:
+            return await call_next(request)
+        profile_id = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(os.path.join(PROFILE_DIR, profile_id), exist_ok=True)
+        _prune_profiles()
+        token = _profile_id.set(profile_id)
+        try:
+            response = await call_next(request)
+        finally:
+            _profile_id.reset(token)
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+
+app.add_middleware(ProfilingMiddleware)
+
+
+# ─── Admission control ─────────────────────────────────────────────────────
+#
+# Latency-sensitive endpoints run in admission classes with a concurrency
+# limit and a bounded wait queue. A full queue is rejected at once with 429;
+# a request that waits longer than ADMISSION_MAX_WAIT_S gets 503. Both carry
+# Retry-After, estimated from recent service times. Bulk indexing sits below
+# all of this: at most INDEX_CONCURRENCY index jobs run (INDEX_QUEUE more may
+# wait, beyond that /build_embeddings answers 429), and index batches hold
+# back while queries are queued.
+
+
+class AdmissionController:
+    def __init__(self, name: str, limit: int, queue_size: int):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = 0
+        self.avg_s = 1.0
+        self.admitted = self.rejected = self.timed_out = 0
+        self._sem = asyncio.Semaphore(limit)
+
+    def retry_after(self) -> int:
+        return int(min(60, max(1, math.ceil(self.avg_s * (self.waiting + 1) / self.limit))))
+
+    def busy(self) -> bool:
+        return self.waiting > 0 or self.active >= self.limit
+
+    def _reject(self, status: int, detail: str) -> Response:
+        return _add_cors_headers(JSONResponse(
+            {"detail": detail}, status_code=status, headers={"Retry-After": str(self.retry_after())}
+        ))
+
+    async def run(self, request: Request, call_next) -> Response:
+        if self._sem.locked() and self.waiting >= self.queue_size:
+            self.rejected += 1
+            return self._reject(429, f"Too many {self.name} requests, try again shortly")
+        if self._sem.locked():
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._sem.acquire(), ADMISSION_MAX_WAIT_S)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                return self._reject(503, f"Server overloaded ({self.name}), try again shortly")
+            finally:
+                self.waiting -= 1
+        else:
+            await self._sem.acquire()
+        self.active += 1
+        self.admitted += 1
+        started = time.monotonic()
+        try:
+            return await call_next(request)
+        finally:
+            self.active -= 1
+            self._sem.release()
+            self.avg_s = 0.8 * self.avg_s + 0.2 * (time.monotonic() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit, "queue_size": self.queue_size, "active": self.active,
+            "waiting": self.waiting, "avg_s": round(self.avg_s, 3), "admitted": self.admitted,
+            "rejected": self.rejected, "timed_out": self.timed_out,
+        }
+
+
+_admission = {
+    "query": AdmissionController("query", QUERY_CONCURRENCY, QUERY_QUEUE),
+    "summarize": AdmissionController("summarize", SUMMARIZE_CONCURRENCY, SUMMARIZE_QUEUE),
+}
+_admission_routes = {"/query": "query", "/query_batch": "query", "/summarize": "summarize"}
+
+
+class AdmissionMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        controller = _admission.get(_admission_routes.get(request.url.path, ""))
+        if controller is None or request.method == "OPTIONS":
+            return await call_next(request)
+        token = _request_arrived_at.set(time.monotonic())
+        try:
+            return await controller.run(request, call_next)
+        finally:
+            _request_arrived_at.reset(token)
+
+
+app.add_middleware(AdmissionMiddleware)
+
+
+def _yield_to_queries():
+    """Hold bulk indexing back (bounded) while query traffic is queued or saturated."""
+    deadline = time.time() + INDEX_YIELD_MAX_S
+    while _admission["query"].busy() and time.time() < deadline:
+        time.sleep(0.25)
+
+
+def profiled(label: str):
+    """Profile the wrapped call when the current request opted in via X-Profile."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profile_id = _profile_id.get()
+            # cProfile is per-thread and does not nest: an inner @profiled call
+            # in the same thread is already covered by the outer profiler.
+            if profile_id is None or getattr(_profile_local, "active", False):
+                return fn(*args, **kwargs)
+            prof = cProfile.Profile()
+            started = time.time()
+            cpu_started = time.thread_time()
+            _profile_local.active = True
+            try:
+                return prof.runcall(fn, *args, **kwargs)
+            finally:
+                _profile_local.active = False
+                _save_profile(profile_id, label, prof, started, time.thread_time() - cpu_started)
+        return wrapper
+    return decorator
+
+
+def _save_profile(profile_id: str, label: str, prof: cProfile.Profile, started: float, cpu_s: float):
+    try:
+        out_dir = os.path.join(PROFILE_DIR, profile_id)
+        os.makedirs(out_dir, exist_ok=True)
+        name = f"{label}-{uuid.uuid4().hex[:6]}"
+        prof.dump_stats(os.path.join(out_dir, f"{name}.prof"))
+        with open(os.path.join(out_dir, f"{name}.json"), "w") as f:
+            json.dump({
+                "label": label,
+                "thread": threading.current_thread().name,
+                "started_at": started,
+                "wall_s": round(time.time() - started, 4),
+                "cpu_s": round(cpu_s, 4),
+            }, f)
+    except Exception as e:
+        print(f"[Profile] Failed to save {label} for {profile_id}: {e}")
+
+
+def _prune_profiles():
+    try:
+        ids = sorted(os.listdir(PROFILE_DIR))
+    except OSError:
+        return
+    for old in ids[:-PROFILE_MAX_KEEP]:
+        shutil.rmtree(os.path.join(PROFILE_DIR, old), ignore_errors=True)
+
+
+def _profile_sections(profile_id: str) -> List[Dict[str, Any]]:
+    out_dir = os.path.join(PROFILE_DIR, os.path.basename(profile_id))
+    if not os.path.isdir(out_dir):
+        raise HTTPException(404, f"Unknown profile {profile_id}")
+    sections = []
+    for fname in sorted(os.listdir(out_dir)):
+        if fname.endswith(".json"):
+            with open(os.path.join(out_dir, fname)) as f:
+                meta = json.load(f)
+            meta["file"] = os.path.join(out_dir, fname[:-5] + ".prof")
+            sections.append(meta)
+    return sections
+
+
+@app.get("/admin/profiles")
+def list_profiles(request: Request):
+    _require_admin(request)
+    try:
+        ids = sorted(os.listdir(PROFILE_DIR), reverse=True)
+    except OSError:
+        ids = []
+    return {
+        "profiles": [
+            {
+                "profile_id": pid,
+                "sections": [
+                    {k: v for k, v in s.items() if k != "file"} for s in _profile_sections(pid)
+                ],
+            }
+            for pid in ids
+        ]
+    }
+
+
+@app.get("/admin/profiles/{profile_id}")
+def get_profile(profile_id: str, request: Request, sort: str = "cumulative", limit: int = 60):
+    """Merged pstats report for every section recorded under profile_id."""
+    _require_admin(request)
+    sections = _profile_sections(profile_id)
+    if not sections:
+        return Response(content="Profile is still running or recorded nothing.\n", media_type="text/plain")
+    buf = io.StringIO()
+    for s in sections:
+        buf.write(f"# {s['label']} [{s['thread']}] wall={s['wall_s']}s cpu={s['cpu_s']}s\n")
+    buf.write("\n")
+    stats = pstats.Stats(*[s["file"] for s in sections], stream=buf)
+    try:
+        stats.sort_stats(sort)
+    except KeyError:
+        raise HTTPException(400, f"Invalid sort key: {sort}")
+    stats.print_stats(limit)
+    return Response(content=buf.getvalue(), media_type="text/plain")
+
+
 @app.api_route("/", methods=["GET", "HEAD"])
 def read_root():
     return {"message": "GitHub Repo Summarizer RAG API", "version": "2.0"}
@@ -103,6 +470,10 @@ class BuildEmbeddingsRequest(BaseModel):
     owner: str
     repo: str
     branch: Optional[str] = None
+    # Per-repo indexing budget; defaults to, and is capped at, INDEX_MAX_FILES / _BYTES / _TOKENS
+    max_files: Optional[int] = None
+    max_bytes: Optional[int] = None
+    max_tokens: Optional[int] = None
 
 
 class QueryRequest(BaseModel):
@@ -112,6 +483,16 @@ class QueryRequest(BaseModel):
     branch: Optional[str] = None
     top_files: int = 8
     top_chunks: int = 12
+    deadline_s: Optional[float] = None  # whole-request budget; defaults to QUERY_DEADLINE_S
+
+
+class QueryBatchRequest(BaseModel):
+    owner: str
+    repo: str
+    questions: List[str]
+    branch: Optional[str] = None
+    top_files: int = 8
+    top_chunks: int = 12
 
 
 class Reference(BaseModel):
@@ -124,6 +505,12 @@ class Reference(BaseModel):
 class QueryResponse(BaseModel):
     answer: str
     references: List[Reference]
+    partial: bool = False  # answered while the repo was still being indexed
+    degraded: List[str] = []  # steps cut short to meet the request deadline
+
+
+class QueryBatchResponse(BaseModel):
+    results: List[QueryResponse]  # one per question, in request order
 
 
 # ─── Qdrant client ─────────────────────────────────────────────────────────
@@ -135,38 +522,60 @@ _collections_ready = False
 def get_qdrant_client():
     global _qdrant_client
     if _qdrant_client is None:
-        if QdrantClient is None:
+        if not _module_available("qdrant_client"):
             raise HTTPException(500, "qdrant-client not installed")
         if not QDRANT_URL:
             raise HTTPException(500, "QDRANT_URL not configured")
-        _qdrant_client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY, timeout=30)
+        _qdrant_client = QdrantClient(
+            url=QDRANT_URL, api_key=QDRANT_API_KEY, timeout=30, prefer_grpc=QDRANT_PREFER_GRPC
+        )
     return _qdrant_client
 
 
-def ensure_collections():
+_collections_setup: Optional[Future] = None
+_collections_setup_lock = threading.Lock()
+_collections_setup_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qdrant-setup")
+
+
+def ensure_collections(deadline: Optional[float] = None):
+    """Create missing collections and indexes once per process.
+
+    With a deadline (time.monotonic()), waits at most until then and raises
+    504; the setup keeps running, so a later request finds it done.
+    """
+    global _collections_setup
+    if _collections_ready:
+        return
+    if deadline is None:
+        return _setup_collections()
+    with _collections_setup_lock:
+        if _collections_setup is None or _collections_setup.done():
+            _collections_setup = _collections_setup_pool.submit(_setup_collections)
+        setup = _collections_setup
+    try:
+        setup.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FuturesTimeout:
+        raise HTTPException(504, "Qdrant collections not ready before the deadline")
+
+
+def _setup_collections():
     global _collections_ready
     if _collections_ready:
         return
     client = get_qdrant_client()
     try:
         existing = {c.name for c in client.get_collections().collections}
+        if MANIFEST_COLLECTION not in existing:
+            # One payload-only record per repo_id, fetched by point id
+            client.create_collection(collection_name=MANIFEST_COLLECTION, vectors_config={})
+        if PATHS_COLLECTION not in existing:
+            # Payload-only (repo_id, file_path) -> blob_sha membership records
+            client.create_collection(collection_name=PATHS_COLLECTION, vectors_config={})
         for coll in [FILES_COLLECTION, CHUNKS_COLLECTION]:
             if coll not in existing:
-                client.create_collection(
-                    collection_name=coll,
-                    vectors_config=VectorParams(size=EMBEDDING_DIM, distance=Distance.COSINE),
-                )
-            # Always ensure indexes — idempotent, safe to call even if they exist.
-            # Qdrant Cloud requires indexes on every field used in a filter.
-            for field in ["repo_id", "file_path"]:
-                try:
-                    client.create_payload_index(
-                        collection_name=coll,
-                        field_name=field,
-                        field_schema=PayloadSchemaType.KEYWORD,
-                    )
-                except Exception:
-                    pass  # already exists
+                _create_vector_collection(client, coll, COLLECTION_LAYOUT == "tenant")
+        _ensure_indexes(client, [FILES_COLLECTION, CHUNKS_COLLECTION, PATHS_COLLECTION],
+                        COLLECTION_LAYOUT == "tenant")
         _collections_ready = True
     except HTTPException:
         raise
@@ -174,20 +583,252 @@ def ensure_collections():
         raise HTTPException(502, f"Qdrant setup error: {e}")
 
 
-# ─── Jina AI embeddings ────────────────────────────────────────────────────
+# ─── Collection layout ─────────────────────────────────────────────────────
+#
+# COLLECTION_LAYOUT picks how the shared file/chunk collections are built:
+#   "shared" — one global HNSW graph, searches filter on the repo_ids index.
+#   "tenant" — repo_ids is a tenant index and HNSW links are built per repo
+#              (m=0, payload_m=16), so a small repo's filtered search walks
+#              its own graph instead of a huge global one.
+# Repos with at least DEDICATED_MIN_FILES files (0 = never) get their own
+# collection pair instead; they no longer share points with other repos.
+# Qdrant shard keys don't fit here: content-addressed points belong to
+# several repos at once. /admin/layout/migrate moves existing data over.
 
-def get_embeddings(texts: List[str]) -> List[List[float]]:
-    """Batch-embed texts via Jina AI API. No local model — no cold-start delay."""
-    if not texts:
-        return []
-    if not JINA_API_KEY:
-        raise HTTPException(500, "JINA_API_KEY not configured")
+_dedicated_repos: set = set()
+
+
+def _create_vector_collection(client, name: str, tenant: bool):
+    client.create_collection(
+        collection_name=name,
+        vectors_config=VectorParams(size=EMBEDDING_DIM, distance=Distance.COSINE),
+        hnsw_config=HnswConfigDiff(m=0, payload_m=16) if tenant else None,
+    )
+
+
+def _ensure_indexes(client, collections: List[str], tenant: bool):
+    # Qdrant Cloud requires indexes on every field used in a filter.
+    # `repo_id` is only set on PATHS points and on pre-content-addressing ones.
+    # One schema read per collection; only missing indexes cost a create call.
+    for coll in collections:
+        try:
+            existing = set(client.get_collection(coll).payload_schema or {})
+        except Exception:
+            existing = set()
+        for field in ["repo_id", "repo_ids", "blob_sha"]:
+            if field in existing:
+                continue
+            schema = PayloadSchemaType.KEYWORD
+            if tenant and field == "repo_ids" and coll != PATHS_COLLECTION:
+                schema = KeywordIndexParams(type="keyword", is_tenant=True)
+            try:
+                client.create_payload_index(collection_name=coll, field_name=field, field_schema=schema)
+            except Exception:
+                pass  # already exists
+
+
+def _dedicated_collections(repo_id: str) -> Tuple[str, str]:
+    slug = hashlib.sha1(repo_id.encode()).hexdigest()[:16]
+    return f"{FILES_COLLECTION}__{slug}", f"{CHUNKS_COLLECTION}__{slug}"
+
+
+def _repo_collections(repo_id: str, deadline: Optional[float] = None) -> Tuple[str, str]:
+    """(files, chunks) collections holding repo_id's points."""
+    if repo_id not in _dedicated_repos:
+        manifest = get_manifest(repo_id, deadline)
+        if not (manifest and manifest.get("dedicated")):
+            return FILES_COLLECTION, CHUNKS_COLLECTION
+        _dedicated_repos.add(repo_id)
+    return _dedicated_collections(repo_id)
+
+
+def _ensure_dedicated(repo_id: str):
+    client = get_qdrant_client()
+    existing = {c.name for c in client.get_collections().collections}
+    for coll in _dedicated_collections(repo_id):
+        if coll not in existing:
+            _create_vector_collection(client, coll, tenant=False)
+    _ensure_indexes(client, list(_dedicated_collections(repo_id)), tenant=False)
+
+
+# ─── Vector-store writer ───────────────────────────────────────────────────
+#
+# Upserts are sliced into batches of roughly WRITE_BATCH_BYTES and sent
+# WRITE_CONCURRENCY at a time without waiting for Qdrant to apply them.
+# flush() is the consistency barrier: once every non-blocking batch has been
+# accepted, the held-back last batch is sent with wait=True, and since Qdrant
+# applies a shard's updates in order, everything written before it is
+# searchable when flush() returns. That ordering only covers one shard: the
+# last batch need not touch every shard another batch did, so collections
+# with several shards get wait=True on every batch instead.
+#
+# qdrant-client has no numpy wire format (upload_collection also calls
+# .tolist() per batch), so vectors are converted once per batch and the
+# Batch model is built without re-validating every float.
+
+_write_pool = ThreadPoolExecutor(max_workers=WRITE_CONCURRENCY, thread_name_prefix="qdrant-write")
+_shard_counts: Dict[str, int] = {}
+
+
+def _shard_count(client, collection: str) -> int:
+    if collection not in _shard_counts:
+        try:
+            shards = client.get_collection(collection).config.params.shard_number or 1
+        except Exception as e:
+            # Unknown: treat as sharded, which is slower but always consistent
+            print(f"[Write] Could not read shard count of {collection} ({e})")
+            return 2
+        _shard_counts[collection] = shards
+    return _shard_counts[collection]
+
+
+class VectorWriter:
+    def __init__(self, client):
+        self.client = client
+        self._pending: Dict[str, List[Any]] = {}
+        self._held: Dict[str, Tuple[List[str], np.ndarray, List[Dict[str, Any]]]] = {}
+        self.points = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._started: Optional[float] = None
+
+    def _batches(self, ids: List[str], vectors: np.ndarray, payloads: List[Dict[str, Any]]):
+        # REST sends each float as JSON text (~10 bytes), gRPC as 4 raw bytes
+        vector_bytes = vectors.shape[1] * (4 if QDRANT_PREFER_GRPC else 10) if len(vectors) else 0
+        start, size = 0, 0
+        for i, payload in enumerate(payloads):
+            point_bytes = vector_bytes + len(json.dumps(payload))
+            if i > start and size + point_bytes > WRITE_BATCH_BYTES:
+                yield ids[start:i], vectors[start:i], payloads[start:i], size
+                start, size = i, 0
+            size += point_bytes
+        if start < len(ids):
+            yield ids[start:], vectors[start:], payloads[start:], size
+
+    def _send(self, collection: str, ids: List[str], vectors: np.ndarray,
+              payloads: List[Dict[str, Any]], wait: bool):
+        for attempt in range(3):
+            try:
+                self.client.upsert(
+                    collection_name=collection,
+                    points=Batch.model_construct(ids=ids, vectors=vectors.tolist(), payloads=payloads),
+                    wait=wait,
+                )
+                return
+            except Exception as e:
+                if attempt == 2:
+                    raise
+                print(f"[Write] Upsert of {len(ids)} points to {collection} failed ({e}), retrying")
+                time.sleep(0.5 * 2 ** attempt)
+
+    def write(self, collection: str, ids: List[str], vectors: np.ndarray, payloads: List[Dict[str, Any]]):
+        if self._started is None:
+            self._started = time.time()
+        wait = _shard_count(self.client, collection) > 1
+        for batch_ids, batch_vectors, batch_payloads, size in self._batches(ids, vectors, payloads):
+            held = self._held.get(collection)
+            if held:
+                self._pending.setdefault(collection, []).append(
+                    _write_pool.submit(self._send, collection, *held, wait)
+                )
+            self._held[collection] = (batch_ids, batch_vectors, batch_payloads)
+            self.points += len(batch_ids)
+            self.bytes += size
+
+    def flush(self, collection: str):
+        """Block until every point written to collection is applied and searchable."""
+        futures = self._pending.pop(collection, [])
+        held = self._held.pop(collection, None)
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        if held:
+            self._send(collection, *held, True)
+        if self._started is not None:
+            self.seconds = time.time() - self._started
+
+    def stats(self) -> Dict[str, Any]:
+        seconds = max(self.seconds, 1e-6)
+        return {
+            "points": self.points,
+            "mb": round(self.bytes / 1e6, 2),
+            "seconds": round(self.seconds, 3),
+            "points_per_s": round(self.points / seconds, 1),
+            "mb_per_s": round(self.bytes / 1e6 / seconds, 2),
+        }
 
-    all_embeddings: List[List[float]] = []
-    batch_size = 64
 
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i : i + batch_size]
+# ─── Jina AI embeddings ────────────────────────────────────────────────────
+
+# Batches are sized by estimated tokens and several are kept in flight. All
+# callers share one AIMD limiter: a 429/5xx halves the allowed concurrency
+# and pauses new requests for the backoff period, successes grow it back,
+# and only the failed batch is retried.
+
+_embed_cond = threading.Condition()
+_embed_in_flight = 0
+_embed_limit = float(EMBED_CONCURRENCY)
+_embed_pause_until = 0.0
+_embed_pool = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix="embed")
+
+
+def _embedding_batches(texts: List[str]) -> List[Tuple[int, int]]:
+    """(start, end) ranges holding at most EMBED_BATCH_TOKENS estimated tokens each."""
+    batches: List[Tuple[int, int]] = []
+    start, tokens = 0, 0
+    for i, text in enumerate(texts):
+        t = len(text) // 4 + 1
+        if i > start and (tokens + t > EMBED_BATCH_TOKENS or i - start >= EMBED_BATCH_MAX_ITEMS):
+            batches.append((start, i))
+            start, tokens = i, 0
+        tokens += t
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+def _acquire_embed_slot(deadline: Optional[float] = None):
+    global _embed_in_flight
+    with _embed_cond:
+        while True:
+            wait_s = _embed_pause_until - time.time()
+            if wait_s <= 0 and _embed_in_flight < max(1, int(_embed_limit)):
+                _embed_in_flight += 1
+                return
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise HTTPException(504, "Deadline exceeded waiting for the embedding API")
+                wait_s = min(wait_s, left) if wait_s > 0 else left
+            _embed_cond.wait(timeout=wait_s if wait_s > 0 else None)
+
+
+def _release_embed_slot(ok: bool, backoff_s: float = 0.0):
+    global _embed_in_flight, _embed_limit, _embed_pause_until
+    with _embed_cond:
+        _embed_in_flight -= 1
+        if ok:
+            _embed_limit = min(float(EMBED_CONCURRENCY), _embed_limit + 1 / max(1.0, _embed_limit))
+        elif backoff_s:
+            _embed_limit = max(1.0, _embed_limit / 2)
+            _embed_pause_until = max(_embed_pause_until, time.time() + backoff_s)
+        _embed_cond.notify_all()
+
+
+def _decode_embedding(value: Any) -> np.ndarray:
+    """float32 vector from a base64 (little-endian float32) or plain list embedding."""
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype="<f4")
+    return np.asarray(value, dtype=np.float32)
+
+
+def _embed_batch(batch: List[str], deadline: Optional[float] = None) -> np.ndarray:
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        _acquire_embed_slot(deadline)
         try:
             r = http_requests.post(
                 "https://api.jina.ai/v1/embeddings",
@@ -195,21 +836,236 @@ def get_embeddings(texts: List[str]) -> List[List[float]]:
                     "Content-Type": "application/json",
                     "Authorization": f"Bearer {JINA_API_KEY}",
                 },
-                json={"input": batch, "model": EMBEDDING_MODEL},
-                timeout=60,
+                json={"input": batch, "model": EMBEDDING_MODEL, "embedding_type": "base64"},
+                timeout=_time_left(deadline, 60),
             )
-            if not r.ok:
-                raise HTTPException(502, f"Jina API error {r.status_code}: {r.text[:200]}")
-            data = r.json()
-            all_embeddings.extend(item["embedding"] for item in data["data"])
-        except HTTPException:
-            raise
         except Exception as e:
-            raise HTTPException(502, f"Jina API call failed: {e}")
+            r, error = None, f"Jina API call failed: {e}"
+
+        if r is not None and r.ok:
+            data = sorted(r.json()["data"], key=lambda item: item.get("index", 0))
+            if len(data) == len(batch):
+                _release_embed_slot(ok=True)
+                out = np.empty((len(batch), EMBEDDING_DIM), dtype=np.float32)
+                for row, item in enumerate(data):
+                    out[row] = _decode_embedding(item["embedding"])
+                return out
+            # Short responses would leave rows of `out` uninitialised; retry them like a failed call
+            r, error = None, f"Jina API returned {len(data)} embeddings for {len(batch)} inputs"
+
+        if r is not None:
+            error = f"Jina API error {r.status_code}: {r.text[:200]}"
+        retryable = r is None or r.status_code == 429 or r.status_code >= 500
+        backoff = min(30.0, EMBED_BACKOFF_S * 2 ** attempt) * (0.5 + random.random() / 2)
+        if r is not None and r.headers.get("Retry-After", "").isdigit():
+            backoff = max(backoff, float(r.headers["Retry-After"]))
+        if deadline is not None and time.monotonic() + backoff >= deadline:
+            retryable = False
+        if not retryable or attempt == EMBED_MAX_RETRIES:
+            _release_embed_slot(ok=False)
+            raise HTTPException(502, error)
+
+        print(f"[Embed] {error.split(':')[0]}, retrying batch of {len(batch)} in {backoff:.1f}s")
+        _release_embed_slot(ok=False, backoff_s=backoff)
+    raise HTTPException(502, "Jina API call failed")
+
+
+def get_embeddings(texts: List[str], deadline: Optional[float] = None) -> np.ndarray:
+    """Batch-embed texts via Jina AI API. No local model — no cold-start delay.
+
+    Returns a contiguous (len(texts), EMBEDDING_DIM) float32 matrix decoded
+    straight from Jina's base64 response, never per-element Python floats.
+    With a deadline (time.monotonic()), calls and retries are cut to fit it.
+    """
+    if not texts:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    if not JINA_API_KEY:
+        raise HTTPException(500, "JINA_API_KEY not configured")
+
+    batches = _embedding_batches(texts)
+    if len(batches) == 1:
+        return _embed_batch(texts, deadline)
 
+    futures = [_embed_pool.submit(_embed_batch, texts[start:end], deadline) for start, end in batches]
+    all_embeddings = np.empty((len(texts), EMBEDDING_DIM), dtype=np.float32)
+    try:
+        for (start, end), future in zip(batches, futures):
+            all_embeddings[start:end] = future.result()
+    except Exception:
+        for future in futures:
+            future.cancel()
+        raise
     return all_embeddings
 
 
+# ─── LLM gateway ───────────────────────────────────────────────────────────
+#
+# Every Groq completion goes through llm_complete(): one shared client, a
+# global LLM_CONCURRENCY limit plus a per-model limit, and max_tokens sized
+# to what the prompt leaves of the context window. Requests go to the primary
+# model unless its queue wait would exceed LLM_FALLBACK_WAIT_S, its recent
+# latency is above LLM_FALLBACK_LATENCY_S (one probe per
+# LLM_PROBE_INTERVAL_S still tries it), or it fails with a rate limit or
+# server error; then the smaller fallback model answers instead. Latency is
+# tracked per call class ("query", "summarize"), so long summaries never
+# make the primary look slow to short query answers. Each routing decision
+# is counted and shown by /admin/llm.
+
+
+class _ModelRoute:
+    def __init__(self, model: str, limit: int):
+        self.model = model
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.latency_s: Dict[str, float] = {}  # call class -> EWMA of completion time
+        self.last_used_at: Dict[str, float] = {}  # call class -> time.time()
+        self.calls = self.errors = self.queue_timeouts = 0
+
+    def slow(self, call_class: str) -> bool:
+        return self.latency_s.get(call_class, 0.0) > LLM_FALLBACK_LATENCY_S and \
+            time.time() - self.last_used_at.get(call_class, 0.0) < LLM_PROBE_INTERVAL_S
+
+    def record_latency(self, call_class: str, latency_s: float):
+        last = self.latency_s.get(call_class)
+        self.latency_s[call_class] = latency_s if last is None else 0.8 * last + 0.2 * latency_s
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit, "active": self.active, "waiting": self.waiting,
+            "latency_s": {k: round(v, 3) for k, v in self.latency_s.items()},
+            "calls": self.calls, "errors": self.errors, "queue_timeouts": self.queue_timeouts,
+        }
+
+
+class LLMBusy(TimeoutError):
+    """No slot on the chosen model freed up in time."""
+
+
+_llm_client = None
+_llm_cond = threading.Condition()
+_llm_in_flight = 0
+_llm_routes: Dict[str, _ModelRoute] = {LLM_PRIMARY_MODEL: _ModelRoute(LLM_PRIMARY_MODEL, LLM_PRIMARY_CONCURRENCY)}
+if LLM_FALLBACK_MODEL and LLM_FALLBACK_MODEL != LLM_PRIMARY_MODEL:
+    _llm_routes[LLM_FALLBACK_MODEL] = _ModelRoute(LLM_FALLBACK_MODEL, LLM_FALLBACK_CONCURRENCY)
+_llm_decisions: Dict[str, int] = {}
+
+
+def llm_available() -> bool:
+    return bool(GROQ_API_KEY or os.environ.get("API_KEY"))
+
+
+def get_llm_client():
+    global _llm_client
+    if _llm_client is None:
+        if not llm_available():
+            raise HTTPException(500, "No LLM API key configured")
+        from groq import Groq
+        _llm_client = Groq(api_key=GROQ_API_KEY or os.environ.get("API_KEY"), timeout=LLM_TIMEOUT_S)
+    return _llm_client
+
+
+def _llm_max_tokens(messages: List[Dict[str, str]], requested: Optional[int]) -> int:
+    prompt_tokens = sum(len(m["content"]) // 4 + 1 for m in messages)
+    return max(LLM_MIN_TOKENS, min(requested or LLM_MAX_TOKENS, LLM_CONTEXT_TOKENS - prompt_tokens))
+
+
+def _acquire_llm_slot(route: _ModelRoute, call_class: str, wait_s: float) -> bool:
+    global _llm_in_flight
+    deadline = time.monotonic() + wait_s
+    with _llm_cond:
+        route.waiting += 1
+        try:
+            while route.active >= route.limit or _llm_in_flight >= LLM_CONCURRENCY:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    route.queue_timeouts += 1
+                    return False
+                _llm_cond.wait(left)
+            route.active += 1
+            route.last_used_at[call_class] = time.time()
+            _llm_in_flight += 1
+            return True
+        finally:
+            route.waiting -= 1
+
+
+def _release_llm_slot(route: _ModelRoute, call_class: str, latency_s: Optional[float]):
+    global _llm_in_flight
+    with _llm_cond:
+        route.active -= 1
+        _llm_in_flight -= 1
+        if latency_s is not None:
+            route.record_latency(call_class, latency_s)
+        _llm_cond.notify_all()
+
+
+def _complete_on(route: _ModelRoute, reason: str, call_class: str, messages: List[Dict[str, str]],
+                 temperature: float, max_tokens: int, deadline: float, wait_s: Optional[float] = None) -> str:
+    key = f"{route.model}:{reason}"
+    with _llm_cond:
+        _llm_decisions[key] = _llm_decisions.get(key, 0) + 1
+    if reason != "primary":
+        print(f"[LLM] Routed to {route.model} ({reason})")
+    left = deadline - time.monotonic()
+    if not _acquire_llm_slot(route, call_class, min(wait_s, left) if wait_s is not None else left):
+        raise LLMBusy(f"No {route.model} slot free in time")
+    started = time.monotonic()
+    latency_s = None
+    try:
+        route.calls += 1
+        completion = get_llm_client().chat.completions.create(
+            messages=messages,
+            model=route.model,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=False,
+            timeout=max(1.0, deadline - time.monotonic()),
+        )
+        latency_s = time.monotonic() - started
+        return completion.choices[0].message.content
+    except Exception as e:
+        route.errors += 1
+        # A timeout is the slowest kind of answer; let it count toward latency
+        if "Timeout" in type(e).__name__:
+            latency_s = time.monotonic() - started
+        raise
+    finally:
+        _release_llm_slot(route, call_class, latency_s)
+
+
+def _provider_overloaded(e: Exception) -> bool:
+    status = getattr(e, "status_code", None)
+    return type(e).__module__.startswith("groq") and (status is None or status == 429 or status >= 500)
+
+
+def llm_complete(messages: List[Dict[str, str]], temperature: float = 0.2,
+                 max_tokens: Optional[int] = None, timeout: float = LLM_TIMEOUT_S,
+                 call_class: str = "query") -> str:
+    """Chat completion via the shared client, routed to the primary or the fallback model.
+
+    call_class groups calls of similar length; only latency seen for the same
+    class decides whether the primary counts as slow.
+    """
+    deadline = time.monotonic() + timeout
+    max_tokens = _llm_max_tokens(messages, max_tokens)
+    primary = _llm_routes[LLM_PRIMARY_MODEL]
+    fallback = next((r for r in _llm_routes.values() if r is not primary), None)
+    args = (call_class, messages, temperature, max_tokens, deadline)
+    if fallback is None:
+        return _complete_on(primary, "primary", *args)
+    if primary.slow(call_class):
+        return _complete_on(fallback, "primary_slow", *args)
+    try:
+        return _complete_on(primary, "primary", *args, wait_s=LLM_FALLBACK_WAIT_S)
+    except LLMBusy:
+        return _complete_on(fallback, "primary_queue", *args)
+    except Exception as e:
+        if not _provider_overloaded(e) or deadline - time.monotonic() < 1.0:
+            raise
+        return _complete_on(fallback, "primary_error", *args)
+
+
 # ─── Utilities ─────────────────────────────────────────────────────────────
 
 def make_point_id(repo_id: str, path: str, start_line=None, end_line=None) -> str:
@@ -219,54 +1075,141 @@ def make_point_id(repo_id: str, path: str, start_line=None, end_line=None) -> st
     return str(uuid.UUID(bytes=digest))
 
 
+def make_blob_point_id(blob_sha: str, start_line=None, end_line=None) -> str:
+    """Point id for a file (or a chunk of it) addressed by content, shared by every repo containing it."""
+    return make_point_id(f"blob:{EMBEDDING_MODEL}", blob_sha, start_line, end_line)
+
+
+def _time_left(deadline: Optional[float], cap: float, floor: float = 0.5) -> float:
+    """Timeout for one upstream call: cap, shortened to what remains before deadline (time.monotonic())."""
+    if deadline is None:
+        return cap
+    return max(floor, min(cap, deadline - time.monotonic()))
+
+
+def _qdrant_timeout(deadline: Optional[float], cap: int = 30) -> int:
+    """Per-call Qdrant timeout in whole seconds, rounded down so it never outlasts deadline.
+
+    qdrant-client applies it to the HTTP request (or gRPC deadline) as well as
+    sending it to the server, so it bounds the call on both sides. Its
+    smallest value is 1s, so with less than that left the call is skipped (504).
+    """
+    if deadline is None:
+        return cap
+    left = deadline - time.monotonic()
+    if left < 1.0:
+        raise HTTPException(504, "Deadline reached before the Qdrant call")
+    return int(min(cap, left))
+
+
 def get_repo_id(owner: str, repo: str, branch: Optional[str]) -> str:
     return f"{owner}/{repo}@{branch}" if branch else f"{owner}/{repo}"
 
 
-def get_default_branch(owner: str, repo: str) -> str:
+_default_branch_cache: Dict[Tuple[str, str], Tuple[float, str]] = {}
+
+
+def get_default_branch(owner: str, repo: str, timeout: float = 15) -> str:
+    hit = _default_branch_cache.get((owner, repo))
+    if hit and time.time() - hit[0] < DEFAULT_BRANCH_TTL_S:
+        return hit[1]
+    local = get_local_repo(owner, repo)
+    if local:
+        try:
+            branch = local.default_branch()
+            _default_branch_cache[(owner, repo)] = (time.time(), branch)
+            return branch
+        except subprocess.CalledProcessError:
+            pass
     try:
         headers = {"Accept": "application/vnd.github.v3+json"}
         if GITHUB_TOKEN:
             headers["Authorization"] = f"token {GITHUB_TOKEN}"
         r = http_requests.get(
-            f"https://api.github.com/repos/{owner}/{repo}", headers=headers, timeout=15
+            f"https://api.github.com/repos/{owner}/{repo}", headers=headers, timeout=timeout
         )
         if r.ok:
-            return r.json().get("default_branch", "main")
+            branch = r.json().get("default_branch", "main")
+            _default_branch_cache[(owner, repo)] = (time.time(), branch)
+            return branch
     except Exception:
         pass
     return "main"
 
 
-def list_repo_files(owner: str, repo: str, branch: str) -> List[str]:
+def _get_tree(owner: str, repo: str, sha: str, headers: Dict[str, str], recursive: bool,
+              timeout: float = 20) -> Dict[str, Any]:
+    url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{sha}"
+    r = http_requests.get(url + ("?recursive=1" if recursive else ""), headers=headers, timeout=timeout)
+    if not r.ok:
+        raise HTTPException(502, f"Failed to fetch repo tree: {r.status_code}")
+    return r.json()
+
+
+def _list_tree_entries(owner: str, repo: str, ref: str, headers: Dict[str, str],
+                       timeout: float = 20) -> List[Dict[str, Any]]:
+    """Full recursive tree listing for ref.
+
+    GitHub truncates recursive listings of large repos. When that happens the
+    tree is walked level by level instead: each subtree is requested
+    recursively by SHA (TREE_FETCH_CONCURRENCY at a time), and any subtree
+    that is itself truncated is split into its children again.
+    """
+    data = _get_tree(owner, repo, ref, headers, True, timeout)
+    if not data.get("truncated"):
+        return data.get("tree", [])
+
+    print(f"[Tree] {owner}/{repo}@{ref} truncated, walking subtrees")
+    entries: List[Dict[str, Any]] = []
+    with ThreadPoolExecutor(max_workers=TREE_FETCH_CONCURRENCY) as pool:
+        pending = {pool.submit(_get_tree, owner, repo, ref, headers, False, timeout): ("", False)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                prefix, recursive = pending.pop(fut)
+                data = fut.result()
+                if recursive and data.get("truncated"):
+                    pending[pool.submit(_get_tree, owner, repo, data["sha"], headers, False, timeout)] = (prefix, False)
+                    continue
+                for item in data.get("tree", []):
+                    path = prefix + item["path"]
+                    entries.append({**item, "path": path})
+                    if not recursive and item.get("type") == "tree":
+                        pending[pool.submit(_get_tree, owner, repo, item["sha"], headers, True, timeout)] = (path + "/", True)
+    return entries
+
+
+def list_repo_blobs(owner: str, repo: str, branch: str) -> Dict[str, str]:
+    """Supported text files mapped to their git blob SHA, most important first."""
+    local = get_local_repo(owner, repo)
+    if local:
+        shas = {path: sha for path, sha in local.list_blobs(branch).items() if _is_supported_text_file(path)}
+        return {path: shas[path] for path in _prioritize_files(list(shas))}
     headers = {"Accept": "application/vnd.github.v3+json"}
     if GITHUB_TOKEN:
         headers["Authorization"] = f"token {GITHUB_TOKEN}"
-    url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
-    r = http_requests.get(url, headers=headers, timeout=20)
-    if not r.ok:
+    try:
+        tree = _list_tree_entries(owner, repo, branch, headers)
+    except HTTPException:
         fallback = "master" if branch != "master" else "main"
-        r = http_requests.get(
-            f"https://api.github.com/repos/{owner}/{repo}/git/trees/{fallback}?recursive=1",
-            headers=headers,
-            timeout=20,
-        )
-        if not r.ok:
-            raise HTTPException(502, f"Failed to fetch repo tree: {r.status_code}")
-    data = r.json()
-    files = [
-        item["path"]
-        for item in data.get("tree", [])
+        tree = _list_tree_entries(owner, repo, fallback, headers)
+    shas = {
+        item["path"]: item.get("sha")
+        for item in tree
         if item.get("type") == "blob" and _is_supported_text_file(item["path"])
-    ]
-    return _prioritize_files(files)
+    }
+    return {path: shas[path] for path in _prioritize_files(list(shas))}
 
 
-def _prioritize_files(files: List[str], max_files: int = 50) -> List[str]:
-    """Return the most important files first, capped at max_files.
+def list_repo_files(owner: str, repo: str, branch: str) -> List[str]:
+    return list(list_repo_blobs(owner, repo, branch))
+
 
-    Prioritises root-level entry points and config files so small repos get
-    fully indexed while large repos (langchain, etc.) stay fast.
+def _prioritize_files(files: List[str], max_files: Optional[int] = None) -> List[str]:
+    """Return the most important files first, optionally capped at max_files.
+
+    Prioritises root-level entry points and config files so the first indexing
+    tier makes large repos (langchain, etc.) searchable quickly.
     """
     def score(path: str) -> int:
         name = os.path.basename(path).lower()
@@ -285,7 +1228,8 @@ def _prioritize_files(files: List[str], max_files: int = 50) -> List[str]:
             return 4
         return 5 + depth
 
-    return sorted(files, key=score)[:max_files]
+    ordered = sorted(files, key=score)
+    return ordered[:max_files] if max_files is not None else ordered
 
 
 def _is_supported_text_file(path: str) -> bool:
@@ -310,7 +1254,214 @@ def _is_supported_text_file(path: str) -> bool:
     return ext in allow_exts
 
 
-def fetch_file_content(owner: str, repo: str, branch: str, path: str) -> Optional[str]:
+# ─── Local git checkouts ───────────────────────────────────────────────────
+#
+# Repos with a bare clone or working tree at LOCAL_REPOS_DIR/<owner>/<repo>.git
+# (or .../<owner>/<repo>) are read with git plumbing instead of the GitHub API:
+# `ls-tree` lists blobs with their SHAs and one long-lived `cat-file --batch`
+# process streams contents out of the object store. Everything downstream —
+# filtering, prioritisation, chunking, embedding — is unchanged. Keeping the
+# clone up to date (e.g. `git remote update` from cron) is up to the operator.
+
+_local_repos: Dict[str, "LocalRepo"] = {}
+_local_repos_lock = threading.Lock()
+
+# owner/repo come straight from requests; only plain GitHub-style names may
+# touch the filesystem, and refs are passed after --end-of-options.
+_SAFE_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+_SAFE_REF = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_./-]*$")
+
+
+def _safe_ref(ref: str) -> bool:
+    return bool(_SAFE_REF.match(ref)) and ".." not in ref and "//" not in ref
+
+
+class LocalRepo:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._cat: Optional[subprocess.Popen] = None
+
+    def git(self, *args: str) -> str:
+        return subprocess.run(
+            ["git", "-C", self.path, *args], capture_output=True, check=True, timeout=120
+        ).stdout.decode("utf-8", errors="replace")
+
+    def default_branch(self) -> str:
+        return self.git("symbolic-ref", "--short", "HEAD").strip()
+
+    def resolve(self, ref: str) -> Optional[str]:
+        if not _safe_ref(ref):
+            return None
+        try:
+            return self.git("rev-parse", "--verify", "--quiet", "--end-of-options",
+                            f"{ref}^{{commit}}").strip() or None
+        except subprocess.CalledProcessError:
+            return None
+
+    def list_blobs(self, ref: str) -> Dict[str, str]:
+        if not _safe_ref(ref):
+            raise HTTPException(400, f"Invalid ref: {ref!r}")
+        try:
+            out = self.git("ls-tree", "-r", "-z", "--end-of-options", ref)
+        except subprocess.CalledProcessError:
+            raise HTTPException(404, f"{ref} not found in local checkout {self.path}")
+        blobs: Dict[str, str] = {}
+        for entry in out.split("\0"):
+            if not entry:
+                continue
+            meta, path = entry.split("\t", 1)
+            _, kind, sha = meta.split()
+            if kind == "blob":
+                blobs[path] = sha
+        return blobs
+
+    def read(self, obj: str) -> Optional[bytes]:
+        """Contents of a blob, by SHA or `<ref>:<path>`; None if it doesn't exist."""
+        if "\n" in obj or not _safe_ref(obj.split(":", 1)[0]):
+            return None  # would desync the batch protocol
+        with self._lock:
+            if self._cat is None or self._cat.poll() is not None:
+                self._cat = subprocess.Popen(
+                    ["git", "-C", self.path, "cat-file", "--batch"],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                )
+            self._cat.stdin.write(obj.encode() + b"\n")
+            self._cat.stdin.flush()
+            header = self._cat.stdout.readline().split()
+            if len(header) != 3 or header[1] != b"blob":
+                return None  # "<obj> missing" / not a blob
+            data = self._cat.stdout.read(int(header[2]))
+            self._cat.stdout.read(1)  # trailing newline
+            return data
+
+
+def get_local_repo(owner: str, repo: str) -> Optional[LocalRepo]:
+    if not LOCAL_REPOS_DIR:
+        return None
+    if not (_SAFE_NAME.match(owner) and _SAFE_NAME.match(repo)) or {owner, repo} & {".", ".."}:
+        return None
+    root = os.path.realpath(LOCAL_REPOS_DIR)
+    key = f"{owner}/{repo}"
+    with _local_repos_lock:
+        if key not in _local_repos:
+            for name in (f"{repo}.git", repo):
+                path = os.path.realpath(os.path.join(root, owner, name))
+                if os.path.commonpath([root, path]) != root:
+                    continue
+                if os.path.isfile(os.path.join(path, "HEAD")) or os.path.exists(os.path.join(path, ".git")):
+                    _local_repos[key] = LocalRepo(path)
+                    break
+            else:
+                return None
+        return _local_repos[key]
+
+
+# ─── Blob store ────────────────────────────────────────────────────────────
+#
+# Raw file bodies, zlib-compressed on local disk and addressed by their git
+# blob SHA, so reindexing, fallback answers and chunk rendering read from
+# disk instead of raw.githubusercontent. Reads refresh a blob's mtime; once
+# BLOB_STORE_MAX_BYTES is exceeded the least recently used blobs are evicted.
+
+_blob_lock = threading.Lock()
+_blob_store_bytes: Optional[int] = None
+
+
+def git_blob_sha(data: bytes) -> str:
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def _blob_path(sha: str) -> str:
+    return os.path.join(BLOB_STORE_DIR, sha[:2], sha[2:])
+
+
+def blob_get(sha: str) -> Optional[bytes]:
+    path = _blob_path(sha)
+    try:
+        with open(path, "rb") as f:
+            data = zlib.decompress(f.read())
+        os.utime(path)
+        return data
+    except (OSError, zlib.error):
+        return None
+
+
+def blob_put(data: bytes) -> str:
+    """Store data under its git blob SHA and return the SHA."""
+    global _blob_store_bytes
+    sha = git_blob_sha(data)
+    path = _blob_path(sha)
+    if os.path.exists(path):
+        return sha
+    compressed = zlib.compress(data, 6)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(compressed)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[Blobs] Failed to store {sha}: {e}")
+        return sha
+    with _blob_lock:
+        if _blob_store_bytes is None:
+            _blob_store_bytes = sum(size for _, _, size in _list_blobs())
+        else:
+            _blob_store_bytes += len(compressed)
+        if _blob_store_bytes > BLOB_STORE_MAX_BYTES:
+            _evict_blobs()
+    return sha
+
+
+def _list_blobs() -> List[Tuple[float, str, int]]:
+    blobs = []
+    for root, _, names in os.walk(BLOB_STORE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            blobs.append((st.st_mtime, path, st.st_size))
+    return blobs
+
+
+def _evict_blobs():
+    """Drop least recently used blobs down to 90% of the cap. Caller holds _blob_lock."""
+    global _blob_store_bytes
+    blobs = sorted(_list_blobs())
+    total = sum(size for _, _, size in blobs)
+    target = BLOB_STORE_MAX_BYTES * 0.9
+    for _, path, size in blobs:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    _blob_store_bytes = total
+
+
+def _decode_text(data: bytes) -> Optional[str]:
+    text = data.decode("utf-8", errors="replace")
+    return None if "\x00" in text else text
+
+
+def fetch_file_content(owner: str, repo: str, branch: str, path: str,
+                       sha: Optional[str] = None) -> Optional[str]:
+    """File text from the blob store or a local checkout when possible, else raw.githubusercontent."""
+    if sha:
+        data = blob_get(sha)
+        if data is not None:
+            return _decode_text(data) if len(data) <= 500 * 1024 else None
+    local = get_local_repo(owner, repo)
+    if local:
+        data = local.read(sha or f"{branch}:{path}")
+        if data is None or len(data) > 500 * 1024:
+            return None
+        return _decode_text(data)
     try:
         r = http_requests.get(
             f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{path}", timeout=20
@@ -318,15 +1469,31 @@ def fetch_file_content(owner: str, repo: str, branch: str, path: str) -> Optiona
         if r.ok:
             if len(r.content) > 500 * 1024:
                 return None
-            text = r.text
-            if "\x00" in text:
-                return None
-            return text
+            blob_put(r.content)
+            return _decode_text(r.content)
     except Exception:
         return None
     return None
 
 
+def _chunk_text(m: Dict[str, Any]) -> str:
+    """Full chunk text rebuilt from the blob store; payloads only keep 1000 chars."""
+    text = m.get("text", "")
+    sha = m.get("blob_sha")
+    if sha and len(text) >= 1000:
+        data = blob_get(sha)
+        if data is None and m.get("owner"):
+            local = get_local_repo(m["owner"], m["repo"])
+            data = local.read(sha) if local else None
+        if data is not None:
+            lines = data.decode("utf-8", errors="replace").splitlines()
+            full = "\n".join(lines[int(m["start_line"]) - 1 : int(m["end_line"])])
+            # Guard against a blob that doesn't match what was indexed
+            if full.startswith(text):
+                return full
+    return text
+
+
 def chunk_code(
     content: str, min_chars: int = 900, max_chars: int = 1800, overlap_lines: int = 15
 ) -> List[Tuple[str, int, int]]:
@@ -353,118 +1520,579 @@ def chunk_code(
     return chunks
 
 
-# ─── Index check ───────────────────────────────────────────────────────────
+# ─── Index manifest ────────────────────────────────────────────────────────
+#
+# One record per repo_id in MANIFEST_COLLECTION: indexed commit, counts,
+# timestamps and completeness. Written by the indexer after every batch and
+# cached in process, so check_if_indexed and /index_status answer from a
+# single point lookup (usually none) instead of GitHub + two Qdrant scrolls.
 
-def check_if_indexed(owner: str, repo: str, branch: Optional[str] = None) -> bool:
-    """Returns True only when BOTH files and chunks exist — partial indexes trigger re-indexing."""
+_MANIFEST_FIELDS = (
+    "repo_id", "owner", "repo", "branch", "commit", "num_files", "num_chunks",
+    "files_total", "bytes", "complete", "stopped_reason", "started_at", "dedicated",
+)
+_manifest_cache: Dict[str, Tuple[float, Optional[Dict[str, Any]]]] = {}
+
+
+def _manifest_point_id(repo_id: str) -> str:
+    return make_point_id(repo_id, "__manifest__")
+
+
+def get_manifest(repo_id: str, deadline: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    hit = _manifest_cache.get(repo_id)
+    if hit and time.time() - hit[0] < MANIFEST_CACHE_TTL_S:
+        return hit[1]
+    ensure_collections(deadline)
+    client = get_qdrant_client()
+    records = client.retrieve(
+        collection_name=MANIFEST_COLLECTION, ids=[_manifest_point_id(repo_id)], with_payload=True,
+        timeout=_qdrant_timeout(deadline),
+    )
+    manifest = records[0].payload if records else None
+    _manifest_cache[repo_id] = (time.time(), manifest)
+    return manifest
+
+
+def _write_manifest(manifest: Dict[str, Any]):
     try:
-        branch = branch or get_default_branch(owner, repo)
-        repo_id = get_repo_id(owner, repo, branch)
         ensure_collections()
-        client = get_qdrant_client()
-        files, _ = client.scroll(
-            collection_name=FILES_COLLECTION,
-            scroll_filter=Filter(
-                must=[FieldCondition(key="repo_id", match=MatchValue(value=repo_id))]
-            ),
-            limit=1,
-        )
-        if not files:
-            return False
-        chunks, _ = client.scroll(
-            collection_name=CHUNKS_COLLECTION,
-            scroll_filter=Filter(
-                must=[FieldCondition(key="repo_id", match=MatchValue(value=repo_id))]
-            ),
-            limit=1,
+        get_qdrant_client().upsert(
+            collection_name=MANIFEST_COLLECTION,
+            points=[PointStruct(id=_manifest_point_id(manifest["repo_id"]), vector={}, payload=manifest)],
         )
-        return len(chunks) > 0
-    except Exception:
-        return False
-
+    except Exception as e:
+        print(f"[Manifest] Failed to write {manifest['repo_id']}: {e}")
+    _manifest_cache[manifest["repo_id"]] = (time.time(), manifest)
 
-# ─── Background indexing ───────────────────────────────────────────────────
 
-_indexing_jobs: Dict[str, Dict] = {}
+def _save_manifest(progress: Dict[str, Any]):
+    manifest = {k: progress.get(k) for k in _MANIFEST_FIELDS}
+    manifest["updated_at"] = time.time()
+    manifest["indexed_at"] = manifest["updated_at"] if progress["complete"] else None
+    manifest["last_accessed_at"] = _last_accessed(progress["repo_id"])
+    _write_manifest(manifest)
 
 
-def _do_build_embeddings(owner: str, repo: str, branch: str, repo_id: str):
-    """Runs in FastAPI's thread pool via BackgroundTasks."""
+def check_if_indexed(owner: str, repo: str, branch: Optional[str] = None) -> bool:
+    """True once the repo is searchable (it may still be backfilling — see the manifest's `complete`)."""
     try:
-        _indexing_jobs[repo_id].update({"status": "indexing", "message": "Listing repository files..."})
+        branch = branch or get_default_branch(owner, repo)
+        manifest = get_manifest(get_repo_id(owner, repo, branch))
+        return bool(manifest) and manifest.get("num_chunks") != 0
+    except Exception:
+        return False
 
-        files = list_repo_files(owner, repo, branch)
-        _indexing_jobs[repo_id]["message"] = f"Fetching {len(files)} files..."
 
-        # Single fetch pass — contents reused for both file- and chunk-level embeddings
-        file_contents: Dict[str, str] = {}
-        for path in files:
-            content = fetch_file_content(owner, repo, branch, path)
-            if content:
-                file_contents[path] = content
+def _index_is_current(manifest: Dict[str, Any]) -> bool:
+    """Whether the manifest's commit is still the branch HEAD (unknown commits count as current)."""
+    if not manifest.get("commit"):
+        return True
+    head = _resolve_commit(manifest["owner"], manifest["repo"], manifest["branch"], 10)
+    return head is None or head == manifest["commit"]
+
+
+# ─── Content-addressed points ──────────────────────────────────────────────
+#
+# File and chunk vectors are keyed by git blob SHA (plus line range), so a
+# file that is identical across branches and forks is fetched and embedded
+# once. Each point lists the repo_ids containing it in `repo_ids`, which is
+# what searches filter on; PATHS_COLLECTION maps (repo_id, file_path) to the
+# blob, which is how hits get back a path in the repo that was searched.
+# Membership is read-modify-written while holding the blobs involved, so
+# jobs touching different blobs never wait on each other's writes.
+
+_membership_cond = threading.Condition()
+_membership_held: set = set()
+
+
+@contextmanager
+def _membership_locked(blob_shas):
+    """Hold blob_shas for a membership read-modify-write, all at once (so no lock-order deadlocks)."""
+    shas = set(blob_shas)
+    with _membership_cond:
+        while shas & _membership_held:
+            _membership_cond.wait()
+        _membership_held.update(shas)
+    try:
+        yield
+    finally:
+        with _membership_cond:
+            _membership_held.difference_update(shas)
+            _membership_cond.notify_all()
 
-        if not file_contents:
-            raise ValueError("No readable files found in repository")
 
-        paths = list(file_contents.keys())
-        _indexing_jobs[repo_id]["message"] = f"Embedding {len(paths)} files via Jina AI..."
+def _repo_filter(repo_id: str) -> Filter:
+    return Filter(must=[FieldCondition(key="repo_ids", match=MatchValue(value=repo_id))])
 
-        # Batch-embed all file texts in one API call
-        file_texts = [content[:10000] for content in file_contents.values()]
-        file_embeddings = get_embeddings(file_texts)
 
-        ensure_collections()
-        client = get_qdrant_client()
+def _blobs_filter(blob_shas: List[str]) -> Filter:
+    return Filter(must=[FieldCondition(key="blob_sha", match=MatchAny(any=blob_shas))])
 
-        file_points = [
-            PointStruct(
-                id=make_point_id(repo_id, path),
-                vector=emb,
-                payload={
-                    "repo_id": repo_id, "owner": owner, "repo": repo,
-                    "branch": branch, "file_path": path, "type": "file",
-                },
-            )
-            for path, emb in zip(paths, file_embeddings)
-        ]
-        for i in range(0, len(file_points), 100):
-            client.upsert(collection_name=FILES_COLLECTION, points=file_points[i : i + 100])
 
-        # Collect all chunks across all files, then embed in one batch
-        _indexing_jobs[repo_id]["message"] = "Creating code chunks..."
-        all_chunks: List[Tuple[str, str, int, int]] = []  # (path, text, start, end)
-        for path, content in file_contents.items():
-            for chunk_text, start_line, end_line in chunk_code(content):
-                all_chunks.append((path, chunk_text, start_line, end_line))
+def _existing_blobs(client, repo_id: str, blob_shas: List[str],
+                    collections: Optional[Tuple[str, str]] = None) -> Dict[str, Dict[str, Any]]:
+    """File-point payloads for the blobs already embedded where repo_id's points live."""
+    if not blob_shas:
+        return {}
+    records = client.retrieve(
+        collection_name=(collections or _repo_collections(repo_id))[0], ids=[make_blob_point_id(sha) for sha in blob_shas],
+        with_payload=True,
+    )
+    return {r.payload["blob_sha"]: r.payload for r in records}
+
+
+def _set_membership(client, repo_id: str, groups: Dict[Tuple[str, ...], List[str]],
+                    collections: Optional[Tuple[str, str]] = None):
+    # Chunks first, as with upserts: a file is never a search hit before its chunks are.
+    for coll in reversed(collections or _repo_collections(repo_id)):
+        for repo_ids, blob_shas in groups.items():
+            for i in range(0, len(blob_shas), 256):
+                client.set_payload(
+                    collection_name=coll, payload={"repo_ids": list(repo_ids)},
+                    points=_blobs_filter(blob_shas[i:i + 256]), wait=True,
+                )
 
-        _indexing_jobs[repo_id]["message"] = f"Embedding {len(all_chunks)} code chunks via Jina AI..."
-        chunk_texts = [ct for _, ct, _, _ in all_chunks]
-        chunk_embeddings = get_embeddings(chunk_texts)
 
-        chunk_points = [
-            PointStruct(
-                id=make_point_id(repo_id, path, start, end),
-                vector=emb,
-                payload={
-                    "repo_id": repo_id, "owner": owner, "repo": repo,
-                    "branch": branch, "file_path": path,
-                    "start_line": start, "end_line": end,
-                    "text": chunk_text[:1000], "type": "chunk",
-                },
-            )
-            for (path, chunk_text, start, end), emb in zip(all_chunks, chunk_embeddings)
-        ]
-        for i in range(0, len(chunk_points), 200):
-            client.upsert(collection_name=CHUNKS_COLLECTION, points=chunk_points[i : i + 200])
+def _add_membership(client, repo_id: str, blob_shas: List[str]):
+    with _membership_locked(blob_shas):
+        groups: Dict[Tuple[str, ...], List[str]] = {}
+        for sha, payload in _existing_blobs(client, repo_id, blob_shas).items():
+            repo_ids = payload.get("repo_ids") or []
+            if repo_id not in repo_ids:
+                groups.setdefault(tuple(sorted(repo_ids + [repo_id])), []).append(sha)
+        _set_membership(client, repo_id, groups)
 
-        _indexing_jobs[repo_id].update({
-            "status": "done",
-            "num_files": len(file_contents),
-            "num_chunks": len(all_chunks),
-            "message": f"Indexed {len(file_contents)} files and {len(all_chunks)} chunks",
-            "finished_at": time.time(),
-        })
-        print(f"[Index] Done: {repo_id} — {len(file_contents)} files, {len(all_chunks)} chunks")
+
+def _member_blobs(client, repo_id: str, collections: Optional[Tuple[str, str]] = None) -> List[Dict[str, Any]]:
+    payloads: List[Dict[str, Any]] = []
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=(collections or _repo_collections(repo_id))[0], scroll_filter=_repo_filter(repo_id),
+            limit=256, offset=offset, with_payload=["repo_ids", "blob_sha"],
+        )
+        payloads.extend(r.payload for r in records)
+        if offset is None:
+            return payloads
+
+
+def _remove_membership(client, repo_id: str, blob_shas: Optional[List[str]] = None,
+                       collections: Optional[Tuple[str, str]] = None):
+    """Drop repo_id from the given blobs (default: all it uses), deleting points no other repo uses."""
+    collections = collections or _repo_collections(repo_id)
+    if blob_shas is None:
+        blob_shas = [p["blob_sha"] for p in _member_blobs(client, repo_id, collections)]
+    with _membership_locked(blob_shas):
+        payloads = list(_existing_blobs(client, repo_id, blob_shas, collections).values())
+        groups: Dict[Tuple[str, ...], List[str]] = {}
+        for p in payloads:
+            if repo_id in (p.get("repo_ids") or []):
+                rest = tuple(sorted(set(p["repo_ids"]) - {repo_id}))
+                groups.setdefault(rest, []).append(p["blob_sha"])
+        orphans = groups.pop((), [])
+        _set_membership(client, repo_id, groups, collections)
+        for coll in collections:
+            for i in range(0, len(orphans), 256):
+                client.delete(collection_name=coll,
+                              points_selector=FilterSelector(filter=_blobs_filter(orphans[i:i + 256])))
+
+
+def _write_paths(client, repo_id: str, paths: Dict[str, str]):
+    if paths:
+        client.upsert(
+            collection_name=PATHS_COLLECTION,
+            points=[
+                PointStruct(id=make_point_id(repo_id, path), vector={},
+                            payload={"repo_id": repo_id, "file_path": path, "blob_sha": sha})
+                for path, sha in paths.items()
+            ],
+        )
+
+
+def _prune_paths(client, repo_id: str, current: Dict[str, str]):
+    """After a re-index, forget paths and blobs of repo_id that are no longer at `current`."""
+    stale_ids = []
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=PATHS_COLLECTION,
+            scroll_filter=Filter(must=[FieldCondition(key="repo_id", match=MatchValue(value=repo_id))]),
+            limit=256, offset=offset, with_payload=True,
+        )
+        for r in records:
+            if current.get(r.payload["file_path"]) != r.payload["blob_sha"]:
+                stale_ids.append(r.id)
+        if offset is None:
+            break
+    if stale_ids:
+        client.delete(collection_name=PATHS_COLLECTION, points_selector=stale_ids)
+    # Paths re-pointed at a new blob leave no stale path record, so compare blobs directly.
+    live = set(current.values())
+    stale_blobs = {p["blob_sha"] for p in _member_blobs(client, repo_id)} - live
+    if stale_blobs:
+        _remove_membership(client, repo_id, list(stale_blobs))
+        print(f"[Index] {repo_id}: dropped {len(stale_ids)} stale paths, {len(stale_blobs)} stale blobs")
+    # Points written before content addressing carry `repo_id` and are never searched.
+    legacy = Filter(must=[FieldCondition(key="repo_id", match=MatchValue(value=repo_id))])
+    for coll in [CHUNKS_COLLECTION, FILES_COLLECTION]:
+        client.delete(collection_name=coll, points_selector=FilterSelector(filter=legacy))
+
+
+def _paths_for_blobs(client, repo_id: str, blob_shas: List[str],
+                     deadline: Optional[float] = None) -> Dict[str, str]:
+    """blob_sha -> file_path within repo_id (one of its paths, if a blob occurs more than once).
+
+    A blob can sit at dozens of paths (the same LICENSE in every package), so
+    one page may be used up by a few blobs; each further page asks only for
+    the blobs still unresolved.
+    """
+    wanted = set(blob_shas)
+    paths: Dict[str, str] = {}
+    while wanted:
+        records, _ = client.scroll(
+            collection_name=PATHS_COLLECTION,
+            scroll_filter=Filter(must=[
+                FieldCondition(key="repo_id", match=MatchValue(value=repo_id)),
+                FieldCondition(key="blob_sha", match=MatchAny(any=sorted(wanted))),
+            ]),
+            limit=len(wanted) * 4, with_payload=True, timeout=_qdrant_timeout(deadline),
+        )
+        if not records:
+            break
+        for r in sorted(records, key=lambda r: r.payload["file_path"]):
+            paths.setdefault(r.payload["blob_sha"], r.payload["file_path"])
+        wanted -= {r.payload["blob_sha"] for r in records}
+    return paths
+
+
+# ─── Background indexing ───────────────────────────────────────────────────
+#
+# Indexing is tiered: the top INDEX_FIRST_TIER_FILES prioritised files are
+# indexed by the job itself so the repo becomes searchable quickly, then the
+# rest of the repo is worked through by a single backfill thread, one batch
+# per repo in round-robin order so one huge monorepo never starves the rest.
+# Progress is persisted per batch in INDEX_STATE_DIR (`done` = processed
+# paths, `indexed` = paths whose vectors have landed), so an interrupted job
+# resumes where it stopped and /query can tell a partial index from a full one.
+
+_indexing_jobs: Dict[str, Dict] = {}
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def _default_budget(max_files: Optional[int] = None, max_bytes: Optional[int] = None,
+                    max_tokens: Optional[int] = None) -> Dict[str, int]:
+    """Per-request limits may lower the INDEX_MAX_* caps but never raise them."""
+    def cap(requested: Optional[int], limit: int) -> int:
+        return max(1, min(requested, limit)) if requested else limit
+
+    return {
+        "max_files": cap(max_files, INDEX_MAX_FILES),
+        "max_bytes": cap(max_bytes, INDEX_MAX_BYTES),
+        "max_tokens": cap(max_tokens, INDEX_MAX_TOKENS),
+    }
+
+
+def _progress_path(repo_id: str) -> str:
+    return os.path.join(INDEX_STATE_DIR, hashlib.sha1(repo_id.encode()).hexdigest() + ".json")
+
+
+def _load_progress(repo_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_progress_path(repo_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_progress(progress: Dict[str, Any]):
+    progress["updated_at"] = time.time()
+    os.makedirs(INDEX_STATE_DIR, exist_ok=True)
+    path = _progress_path(progress["repo_id"])
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(progress, f)
+    os.replace(tmp, path)
+
+
+def _new_progress(owner: str, repo: str, branch: str, repo_id: str,
+                  files: List[str], budget: Dict[str, int]) -> Dict[str, Any]:
+    return {
+        "repo_id": repo_id, "owner": owner, "repo": repo, "branch": branch,
+        "files_total": len(files), "pending": files, "done": [], "indexed": [],
+        "num_files": 0, "num_chunks": 0, "bytes": 0, "tokens": 0,
+        "budget": budget, "complete": False, "stopped_reason": None,
+        "started_at": time.time(),
+    }
+
+
+def _budget_exhausted(progress: Dict[str, Any]) -> Optional[str]:
+    budget = progress["budget"]
+    if progress["num_files"] >= budget["max_files"]:
+        return "max_files"
+    if progress["bytes"] >= budget["max_bytes"]:
+        return "max_bytes"
+    if progress["tokens"] >= budget["max_tokens"]:
+        return "max_tokens"
+    return None
+
+
+def _publish_progress(progress: Dict[str, Any]):
+    """Mirror persisted progress into the in-memory job served by /index_status."""
+    job = _indexing_jobs.setdefault(progress["repo_id"], {"status": "done"})
+    job.update({
+        "num_files": progress["num_files"],
+        "num_chunks": progress["num_chunks"],
+        "files_done": len(progress["done"]),
+        "files_indexed": len(progress["indexed"]),
+        "files_total": progress["files_total"],
+        "complete": progress["complete"],
+        "stopped_reason": progress["stopped_reason"],
+    })
+
+
+def _index_is_partial(repo_id: str, deadline: Optional[float] = None) -> bool:
+    """True while repo_id is still being indexed, i.e. search results may be incomplete."""
+    job = _indexing_jobs.get(repo_id, {})
+    if job.get("status") in ("queued", "indexing"):
+        return True
+    if "complete" in job:
+        return not job["complete"]
+    manifest = get_manifest(repo_id, deadline)
+    return bool(manifest) and not manifest.get("complete", True)
+
+
+def _index_batch(progress: Dict[str, Any], paths: List[str], repo_id: str):
+    """Fetch, embed and upsert one batch of files, then record it in progress.
+
+    Stops early (leaving the rest pending) when the byte or token budget
+    would be exceeded.
+    """
+    _yield_to_queries()
+    owner, repo, branch = progress["owner"], progress["repo"], progress["branch"]
+    budget = progress["budget"]
+    shas = progress.get("shas", {})
+    bytes_used, tokens_used = progress["bytes"], progress["tokens"]
+    ensure_collections()
+    client = get_qdrant_client()
+
+    # Blobs some other branch or fork already embedded only need membership.
+    if progress.get("dedicated"):
+        _dedicated_repos.add(repo_id)
+    files_coll, chunks_coll = _repo_collections(repo_id)
+    existing = _existing_blobs(client, repo_id, [shas[p] for p in paths if shas.get(p)])
+
+    # Single fetch pass — contents reused for both file- and chunk-level embeddings
+    indexed: Dict[str, str] = {}        # path -> blob_sha, everything this batch covers
+    new_blobs: Dict[str, str] = {}      # blob_sha -> content still to embed
+    all_chunks: List[Tuple[str, str, int, int]] = []  # (blob_sha, text, start, end)
+    num_chunks = 0
+    processed = 0
+    for path in paths:
+        sha = shas.get(path)
+        if sha in existing:
+            indexed[path] = sha
+            bytes_used += existing[sha].get("bytes", 0)
+            num_chunks += existing[sha].get("num_chunks", 0)
+            processed += 1
+            continue
+        content = new_blobs.get(sha) if sha else None
+        if content is None:
+            content = fetch_file_content(owner, repo, progress.get("commit") or branch, path, sha)
+        if content:
+            sha = sha or git_blob_sha(content.encode())
+            chunks = chunk_code(content)
+            if sha not in new_blobs:
+                tokens = _estimate_tokens(content[:10000]) + sum(_estimate_tokens(c[0]) for c in chunks)
+                if (bytes_used + len(content) > budget["max_bytes"]
+                        or tokens_used + tokens > budget["max_tokens"]):
+                    progress["stopped_reason"] = (
+                        "max_bytes" if bytes_used + len(content) > budget["max_bytes"] else "max_tokens"
+                    )
+                    break
+                tokens_used += tokens
+                new_blobs[sha] = content
+                for chunk_text, start_line, end_line in chunks:
+                    all_chunks.append((sha, chunk_text, start_line, end_line))
+            bytes_used += len(content)
+            num_chunks += len(chunks)
+            indexed[path] = sha
+        processed += 1
+
+    if new_blobs:
+        _indexing_jobs[repo_id]["message"] = f"Embedding {len(new_blobs)} files via Jina AI..."
+        blobs_fetched = list(new_blobs.keys())
+        file_texts = [content[:10000] for content in new_blobs.values()]
+        file_embeddings = get_embeddings(file_texts)
+
+        _indexing_jobs[repo_id]["message"] = f"Embedding {len(all_chunks)} code chunks via Jina AI..."
+        chunk_texts = [ct for _, ct, _, _ in all_chunks]
+        chunk_embeddings = get_embeddings(chunk_texts)
+
+        chunk_counts: Dict[str, int] = {}
+        for sha, _, _, _ in all_chunks:
+            chunk_counts[sha] = chunk_counts.get(sha, 0) + 1
+
+        # Chunks land before their file points: stage-1 file search can only
+        # surface a file once its chunks are queryable, so a partially built
+        # index is always consistent. The new blobs are held for the write,
+        # with repo_ids re-read just before it, so a concurrent job that wrote
+        # (or joined) the same blob meanwhile keeps its membership.
+        writer = VectorWriter(client)
+        with _membership_locked(blobs_fetched):
+            current = _existing_blobs(client, repo_id, blobs_fetched)
+            members = {sha: sorted(set(current.get(sha, {}).get("repo_ids") or []) | {repo_id})
+                       for sha in blobs_fetched}
+            writer.write(
+                chunks_coll,
+                [make_blob_point_id(sha, start, end) for sha, _, start, end in all_chunks],
+                chunk_embeddings,
+                [
+                    {
+                        "repo_ids": members[sha], "blob_sha": sha,
+                        "start_line": start, "end_line": end,
+                        "text": chunk_text[:1000], "type": "chunk",
+                    }
+                    for sha, chunk_text, start, end in all_chunks
+                ],
+            )
+            writer.flush(chunks_coll)
+
+            writer.write(
+                files_coll,
+                [make_blob_point_id(sha) for sha in blobs_fetched],
+                file_embeddings,
+                [
+                    {
+                        "repo_ids": members[sha], "blob_sha": sha, "type": "file",
+                        "bytes": len(new_blobs[sha]), "num_chunks": chunk_counts.get(sha, 0),
+                    }
+                    for sha in blobs_fetched
+                ],
+            )
+            writer.flush(files_coll)
+        _indexing_jobs[repo_id]["write_throughput"] = writer.stats()
+        print(f"[Write] {repo_id}: {writer.stats()}")
+
+    if indexed:
+        # Blobs reused from `existing` only need repo_id added to their repo_ids
+        _add_membership(client, repo_id, list(set(indexed.values())))
+        _write_paths(client, repo_id, indexed)
+        reused = sum(1 for sha in indexed.values() if sha in existing)
+        if reused:
+            print(f"[Index] {repo_id}: reused {reused} already-embedded files")
+
+    progress["done"].extend(paths[:processed])
+    progress["indexed"].extend(indexed.keys())
+    progress["pending"] = progress["pending"][processed:]
+    progress["num_files"] += len(indexed)
+    progress["num_chunks"] += num_chunks
+    progress["bytes"] = bytes_used
+    progress["tokens"] = tokens_used
+    reason = progress["stopped_reason"] or _budget_exhausted(progress)
+    if reason or not progress["pending"]:
+        progress["complete"] = True
+        progress["stopped_reason"] = reason
+        _prune_paths(client, repo_id, shas)
+    _save_progress(progress)
+    _save_manifest(progress)
+    _publish_progress(progress)
+
+
+# Index jobs run on their own pool, so queued ones wait in its work queue
+# rather than parking request-handling threads.
+_index_pool = ThreadPoolExecutor(max_workers=INDEX_CONCURRENCY, thread_name_prefix="index")
+_index_futures: Dict[str, Future] = {}
+_index_submit_lock = threading.Lock()
+
+
+def submit_index_job(owner: str, repo: str, branch: str, repo_id: str,
+                     budget: Optional[Dict[str, int]] = None,
+                     message: str = "Queued for indexing...") -> Optional[Future]:
+    """Queue _do_build_embeddings on the index pool.
+
+    Returns the job's future (the existing one if repo_id is already queued or
+    indexing), or None when INDEX_CONCURRENCY + INDEX_QUEUE jobs are pending.
+    """
+    with _index_submit_lock:
+        for done in [rid for rid, f in _index_futures.items() if f.done()]:
+            del _index_futures[done]
+        future = _index_futures.get(repo_id)
+        if future is not None:
+            return future
+        if len(_index_futures) >= INDEX_CONCURRENCY + INDEX_QUEUE:
+            return None
+        _indexing_jobs[repo_id] = {"status": "queued", "message": message, "started_at": time.time()}
+        # Executor threads do not inherit contextvars; carry the caller's so an
+        # X-Profile request still profiles the index job it started.
+        future = _index_pool.submit(copy_context().run, _do_build_embeddings, owner, repo, branch, repo_id, budget)
+        _index_futures[repo_id] = future
+        return future
+
+
+@profiled("build_embeddings_task")
+def _do_build_embeddings(owner: str, repo: str, branch: str, repo_id: str,
+                         budget: Optional[Dict[str, int]] = None):
+    """Runs on the index pool via submit_index_job.
+
+    Indexes the first tier synchronously, then hands the rest to the backfill thread.
+    """
+    try:
+        _indexing_jobs[repo_id].update({"status": "indexing", "message": "Listing repository files..."})
+
+        progress = _load_progress(repo_id)
+        if progress is None or progress.get("branch") != branch or progress.get("complete"):
+            # Pin the job to one commit so the listing, file contents and the
+            # manifest all describe the same snapshot.
+            commit = _resolve_commit(owner, repo, branch, 15)
+            blobs = list_repo_blobs(owner, repo, commit or branch)
+            progress = _new_progress(owner, repo, branch, repo_id, list(blobs), budget or _default_budget())
+            progress["shas"] = blobs
+            progress["commit"] = commit
+            # A repo keeps the layout it was first indexed with; /admin/layout/migrate moves it.
+            manifest = get_manifest(repo_id)
+            if manifest:
+                progress["dedicated"] = bool(manifest.get("dedicated"))
+            else:
+                progress["dedicated"] = 0 < DEDICATED_MIN_FILES <= len(blobs)
+            if progress["dedicated"]:
+                _ensure_dedicated(repo_id)
+            _save_progress(progress)
+        else:
+            _indexing_jobs[repo_id]["message"] = (
+                f"Resuming — {len(progress['done'])} of {progress['files_total']} files already processed..."
+            )
+
+        # The first tier lands in small batches, each searchable as soon as it is upserted.
+        while not progress["complete"] and len(progress["done"]) < INDEX_FIRST_TIER_FILES:
+            size = min(INDEX_EARLY_BATCH_FILES,
+                       INDEX_FIRST_TIER_FILES - len(progress["done"]),
+                       progress["budget"]["max_files"] - progress["num_files"])
+            _indexing_jobs[repo_id]["message"] = (
+                f"Fetching files {len(progress['done']) + 1}-{len(progress['done']) + size} "
+                f"of {progress['files_total']}..."
+            )
+            _index_batch(progress, progress["pending"][:max(0, size)], repo_id)
+
+        if not progress["num_files"] and progress["complete"]:
+            raise ValueError("No readable files found in repository")
+
+        if not progress["complete"]:
+            _schedule_backfill(repo_id)
+
+        _indexing_jobs[repo_id].update({
+            "status": "done",
+            "message": (
+                f"Indexed {progress['num_files']} files and {progress['num_chunks']} chunks"
+                + ("" if progress["complete"] else
+                   f"; indexing remaining {len(progress['pending'])} files in the background")
+            ),
+            "finished_at": time.time(),
+        })
+        _publish_progress(progress)
+        print(f"[Index] First tier done: {repo_id} — {progress['num_files']} files, {progress['num_chunks']} chunks")
 
     except Exception as e:
         print(f"[Index] Error for {repo_id}: {e}")
@@ -472,23 +2100,1063 @@ def _do_build_embeddings(owner: str, repo: str, branch: str, repo_id: str):
         _indexing_jobs[repo_id].update({"status": "error", "message": str(e)})
 
 
+_backfill_queue: "queue.Queue[str]" = queue.Queue()
+_backfill_scheduled: set = set()
+_backfill_lock = threading.Lock()
+_backfill_thread: Optional[threading.Thread] = None
+
+
+def _schedule_backfill(repo_id: str):
+    global _backfill_thread
+    with _backfill_lock:
+        if repo_id in _backfill_scheduled:
+            return
+        _backfill_scheduled.add(repo_id)
+        _backfill_queue.put(repo_id)
+        if _backfill_thread is None or not _backfill_thread.is_alive():
+            _backfill_thread = threading.Thread(target=_backfill_worker, name="index-backfill", daemon=True)
+            _backfill_thread.start()
+
+
+def _backfill_worker():
+    while True:
+        repo_id = _backfill_queue.get()
+        more = False
+        try:
+            more = _run_backfill_batch(repo_id)
+        except Exception as e:
+            # Progress up to the last finished batch is persisted; the next
+            # /build_embeddings call for this repo picks it up again.
+            print(f"[Index] Backfill error for {repo_id}: {e}")
+            traceback.print_exc()
+            _indexing_jobs.setdefault(repo_id, {"status": "done"}).update({
+                "message": f"Background indexing paused: {e}", "backfill_error": str(e),
+            })
+        with _backfill_lock:
+            if more:
+                _backfill_queue.put(repo_id)
+            else:
+                _backfill_scheduled.discard(repo_id)
+
+
+def _run_backfill_batch(repo_id: str) -> bool:
+    """Index the next batch for repo_id. Returns True while work remains."""
+    progress = _load_progress(repo_id)
+    if not progress or progress["complete"]:
+        return False
+    _indexing_jobs.setdefault(repo_id, {"status": "done", "message": "Indexed"})
+    batch = progress["pending"][:INDEX_BATCH_FILES]
+    batch = batch[: max(0, progress["budget"]["max_files"] - progress["num_files"])]
+    _index_batch(progress, batch, repo_id)
+    if progress["complete"]:
+        _indexing_jobs[repo_id]["message"] = (
+            f"Indexed {progress['num_files']} files and {progress['num_chunks']} chunks"
+        )
+        print(f"[Index] Backfill done: {repo_id} — {progress['num_files']} files, "
+              f"{progress['num_chunks']} chunks ({progress['stopped_reason'] or 'complete'})")
+    return not progress["complete"]
+
+
+@app.on_event("startup")
+def _resume_backfills():
+    """Pick up repos whose background indexing was interrupted by a restart."""
+    try:
+        names = os.listdir(INDEX_STATE_DIR)
+    except OSError:
+        return
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(INDEX_STATE_DIR, name)) as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not progress.get("complete") and progress.get("done"):
+            _publish_progress(progress)
+            _schedule_backfill(progress["repo_id"])
+
+
+# ─── Index lifecycle ───────────────────────────────────────────────────────
+#
+# Every query touches its repo_id's manifest (`last_accessed_at`, flushed at
+# most once per INDEX_ACCESS_FLUSH_S). A collector thread drops indexes not
+# used within INDEX_TTL_S, then — if INDEX_STORAGE_BUDGET_BYTES is set —
+# least-recently-used ones until the estimated footprint fits the budget.
+# Repos that are still indexing are never collected. Deleting a repo only
+# drops its membership; points shared with other repos stay (and the
+# estimate counts a shared point toward every repo using it).
+
+# Chunk payloads carry at most 1000 chars of text plus a few metadata fields.
+_POINT_PAYLOAD_BYTES = 1200
+
+_last_access: Dict[str, float] = {}
+_access_flushed: Dict[str, float] = {}
+_gc_lock = threading.Lock()
+_gc_thread: Optional[threading.Thread] = None
+
+
+def _last_accessed(repo_id: str) -> Optional[float]:
+    if repo_id in _last_access:
+        return _last_access[repo_id]
+    hit = _manifest_cache.get(repo_id)
+    return hit[1].get("last_accessed_at") if hit and hit[1] else None
+
+
+def touch_index(repo_id: str):
+    """Record a read of repo_id's index.
+
+    The in-process timestamp is updated at once; the manifest write behind it
+    runs on its own thread so it never counts against a query's deadline.
+    """
+    now = time.time()
+    _last_access[repo_id] = now
+    if now - _access_flushed.get(repo_id, 0) < INDEX_ACCESS_FLUSH_S:
+        return
+    _access_flushed[repo_id] = now
+    threading.Thread(target=_flush_access, args=(repo_id, now), name="index-access", daemon=True).start()
+
+
+def _flush_access(repo_id: str, now: float):
+    try:
+        if get_manifest(repo_id) is None:
+            return
+        get_qdrant_client().set_payload(
+            collection_name=MANIFEST_COLLECTION,
+            payload={"last_accessed_at": now},
+            points=[_manifest_point_id(repo_id)],
+        )
+        hit = _manifest_cache.get(repo_id)
+        if hit and hit[1]:
+            hit[1]["last_accessed_at"] = now
+    except Exception as e:
+        print(f"[GC] Failed to record access for {repo_id}: {e}")
+
+
+def _all_manifests() -> List[Dict[str, Any]]:
+    ensure_collections()
+    client = get_qdrant_client()
+    manifests: List[Dict[str, Any]] = []
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=MANIFEST_COLLECTION, limit=256, offset=offset, with_payload=True
+        )
+        manifests.extend(r.payload for r in records)
+        if offset is None:
+            return manifests
+
+
+def _index_usage(manifest: Dict[str, Any]) -> Dict[str, Any]:
+    repo_id = manifest["repo_id"]
+    num_files, num_chunks = manifest.get("num_files") or 0, manifest.get("num_chunks") or 0
+    points = num_files + num_chunks
+    last_used = max(_last_accessed(repo_id) or manifest.get("last_accessed_at") or 0,
+                    manifest.get("updated_at") or 0)
+    return {
+        "repo_id": repo_id,
+        "num_files": num_files,
+        "num_chunks": num_chunks,
+        "est_bytes": points * (EMBEDDING_DIM * 4 + _POINT_PAYLOAD_BYTES),
+        "last_used_at": last_used or None,
+        "complete": manifest.get("complete", True),
+    }
+
+
+def _index_busy(repo_id: str) -> bool:
+    return (_indexing_jobs.get(repo_id, {}).get("status") in ("queued", "indexing")
+            or repo_id in _backfill_scheduled)
+
+
+def delete_index(repo_id: str):
+    """Remove repo_id's membership and paths (and points only it used), its manifest and progress."""
+    client = get_qdrant_client()
+    if _repo_collections(repo_id)[0] != FILES_COLLECTION:
+        for coll in _dedicated_collections(repo_id):
+            client.delete_collection(coll)
+        _dedicated_repos.discard(repo_id)
+        client.delete(
+            collection_name=PATHS_COLLECTION,
+            points_selector=FilterSelector(filter=Filter(
+                must=[FieldCondition(key="repo_id", match=MatchValue(value=repo_id))]
+            )),
+        )
+    else:
+        _remove_membership(client, repo_id)
+        _prune_paths(client, repo_id, {})
+    client.delete(collection_name=MANIFEST_COLLECTION, points_selector=[_manifest_point_id(repo_id)])
+    try:
+        os.remove(_progress_path(repo_id))
+    except OSError:
+        pass
+    for d in (_manifest_cache, _last_access, _access_flushed, _indexing_jobs):
+        d.pop(repo_id, None)
+
+
+def collect_indexes(dry_run: bool = False) -> Dict[str, Any]:
+    """Drop expired indexes, then LRU ones until under budget. Returns what was (or would be) deleted."""
+    with _gc_lock:
+        usage = sorted((_index_usage(m) for m in _all_manifests()), key=lambda u: u["last_used_at"] or 0)
+        now = time.time()
+        total = sum(u["est_bytes"] for u in usage)
+        deleted: List[Dict[str, Any]] = []
+        for u in usage:
+            if _index_busy(u["repo_id"]):
+                continue
+            expired = INDEX_TTL_S > 0 and now - (u["last_used_at"] or 0) > INDEX_TTL_S
+            over_budget = 0 < INDEX_STORAGE_BUDGET_BYTES < total
+            if not (expired or over_budget):
+                continue
+            if not dry_run:
+                try:
+                    delete_index(u["repo_id"])
+                except Exception as e:
+                    print(f"[GC] Failed to delete {u['repo_id']}: {e}")
+                    continue
+            total -= u["est_bytes"]
+            deleted.append({**u, "reason": "ttl" if expired else "budget"})
+        if deleted:
+            print(f"[GC] {'Would delete' if dry_run else 'Deleted'} {len(deleted)} indexes: "
+                  + ", ".join(d["repo_id"] for d in deleted))
+        return {"deleted": deleted, "est_bytes_after": total, "dry_run": dry_run}
+
+
+def _gc_worker():
+    while True:
+        time.sleep(INDEX_GC_INTERVAL_S)
+        try:
+            collect_indexes()
+        except Exception as e:
+            print(f"[GC] Collection failed: {e}")
+
+
+@app.on_event("startup")
+def _start_index_gc():
+    global _gc_thread
+    if INDEX_GC_INTERVAL_S > 0 and (_gc_thread is None or not _gc_thread.is_alive()):
+        _gc_thread = threading.Thread(target=_gc_worker, name="index-gc", daemon=True)
+        _gc_thread.start()
+
+
+@app.get("/admin/storage")
+def index_storage(request: Request):
+    _require_admin(request)
+    usage = sorted((_index_usage(m) for m in _all_manifests()),
+                   key=lambda u: u["last_used_at"] or 0, reverse=True)
+    return {
+        "repos": usage,
+        "total_est_bytes": sum(u["est_bytes"] for u in usage),
+        "budget_bytes": INDEX_STORAGE_BUDGET_BYTES or None,
+        "ttl_s": INDEX_TTL_S or None,
+    }
+
+
+@app.post("/admin/gc")
+def run_index_gc(request: Request, dry_run: bool = False):
+    _require_admin(request)
+    return collect_indexes(dry_run)
+
+
+@app.get("/admin/admission")
+def admission_stats(request: Request):
+    _require_admin(request)
+    jobs = [job.get("status") for job in list(_indexing_jobs.values())]
+    return {
+        **{name: c.stats() for name, c in _admission.items()},
+        "index": {"limit": INDEX_CONCURRENCY, "queue_size": INDEX_QUEUE,
+                  "indexing": jobs.count("indexing"), "queued": jobs.count("queued")},
+    }
+
+
+@app.get("/admin/llm")
+def llm_stats(request: Request):
+    _require_admin(request)
+    return {
+        "in_flight": _llm_in_flight, "limit": LLM_CONCURRENCY,
+        "routes": {model: route.stats() for model, route in _llm_routes.items()},
+        "decisions": dict(_llm_decisions),
+    }
+
+
+# ─── Collection layout tooling ─────────────────────────────────────────────
+
+def _copy_to_dedicated(client, repo_id: str) -> Dict[str, int]:
+    """Copy repo_id's points from the shared collections into its own pair."""
+    _ensure_dedicated(repo_id)
+    files_dst, chunks_dst = _dedicated_collections(repo_id)
+    copied: Dict[str, int] = {}
+    writer = VectorWriter(client)
+    for src, dst in [(CHUNKS_COLLECTION, chunks_dst), (FILES_COLLECTION, files_dst)]:
+        copied[dst] = 0
+        offset = None
+        while True:
+            records, offset = client.scroll(
+                collection_name=src, scroll_filter=_repo_filter(repo_id),
+                limit=256, offset=offset, with_payload=True, with_vectors=True,
+            )
+            if records:
+                writer.write(
+                    dst, [r.id for r in records],
+                    np.array([r.vector for r in records], dtype=np.float32),
+                    [{**r.payload, "repo_ids": [repo_id]} for r in records],
+                )
+                copied[dst] += len(records)
+            if offset is None:
+                break
+        writer.flush(dst)
+    return copied
+
+
+def migrate_layout(dry_run: bool = False) -> Dict[str, Any]:
+    """Bring existing collections and repos in line with COLLECTION_LAYOUT and DEDICATED_MIN_FILES."""
+    ensure_collections()
+    client = get_qdrant_client()
+    actions: List[Dict[str, Any]] = []
+    # Repo-scoped points from before content addressing carry `repo_id`. They
+    # are never searched, and repos without a manifest never reach the GC,
+    # so sweep them all here.
+    legacy = Filter(must_not=[IsEmptyCondition(is_empty=PayloadField(key="repo_id"))])
+    for coll in [CHUNKS_COLLECTION, FILES_COLLECTION]:
+        count = client.count(collection_name=coll, count_filter=legacy, exact=True).count
+        if count:
+            actions.append({"collection": coll, "action": "delete_legacy_points", "points": count})
+            if not dry_run:
+                client.delete(collection_name=coll, points_selector=FilterSelector(filter=legacy))
+
+    tenant = COLLECTION_LAYOUT == "tenant"
+    for coll in [FILES_COLLECTION, CHUNKS_COLLECTION]:
+        actions.append({"collection": coll, "action": "tenant_hnsw" if tenant else "global_hnsw"})
+        if not dry_run:
+            client.update_collection(
+                collection_name=coll,
+                hnsw_config=HnswConfigDiff(m=0, payload_m=16) if tenant else HnswConfigDiff(m=16, payload_m=0),
+            )
+            # Re-creating the index with new params replaces it
+            client.create_payload_index(
+                collection_name=coll, field_name="repo_ids",
+                field_schema=KeywordIndexParams(type="keyword", is_tenant=True) if tenant else PayloadSchemaType.KEYWORD,
+            )
+
+    if DEDICATED_MIN_FILES > 0:
+        for manifest in _all_manifests():
+            repo_id = manifest["repo_id"]
+            if manifest.get("dedicated") or (manifest.get("num_files") or 0) < DEDICATED_MIN_FILES:
+                continue
+            if _index_busy(repo_id):
+                actions.append({"repo_id": repo_id, "action": "skipped_busy"})
+                continue
+            action: Dict[str, Any] = {"repo_id": repo_id, "action": "dedicated",
+                                      "num_files": manifest["num_files"]}
+            if not dry_run:
+                action["copied"] = _copy_to_dedicated(client, repo_id)
+                # Flip routing once the copy is searchable, then leave the shared collections.
+                manifest["dedicated"] = True
+                _write_manifest(manifest)
+                _dedicated_repos.add(repo_id)
+                _remove_membership(client, repo_id, collections=(FILES_COLLECTION, CHUNKS_COLLECTION))
+                progress = _load_progress(repo_id)
+                if progress:
+                    progress["dedicated"] = True
+                    _save_progress(progress)
+            actions.append(action)
+    print(f"[Layout] {'Planned' if dry_run else 'Applied'} {len(actions)} layout actions")
+    return {"layout": COLLECTION_LAYOUT, "dedicated_min_files": DEDICATED_MIN_FILES,
+            "dry_run": dry_run, "actions": actions}
+
+
+_TENANT_BUCKETS = [("small", 0, 100), ("medium", 100, 1000), ("large", 1000, None)]
+
+
+def benchmark_layout(queries: int = 5, repos_per_bucket: int = 5) -> Dict[str, Any]:
+    """Time the two-stage search (no embedding or LLM) for repos bucketed by file count."""
+    ensure_collections()
+    client = get_qdrant_client()
+    rng = np.random.default_rng(0)
+    manifests = [m for m in _all_manifests() if m.get("num_files")]
+    buckets: List[Dict[str, Any]] = []
+    for name, low, high in _TENANT_BUCKETS:
+        members = [m for m in manifests if m["num_files"] >= low and (high is None or m["num_files"] < high)]
+        members = sorted(members, key=lambda m: m["num_files"], reverse=True)[:repos_per_bucket]
+        timings: List[float] = []
+        repos: List[Dict[str, Any]] = []
+        for m in members:
+            repo_timings = []
+            for _ in range(queries):
+                vec = rng.standard_normal(EMBEDDING_DIM).astype(np.float32)
+                started = time.perf_counter()
+                _search_repo(client, m["owner"], m["repo"], m["branch"], vec / np.linalg.norm(vec), 5, 8)
+                repo_timings.append((time.perf_counter() - started) * 1000)
+            timings.extend(repo_timings)
+            repos.append({"repo_id": m["repo_id"], "num_files": m["num_files"],
+                          "dedicated": bool(m.get("dedicated")),
+                          "p50_ms": round(float(np.percentile(repo_timings, 50)), 1)})
+        bucket: Dict[str, Any] = {"bucket": name, "min_files": low, "max_files": high, "repos": repos}
+        if timings:
+            bucket.update({
+                "queries": len(timings),
+                "p50_ms": round(float(np.percentile(timings, 50)), 1),
+                "p95_ms": round(float(np.percentile(timings, 95)), 1),
+                "max_ms": round(max(timings), 1),
+            })
+        buckets.append(bucket)
+    return {"layout": COLLECTION_LAYOUT, "buckets": buckets}
+
+
+@app.post("/admin/layout/migrate")
+def run_layout_migration(request: Request, dry_run: bool = False):
+    _require_admin(request)
+    return migrate_layout(dry_run)
+
+
+@app.get("/admin/layout/benchmark")
+def run_layout_benchmark(request: Request, queries: int = 5, repos_per_bucket: int = 5):
+    _require_admin(request)
+    return benchmark_layout(queries, repos_per_bucket)
+
+
+# ─── Index snapshots ───────────────────────────────────────────────────────
+#
+# A snapshot is one repo_id's index in a single memory-mappable file:
+#
+#   b"XSNAP1\n\0" | uint64 header length | JSON header | arrays, 64-byte aligned
+#
+# The header holds the manifest and, per array, its offset/dtype/shape.
+# Vectors are float32 or int8 (symmetric, one float32 scale per row);
+# payloads are stored column-wise — blob SHAs as a 20-byte table referenced
+# by index, strings as uint64 offsets into a UTF-8 byte array. Point ids are
+# not stored: they are derived from blob SHA and line range on import.
+
+_SNAPSHOT_MAGIC = b"XSNAP1\n\0"
+_SNAPSHOT_ALIGN = 64
+_SNAPSHOT_IMPORT_ROWS = 2048
+
+
+class SnapshotWriter:
+    def __init__(self):
+        self.arrays: Dict[str, np.ndarray] = {}
+
+    def add(self, name: str, array: np.ndarray):
+        self.arrays[name] = np.ascontiguousarray(array)
+
+    def add_strings(self, name: str, values: List[str]):
+        encoded = [v.encode("utf-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded], dtype=np.uint64)
+        self.add(f"{name}.offsets", offsets)
+        self.add(f"{name}.data", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def add_vectors(self, name: str, vectors: np.ndarray, quantize: Optional[str]):
+        if quantize == "int8":
+            scale = np.abs(vectors).max(axis=1).astype(np.float32) / 127.0
+            scale[scale == 0] = 1.0
+            self.add(f"{name}.scale", scale)
+            self.add(name, np.round(vectors / scale[:, None]).astype(np.int8))
+        else:
+            self.add(name, vectors.astype(np.float32))
+
+    def write(self, path: str, meta: Dict[str, Any]):
+        layout, offset = {}, 0
+        for name, array in self.arrays.items():
+            layout[name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+            offset += -(-array.nbytes // _SNAPSHOT_ALIGN) * _SNAPSHOT_ALIGN
+        header = json.dumps({**meta, "arrays": layout}).encode()
+        # Array offsets are relative to the first aligned byte after the header
+        start = -(-(len(_SNAPSHOT_MAGIC) + 8 + len(header)) // _SNAPSHOT_ALIGN) * _SNAPSHOT_ALIGN
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_SNAPSHOT_MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for name, array in self.arrays.items():
+                f.seek(start + layout[name]["offset"])
+                f.write(array.tobytes())
+            f.truncate(start + offset)
+        os.replace(tmp, path)
+
+
+class SnapshotReader:
+    def __init__(self, path: str):
+        # The mapping keeps its own handle, so the file can be closed right away
+        with open(path, "rb") as f:
+            try:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise HTTPException(400, "Empty snapshot file")
+        if self._mm[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+            self.close()
+            raise HTTPException(400, "Not an index snapshot")
+        size = int.from_bytes(self._mm[8:16], "little")
+        self.meta = json.loads(self._mm[16:16 + size])
+        self._start = -(-(16 + size) // _SNAPSHOT_ALIGN) * _SNAPSHOT_ALIGN
+
+    def array(self, name: str) -> np.ndarray:
+        spec = self.meta["arrays"][name]
+        return np.ndarray(tuple(spec["shape"]), dtype=np.dtype(spec["dtype"]),
+                          buffer=self._mm, offset=self._start + spec["offset"])
+
+    def strings(self, name: str) -> List[str]:
+        offsets, data = self.array(f"{name}.offsets"), self.array(f"{name}.data")
+        raw = data.tobytes()
+        return [raw[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+    def vectors(self, name: str, rows: List[int]) -> np.ndarray:
+        """float32 rows of a vector matrix, dequantized if needed."""
+        data = self.array(name)[rows]
+        if f"{name}.scale" in self.meta["arrays"]:
+            return data.astype(np.float32) * self.array(f"{name}.scale")[rows][:, None]
+        return data.astype(np.float32, copy=False)
+
+    def close(self):
+        self._mm.close()
+
+
+def _snapshot_name(repo_id: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "__", repo_id) + ".xsnap"
+
+
+def _scroll_points(client, collection: str, scroll_filter: Filter, with_vectors: bool = False):
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=collection, scroll_filter=scroll_filter, limit=512,
+            offset=offset, with_payload=True, with_vectors=with_vectors,
+        )
+        yield from records
+        if offset is None:
+            return
+
+
+def export_snapshot(repo_id: str, quantize: Optional[str] = None) -> str:
+    """Write repo_id's index to SNAPSHOT_DIR and return the file path."""
+    if quantize not in (None, "int8"):
+        raise HTTPException(400, "quantize must be omitted or 'int8'")
+    manifest = get_manifest(repo_id)
+    if not manifest:
+        raise HTTPException(404, f"{repo_id} is not indexed")
+    client = get_qdrant_client()
+    files_coll, chunks_coll = _repo_collections(repo_id)
+
+    paths = {r.payload["file_path"]: r.payload["blob_sha"] for r in _scroll_points(
+        client, PATHS_COLLECTION,
+        Filter(must=[FieldCondition(key="repo_id", match=MatchValue(value=repo_id))]),
+    )}
+    files = list(_scroll_points(client, files_coll, _repo_filter(repo_id), with_vectors=True))
+    chunks = list(_scroll_points(client, chunks_coll, _repo_filter(repo_id), with_vectors=True))
+    # Chunks land before their file point, so an interrupted batch can leave
+    # chunks of a blob with no file; import only restores blobs with files.
+    file_shas = {f.payload["blob_sha"] for f in files}
+    orphaned = len(chunks)
+    chunks = [c for c in chunks if c.payload["blob_sha"] in file_shas]
+    orphaned -= len(chunks)
+    if orphaned:
+        print(f"[Snapshot] {repo_id}: skipping {orphaned} chunks whose file point never landed")
+
+    blob_index: Dict[str, int] = {}
+    for sha in [f.payload["blob_sha"] for f in files] + list(paths.values()):
+        blob_index.setdefault(sha, len(blob_index))
+
+    w = SnapshotWriter()
+    w.add("blobs", np.frombuffer(b"".join(bytes.fromhex(sha) for sha in blob_index), dtype=np.uint8)
+          .reshape(len(blob_index), 20))
+    w.add("paths.blob", np.array([blob_index[sha] for sha in paths.values()], dtype=np.uint32))
+    w.add_strings("paths.name", list(paths))
+    w.add("files.blob", np.array([blob_index[f.payload["blob_sha"]] for f in files], dtype=np.uint32))
+    w.add("files.bytes", np.array([f.payload.get("bytes", 0) for f in files], dtype=np.uint64))
+    w.add("files.num_chunks", np.array([f.payload.get("num_chunks", 0) for f in files], dtype=np.uint32))
+    w.add_vectors("files.vectors", np.array([f.vector for f in files], dtype=np.float32)
+                  .reshape(len(files), EMBEDDING_DIM), quantize)
+    w.add("chunks.blob", np.array([blob_index[c.payload["blob_sha"]] for c in chunks], dtype=np.uint32))
+    w.add("chunks.start", np.array([c.payload["start_line"] for c in chunks], dtype=np.uint32))
+    w.add("chunks.end", np.array([c.payload["end_line"] for c in chunks], dtype=np.uint32))
+    w.add_strings("chunks.text", [c.payload.get("text", "") for c in chunks])
+    w.add_vectors("chunks.vectors", np.array([c.vector for c in chunks], dtype=np.float32)
+                  .reshape(len(chunks), EMBEDDING_DIM), quantize)
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(SNAPSHOT_DIR, _snapshot_name(repo_id))
+    w.write(path, {
+        "version": 1, "repo_id": repo_id, "embedding_model": EMBEDDING_MODEL, "dim": EMBEDDING_DIM,
+        "quantize": quantize, "created_at": time.time(),
+        "manifest": {k: manifest.get(k) for k in _MANIFEST_FIELDS},
+    })
+    print(f"[Snapshot] Exported {repo_id}: {len(files)} files, {len(chunks)} chunks, "
+          f"{os.path.getsize(path) / 1e6:.1f} MB")
+    return path
+
+
+def import_snapshot(path: str) -> Dict[str, Any]:
+    """Bulk-load a snapshot; blobs already embedded here are only linked, not rewritten."""
+    started = time.time()
+    snap = SnapshotReader(path)
+    try:
+        meta = snap.meta
+        if meta.get("embedding_model") != EMBEDDING_MODEL or meta.get("dim") != EMBEDDING_DIM:
+            raise HTTPException(400, f"Snapshot was built with {meta.get('embedding_model')}, "
+                                     f"this instance uses {EMBEDDING_MODEL}")
+        repo_id = meta["repo_id"]
+        if _index_busy(repo_id):
+            raise HTTPException(409, f"{repo_id} is being indexed")
+        ensure_collections()
+        client = get_qdrant_client()
+        manifest = dict(meta["manifest"])
+        # Like a re-index, keep the layout of an existing index; otherwise pick by size
+        current = get_manifest(repo_id)
+        if current:
+            manifest["dedicated"] = bool(current.get("dedicated"))
+        else:
+            manifest["dedicated"] = 0 < DEDICATED_MIN_FILES <= (manifest.get("num_files") or 0)
+        if manifest["dedicated"]:
+            _ensure_dedicated(repo_id)
+            _dedicated_repos.add(repo_id)
+            files_coll, chunks_coll = _dedicated_collections(repo_id)
+        else:
+            files_coll, chunks_coll = FILES_COLLECTION, CHUNKS_COLLECTION
+
+        blobs = [row.tobytes().hex() for row in snap.array("blobs")]
+        file_blob = snap.array("files.blob")
+        existing = _existing_blobs(client, repo_id, [blobs[i] for i in file_blob], (files_coll, chunks_coll))
+        new_files = [i for i, b in enumerate(file_blob) if blobs[b] not in existing]
+        new_blobs = {file_blob[i] for i in new_files}
+
+        # Chunks first, then files — same consistency rule as indexing
+        writer = VectorWriter(client)
+        chunk_blob, chunk_start, chunk_end = snap.array("chunks.blob"), snap.array("chunks.start"), snap.array("chunks.end")
+        chunk_rows = [i for i, b in enumerate(chunk_blob) if b in new_blobs]
+        texts = snap.strings("chunks.text")
+        for at in range(0, len(chunk_rows), _SNAPSHOT_IMPORT_ROWS):
+            rows = chunk_rows[at:at + _SNAPSHOT_IMPORT_ROWS]
+            writer.write(
+                chunks_coll,
+                [make_blob_point_id(blobs[chunk_blob[i]], int(chunk_start[i]), int(chunk_end[i])) for i in rows],
+                snap.vectors("chunks.vectors", rows),
+                [{"repo_ids": [repo_id], "blob_sha": blobs[chunk_blob[i]], "start_line": int(chunk_start[i]),
+                  "end_line": int(chunk_end[i]), "text": texts[i], "type": "chunk"} for i in rows],
+            )
+        writer.flush(chunks_coll)
+        file_bytes, file_chunks = snap.array("files.bytes"), snap.array("files.num_chunks")
+        if new_files:
+            writer.write(
+                files_coll,
+                [make_blob_point_id(blobs[file_blob[i]]) for i in new_files],
+                snap.vectors("files.vectors", new_files),
+                [{"repo_ids": [repo_id], "blob_sha": blobs[file_blob[i]], "type": "file",
+                  "bytes": int(file_bytes[i]), "num_chunks": int(file_chunks[i])} for i in new_files],
+            )
+        writer.flush(files_coll)
+
+        paths = dict(zip(snap.strings("paths.name"), (blobs[i] for i in snap.array("paths.blob"))))
+        _add_membership(client, repo_id, list(set(paths.values())))
+        _write_paths(client, repo_id, paths)
+        _prune_paths(client, repo_id, paths)
+
+        # A complete progress record lets webhook pushes update the import incrementally
+        progress = _new_progress(manifest["owner"], manifest["repo"], manifest["branch"], repo_id,
+                                 [], _default_budget())
+        progress.update({k: v for k, v in manifest.items() if k in _MANIFEST_FIELDS})
+        progress.update({"shas": paths, "done": list(paths), "indexed": list(paths),
+                         "pending": [], "complete": True})
+        _save_progress(progress)
+        _save_manifest(progress)
+        _publish_progress(progress)
+        result = {
+            "repo_id": repo_id, "files": len(file_blob), "chunks": len(chunk_blob),
+            "files_written": len(new_files), "chunks_written": len(chunk_rows),
+            "seconds": round(time.time() - started, 2),
+        }
+        print(f"[Snapshot] Imported {result}")
+        return result
+    finally:
+        snap.close()
+
+
+class SnapshotExportRequest(BaseModel):
+    owner: str
+    repo: str
+    branch: Optional[str] = None
+    quantize: Optional[str] = None  # None (float32) or "int8"
+
+
+@app.post("/admin/snapshots/export")
+def export_snapshot_endpoint(req: SnapshotExportRequest, request: Request):
+    _require_admin(request)
+    branch = req.branch or get_default_branch(req.owner, req.repo)
+    path = export_snapshot(get_repo_id(req.owner, req.repo, branch), req.quantize)
+    return {"name": os.path.basename(path), "bytes": os.path.getsize(path)}
+
+
+@app.get("/admin/snapshots")
+def list_snapshots(request: Request):
+    _require_admin(request)
+    try:
+        names = sorted(n for n in os.listdir(SNAPSHOT_DIR) if n.endswith(".xsnap"))
+    except OSError:
+        names = []
+    return [{"name": n, "bytes": os.path.getsize(os.path.join(SNAPSHOT_DIR, n))} for n in names]
+
+
+def _snapshot_path(name: str) -> str:
+    if os.path.basename(name) != name or not name.endswith(".xsnap"):
+        raise HTTPException(400, "Invalid snapshot name")
+    return os.path.join(SNAPSHOT_DIR, name)
+
+
+@app.get("/admin/snapshots/{name}")
+def download_snapshot(name: str, request: Request):
+    _require_admin(request)
+    path = _snapshot_path(name)
+    if not os.path.exists(path):
+        raise HTTPException(404, "Snapshot not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=name)
+
+
+async def _save_upload(request: Request, path: str, chunk_bytes: int = 1 << 20):
+    """Stream the request body to path; disk writes run off the event loop, ~1 MB at a time."""
+    await run_in_threadpool(os.makedirs, os.path.dirname(path), exist_ok=True)
+    f = await run_in_threadpool(open, path, "wb")
+    try:
+        buffered: List[bytes] = []
+        size = 0
+        async for part in request.stream():
+            buffered.append(part)
+            size += len(part)
+            if size >= chunk_bytes:
+                await run_in_threadpool(f.write, b"".join(buffered))
+                buffered, size = [], 0
+        if buffered:
+            await run_in_threadpool(f.write, b"".join(buffered))
+    finally:
+        await run_in_threadpool(f.close)
+
+
+def _discard_upload(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@app.post("/admin/snapshots/import")
+async def import_snapshot_endpoint(request: Request, name: Optional[str] = None):
+    """Import SNAPSHOT_DIR/<name>, or a snapshot uploaded as the request body."""
+    _require_admin(request)
+    if name:
+        path = _snapshot_path(name)
+        if not await run_in_threadpool(os.path.exists, path):
+            raise HTTPException(404, "Snapshot not found")
+        return await run_in_threadpool(import_snapshot, path)
+    path = os.path.join(SNAPSHOT_DIR, f"upload-{uuid.uuid4().hex}.xsnap")
+    try:
+        await _save_upload(request, path)
+        return await run_in_threadpool(import_snapshot, path)
+    finally:
+        await run_in_threadpool(_discard_upload, path)
+
+
+# ─── Push webhooks ─────────────────────────────────────────────────────────
+#
+# GitHub push events for indexed repo_ids are coalesced per repo/branch: each
+# push pushes the deadline out by WEBHOOK_DEBOUNCE_S (capped at
+# WEBHOOK_MAX_DELAY_S after the first), then one reindex runs for the union of
+# touched paths. The reindex rewrites the repo's progress so only those paths
+# are pending and hands it to the backfill thread; completion prunes removed
+# paths as usual. Gaps in the push history, force pushes and truncated commit
+# lists fall back to a full re-index (which still only embeds changed blobs).
+# A reindex that fails (GitHub or Qdrant hiccup, a local clone that has not
+# fetched the commit yet) is retried with backoff, up to WEBHOOK_MAX_RETRIES.
+
+_GITHUB_MAX_PUSH_COMMITS = 20  # GitHub lists at most 20 commits per push event
+
+_pending_pushes: Dict[str, Dict[str, Any]] = {}
+_push_cond = threading.Condition()
+_push_thread: Optional[threading.Thread] = None
+
+
+def _verify_signature(body: bytes, signature: Optional[str]) -> bool:
+    expected = "sha256=" + hmac.new(GITHUB_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return bool(signature) and hmac.compare_digest(expected, signature)
+
+
+def _queue_push(owner: str, repo: str, branch: str, event: Dict[str, Any]) -> Dict[str, Any]:
+    global _push_thread
+    repo_id = get_repo_id(owner, repo, branch)
+    commits = event.get("commits") or []
+    paths = {p for c in commits for key in ("added", "modified", "removed") for p in c.get(key) or []}
+    now = time.time()
+    with _push_cond:
+        push = _pending_pushes.get(repo_id)
+        if push is None:
+            push = _pending_pushes[repo_id] = {
+                "repo_id": repo_id, "owner": owner, "repo": repo, "branch": branch,
+                "before": event.get("before"), "paths": set(), "full": False, "first_at": now,
+            }
+        push["after"] = event.get("after")
+        push["paths"] |= paths
+        push["full"] = push["full"] or bool(event.get("forced")) or len(commits) >= _GITHUB_MAX_PUSH_COMMITS
+        push["due"] = min(now + WEBHOOK_DEBOUNCE_S, push["first_at"] + WEBHOOK_MAX_DELAY_S)
+        if _push_thread is None or not _push_thread.is_alive():
+            _push_thread = threading.Thread(target=_push_worker, name="push-reindex", daemon=True)
+            _push_thread.start()
+        _push_cond.notify()
+    return push
+
+
+def _push_worker():
+    while True:
+        with _push_cond:
+            while True:
+                now = time.time()
+                due = [p for p in _pending_pushes.values() if p["due"] <= now]
+                if due:
+                    break
+                wait = min((p["due"] for p in _pending_pushes.values()), default=None)
+                _push_cond.wait(None if wait is None else wait - now)
+            for push in due:
+                del _pending_pushes[push["repo_id"]]
+        for push in due:
+            _run_push(push)
+
+
+def _run_push(push: Dict[str, Any]):
+    try:
+        _apply_push(push)
+    except Exception as e:
+        traceback.print_exc()
+        attempts = push.get("attempts", 0) + 1
+        if attempts > WEBHOOK_MAX_RETRIES:
+            print(f"[Webhook] Reindex of {push['repo_id']} failed {attempts} times, giving up: {e}")
+            return
+        print(f"[Webhook] Reindex of {push['repo_id']} failed ({e}), retry {attempts}/{WEBHOOK_MAX_RETRIES}")
+        push["attempts"] = attempts
+        _requeue_push(push, WEBHOOK_DEBOUNCE_S * 2 ** (attempts - 1))
+
+
+def _requeue_push(push: Dict[str, Any], delay: float = WEBHOOK_DEBOUNCE_S):
+    """Merge an unprocessed push back in, behind anything that arrived meanwhile."""
+    with _push_cond:
+        newer = _pending_pushes.get(push["repo_id"])
+        if newer:
+            newer["before"] = push["before"]
+            newer["paths"] |= push["paths"]
+            newer["full"] = newer["full"] or push["full"]
+        else:
+            push["due"] = time.time() + delay
+            _pending_pushes[push["repo_id"]] = push
+        _push_cond.notify()
+
+
+def _apply_push(push: Dict[str, Any]):
+    repo_id = push["repo_id"]
+    manifest = get_manifest(repo_id)
+    if not manifest:
+        return  # never indexed (or collected) — nothing to keep fresh
+    if _index_busy(repo_id):
+        _requeue_push(push)
+        return
+    if manifest.get("commit") == push["after"]:
+        return
+    owner, repo, branch = push["owner"], push["repo"], push["branch"]
+    progress = _load_progress(repo_id)
+    if push["full"] or not progress or manifest.get("commit") != push["before"]:
+        if progress:
+            progress["complete"] = True  # start over from a fresh listing
+            _save_progress(progress)
+        # On the index pool, so this thread moves on to other repos' pushes
+        if submit_index_job(owner, repo, branch, repo_id, progress["budget"] if progress else None,
+                            message="Re-indexing after push...") is None:
+            _requeue_push(push)  # indexing queue full; try again after the debounce
+            return
+        print(f"[Webhook] {repo_id}: full re-index to {push['after'][:8]} queued")
+        return
+
+    blobs = list_repo_blobs(owner, repo, push["after"])
+    old_shas = progress.get("shas", {})
+    touched = [p for p in push["paths"] if old_shas.get(p) != blobs.get(p)]
+    # Take the old versions of touched files out of the totals before re-adding them
+    indexed = set(progress["indexed"])
+    stale = [p for p in touched if p in indexed]
+    payloads = _existing_blobs(get_qdrant_client(), repo_id, list({old_shas[p] for p in stale if old_shas.get(p)}))
+    for p in stale:
+        old = payloads.get(old_shas.get(p), {})
+        progress["num_files"] -= 1
+        progress["num_chunks"] -= old.get("num_chunks", 0)
+        progress["bytes"] -= old.get("bytes", 0)
+    touched_set = set(touched)
+    progress["done"] = [p for p in progress["done"] if p not in touched_set]
+    progress["indexed"] = [p for p in progress["indexed"] if p not in touched_set]
+    progress["pending"] = [p for p in blobs if p in touched_set]
+    progress.update({"shas": blobs, "commit": push["after"], "files_total": len(blobs),
+                     "complete": False, "stopped_reason": None})
+    print(f"[Webhook] {repo_id}: {len(progress['pending'])} changed, "
+          f"{len(touched) - len(progress['pending'])} removed at {push['after'][:8]}")
+    if progress["pending"]:
+        _save_progress(progress)
+        _save_manifest(progress)
+        _publish_progress(progress)
+        _schedule_backfill(repo_id)
+    else:
+        progress["complete"] = True
+        _prune_paths(get_qdrant_client(), repo_id, blobs)
+        _save_progress(progress)
+        _save_manifest(progress)
+        _publish_progress(progress)
+
+
+@app.post("/webhooks/github", status_code=202)
+async def github_webhook(request: Request):
+    if not GITHUB_WEBHOOK_SECRET:
+        raise HTTPException(404, "Not found")
+    body = await request.body()
+    if not _verify_signature(body, request.headers.get("x-hub-signature-256")):
+        raise HTTPException(401, "Invalid signature")
+    event_type = request.headers.get("x-github-event")
+    if event_type == "ping":
+        return {"status": "pong"}
+    if event_type != "push":
+        return {"status": "ignored", "reason": f"event {event_type}"}
+    try:
+        event = json.loads(body)
+        ref = event["ref"]
+        owner = event["repository"]["owner"].get("login") or event["repository"]["owner"]["name"]
+        repo = event["repository"]["name"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(400, "Malformed push payload")
+    if not ref.startswith("refs/heads/") or event.get("deleted"):
+        return {"status": "ignored", "reason": "not a branch update"}
+    push = _queue_push(owner, repo, ref[len("refs/heads/"):], event)
+    return {"status": "queued", "repo_id": push["repo_id"], "paths": len(push["paths"]),
+            "due_in_s": round(push["due"] - time.time(), 1)}
+
+
+# ─── Startup warm-up ───────────────────────────────────────────────────────
+#
+# Right after startup a background thread warms, concurrently, what the first
+# requests would otherwise pay for: the qdrant_client import, the client and
+# the collection checks, the shared Groq client, and embeddings of the fixed
+# /summarize questions. The port is bound immediately; /ready answers 503
+# until every step has succeeded (failed steps are retried a few times, then
+# again while /ready is polled). With WARMUP_ON_STARTUP=0 /ready is always 200.
+
+SUMMARY_ARCH_QUESTION = "What is the main architecture, frameworks, and key technical components?"
+SUMMARY_STRUCT_QUESTION = "What are the main entry points, file structure, and project organization?"
+_precomputed_embeddings: Dict[str, np.ndarray] = {}
+
+_warmup: Dict[str, Any] = {"status": "pending", "started_at": None, "finished_at": None, "components": {}}
+
+
+def _warm_qdrant() -> Optional[str]:
+    if not QDRANT_URL:
+        return "skipped"
+    get_qdrant_client()
+    ensure_collections()
+    return None
+
+
+def _warm_groq() -> Optional[str]:
+    if not llm_available() or not _module_available("groq"):
+        return "skipped"
+    get_llm_client()
+    return None
+
+
+def _warm_embeddings() -> Optional[str]:
+    if not JINA_API_KEY:
+        return "skipped"
+    questions = [SUMMARY_ARCH_QUESTION, SUMMARY_STRUCT_QUESTION]
+    for question, emb in zip(questions, get_embeddings(questions)):
+        _precomputed_embeddings[question] = emb
+    return None
+
+
+_WARMUP_STEPS = {"qdrant": _warm_qdrant, "groq": _warm_groq, "embeddings": _warm_embeddings}
+
+
+def warm_up(steps: Optional[List[str]] = None):
+    """Run the given warm-up steps (default: all), retrying failures WARMUP_RETRIES times."""
+    _warmup.update(status="warming", started_at=time.time(), finished_at=None)
+
+    def run(name: str):
+        started = time.monotonic()
+        try:
+            status, error = _WARMUP_STEPS[name]() or "ok", None
+        except Exception as e:
+            status, error = "error", str(getattr(e, "detail", e))
+        _warmup["components"][name] = {
+            "status": status, "seconds": round(time.monotonic() - started, 3),
+            **({"error": error} if error else {}),
+        }
+
+    pending = list(steps or _WARMUP_STEPS)
+    for attempt in range(WARMUP_RETRIES + 1):
+        if attempt:
+            time.sleep(2 * attempt)
+        with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="warmup") as pool:
+            list(pool.map(run, pending))
+        pending = [name for name in pending if _warmup["components"][name]["status"] == "error"]
+        if not pending:
+            break
+
+    _warmup.update(status="degraded" if pending else "ready", finished_at=time.time())
+    print(f"[Warmup] {_warmup['status']} in {_warmup['finished_at'] - _warmup['started_at']:.2f}s — "
+          + ", ".join(f"{name}: {c['status']}" for name, c in _warmup["components"].items()))
+
+
+_warmup_lock = threading.Lock()
+
+
+def _start_warmup_thread(steps: Optional[List[str]] = None) -> bool:
+    """Start warm_up in the background unless a run is already in progress."""
+    with _warmup_lock:
+        if _warmup["status"] == "warming":
+            return False
+        _warmup["status"] = "warming"
+        threading.Thread(target=warm_up, args=(steps,), name="warmup", daemon=True).start()
+        return True
+
+
+@app.on_event("startup")
+def _start_warmup():
+    if WARMUP_ON_STARTUP:
+        _start_warmup_thread()
+    else:
+        _warmup["status"] = "disabled"
+
+
+@app.get("/ready")
+def readiness():
+    # Steps that failed at boot (e.g. a dependency briefly down) are re-run
+    # in the background, at most every WARMUP_RECHECK_S, while /ready is polled.
+    if _warmup["status"] == "degraded" and time.time() - (_warmup["finished_at"] or 0) >= WARMUP_RECHECK_S:
+        _start_warmup_thread([name for name, c in _warmup["components"].items() if c["status"] == "error"])
+    if _warmup["status"] not in ("ready", "disabled"):
+        return JSONResponse(_warmup, status_code=503)
+    return _warmup
+
+
 # ─── Endpoints ─────────────────────────────────────────────────────────────
 
 @app.post("/build_embeddings")
-def build_embeddings(req: BuildEmbeddingsRequest, background_tasks: BackgroundTasks):
+@profiled("build_embeddings")
+def build_embeddings(req: BuildEmbeddingsRequest):
     branch = req.branch or get_default_branch(req.owner, req.repo)
     repo_id = get_repo_id(req.owner, req.repo, branch)
 
-    if check_if_indexed(req.owner, req.repo, branch):
-        return {"status": "skipped", "repo_id": repo_id, "message": "Already indexed"}
-
-    if _indexing_jobs.get(repo_id, {}).get("status") == "indexing":
+    if _indexing_jobs.get(repo_id, {}).get("status") in ("queued", "indexing"):
         return {"status": "already_running", "repo_id": repo_id}
 
-    _indexing_jobs[repo_id] = {
-        "status": "queued", "message": "Queued for indexing...", "started_at": time.time()
-    }
-    background_tasks.add_task(_do_build_embeddings, req.owner, req.repo, branch, repo_id)
+    if check_if_indexed(req.owner, req.repo, branch):
+        progress = _load_progress(repo_id)
+        if progress and not progress["complete"] and progress["branch"] == branch:
+            _publish_progress(progress)
+            _schedule_backfill(repo_id)
+            return {"status": "skipped", "repo_id": repo_id,
+                    "message": "Already searchable; background indexing resumed"}
+        if _index_is_current(get_manifest(repo_id)):
+            return {"status": "skipped", "repo_id": repo_id, "message": "Already indexed"}
+        print(f"[Index] {repo_id} has new commits since it was indexed, re-indexing")
+
+    budget = _default_budget(req.max_files, req.max_bytes, req.max_tokens)
+    if submit_index_job(req.owner, req.repo, branch, repo_id, budget) is None:
+        raise HTTPException(429, "Indexing queue is full, try again later", headers={"Retry-After": "30"})
     return {"status": "started", "repo_id": repo_id}
 
 
@@ -500,98 +3168,250 @@ def index_status(owner: str, repo: str):
     if repo_id in _indexing_jobs:
         return _indexing_jobs[repo_id]
 
-    if check_if_indexed(owner, repo, branch):
-        return {"status": "done", "message": "Already indexed", "num_files": 0, "num_chunks": 0}
+    try:
+        manifest = get_manifest(repo_id)
+    except Exception:
+        manifest = None
+    if manifest and manifest.get("num_chunks") != 0:
+        return {
+            "status": "done", "message": "Already indexed",
+            "num_files": manifest.get("num_files") or 0, "num_chunks": manifest.get("num_chunks") or 0,
+            "commit": manifest.get("commit"), "complete": manifest.get("complete", True),
+            "indexed_at": manifest.get("indexed_at"), "updated_at": manifest.get("updated_at"),
+        }
 
     return {"status": "not_started", "message": "Repository not indexed yet"}
 
 
 @app.post("/query", response_model=QueryResponse)
+@profiled("query")
 def query_repo(req: QueryRequest):
+    # One deadline for the whole request, counted from arrival so time spent in
+    # the admission queue is included; every upstream call gets what is left
+    # of it, and stages are cut back (two-stage search → one stage, fewer
+    # chunks, references only) rather than overrunning it.
+    arrived_at = _request_arrived_at.get() or time.monotonic()
+    deadline = arrived_at + max(1.0, min(req.deadline_s or QUERY_DEADLINE_S, QUERY_DEADLINE_MAX_S))
+    degraded: List[str] = []
     try:
-        branch = req.branch or get_default_branch(req.owner, req.repo)
+        branch = req.branch or get_default_branch(req.owner, req.repo, _time_left(deadline, 15))
         repo_id = get_repo_id(req.owner, req.repo, branch)
         print(f"[Query] {repo_id}: {req.question[:60]}")
+        touch_index(repo_id)
 
-        query_emb = get_embeddings([req.question])[0]
-        ensure_collections()
+        query_emb = get_embeddings([req.question], deadline)[0]
+        ensure_collections(deadline)
         client = get_qdrant_client()
 
-        # Stage 1: find relevant files
-        file_results = client.query_points(
-            collection_name=FILES_COLLECTION,
-            query=query_emb,
-            query_filter=Filter(
-                must=[FieldCondition(key="repo_id", match=MatchValue(value=repo_id))]
-            ),
-            limit=req.top_files,
-            with_payload=True,
+        two_stage = deadline - time.monotonic() >= QUERY_LLM_MIN_S + QUERY_TWO_STAGE_MIN_S
+        if not two_stage:
+            degraded.append("single_stage_search")
+        file_paths, chunk_hits = _search_repo(
+            client, req.owner, req.repo, branch, query_emb, req.top_files, req.top_chunks,
+            deadline=deadline, two_stage=two_stage,
         )
-        file_paths = [r.payload["file_path"] for r in file_results.points if r.payload.get("file_path")]
+        response = _answer_from_hits(req.owner, req.repo, branch, req.question,
+                                     file_paths, chunk_hits, req.top_chunks, deadline, degraded)
+        response.degraded = degraded
+        if degraded:
+            print(f"[Query] Degraded to meet deadline: {', '.join(degraded)}")
+        return response
 
-        if not file_paths:
-            # No index yet — answer immediately from context so the user isn't kept waiting.
-            # Background indexing (started by the extension) will make future queries use RAG.
-            print(f"[Query] No index for {repo_id}, answering from file tree + README")
-            return _answer_from_context(req.owner, req.repo, req.question)
+    except HTTPException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(500, f"Internal server error: {e}")
 
-        # Stage 2: find relevant chunks within those files
-        per_file = max(1, req.top_chunks // len(file_paths))
-        chunk_hits: List[Dict[str, Any]] = []
-        for path in file_paths:
-            results = client.query_points(
-                collection_name=CHUNKS_COLLECTION,
-                query=query_emb,
-                query_filter=Filter(
-                    must=[
-                        FieldCondition(key="repo_id", match=MatchValue(value=repo_id)),
-                        FieldCondition(key="file_path", match=MatchValue(value=path)),
-                    ]
-                ),
-                limit=per_file,
-                with_payload=True,
-            )
-            for r in results.points:
-                chunk_hits.append({
-                    "doc": r.payload.get("text", ""),
-                    "meta": r.payload,
-                    "dist": 1 - r.score,
-                })
 
+def _answer_from_hits(owner: str, repo: str, branch: str, question: str,
+                      file_paths: List[str], chunk_hits: List[Dict[str, Any]],
+                      top_chunks: int, deadline: Optional[float] = None,
+                      degraded: Optional[List[str]] = None) -> QueryResponse:
+    repo_id = get_repo_id(owner, repo, branch)
+    degraded = degraded if degraded is not None else []
+    if not file_paths:
+        # No index yet — answer immediately from context so the user isn't kept waiting.
+        # Background indexing (started by the extension) will make future queries use RAG.
+        print(f"[Query] No index for {repo_id}, answering from file tree + README")
+        return _answer_from_context(owner, repo, question, branch=branch, deadline=deadline, degraded=degraded)
+
+    top = chunk_hits[:top_chunks]
+
+    if not top:
+        print(f"[Query] Files indexed but no chunks for {repo_id}, falling back to context")
+        return _answer_from_context(owner, repo, question, branch=branch, deadline=deadline, degraded=degraded)
+
+    left = deadline - time.monotonic() if deadline is not None else None
+    if left is not None and left < QUERY_LLM_MIN_S:
+        degraded.append("references_only")
+        return _references_answer(_unique_references(top))
+    if left is not None and left < 2 * QUERY_LLM_MIN_S and len(top) > 3:
+        # A shorter prompt is a faster completion
+        top = top[:max(3, len(top) // 2)]
+        degraded.append("fewer_chunks")
+
+    numbered_parts = [
+        f"[{i+1}] {item['meta']['file_path']}:{item['meta']['start_line']}-{item['meta']['end_line']}\n{item['doc']}"
+        for i, item in enumerate(top)
+    ]
+
+    if _index_is_partial(repo_id, deadline):
+        # Only part of the repo is searchable yet — answer from the chunks that
+        # have landed plus the README/tree context the fallback path uses.
+        print(f"[Query] Partial index for {repo_id}, mixing {len(top)} chunks with context")
+        refs = [_chunk_reference(item["meta"]) for item in top]
+        response = _answer_from_context(owner, repo, question, numbered_parts, refs, branch, deadline, degraded)
+        response.partial = True
+        return response
+
+    answer = _call_llm(question, "\n\n".join(numbered_parts), _time_left(deadline, LLM_TIMEOUT_S))
+    refs = _unique_references(top)
+
+    print(f"[Query] Done — {len(refs)} references")
+    return QueryResponse(answer=answer, references=refs)
+
+
+def _unique_references(hits: List[Dict[str, Any]]) -> List[Reference]:
+    seen: set = set()
+    refs: List[Reference] = []
+    for item in hits:
+        m = item["meta"]
+        key = (m["file_path"], m["start_line"], m["end_line"])
+        if key in seen:
+            continue
+        seen.add(key)
+        refs.append(_chunk_reference(m))
+    return refs
+
+
+def _references_answer(refs: List[Reference]) -> QueryResponse:
+    """Short answer pointing at the references, for when no time is left for the LLM."""
+    lines = [f"[{i+1}] {r.file_path}:{r.start_line}-{r.end_line}" for i, r in enumerate(refs)]
+    answer = "Ran out of time for a full answer. The most relevant code is:\n\n" + "\n".join(lines)
+    return QueryResponse(answer=answer, references=refs)
+
+
+def _search_repo(client, owner: str, repo: str, branch: str, query_emb: np.ndarray,
+                 top_files: int, top_chunks: int, deadline: Optional[float] = None,
+                 two_stage: bool = True) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """Two-stage search: top files of the repo, then the best chunks within them.
+
+    Returns the matched file paths and chunk hits sorted by distance, with each
+    hit's meta carrying its path in this repo. two_stage=False searches the
+    repo's chunks directly, one round trip fewer, for requests short on time.
+    """
+    return _search_repo_batch(client, owner, repo, branch, query_emb[None, :], top_files, top_chunks,
+                              deadline, two_stage)[0]
+
+
+def _search_repo_batch(client, owner: str, repo: str, branch: str, query_embs: np.ndarray,
+                       top_files: int, top_chunks: int, deadline: Optional[float] = None,
+                       two_stage: bool = True) -> List[Tuple[List[str], List[Dict[str, Any]]]]:
+    """_search_repo for several queries at once: one batched request per stage."""
+    repo_id = get_repo_id(owner, repo, branch)
+    files_coll, chunks_coll = _repo_collections(repo_id, deadline)
+
+    if two_stage:
+        # Stage 1: find relevant files
+        file_results = client.query_batch_points(
+            collection_name=files_coll,
+            requests=[
+                PointsQuery(query=emb.tolist(), filter=_repo_filter(repo_id), limit=top_files,
+                            with_payload=["blob_sha"])
+                for emb in query_embs
+            ],
+            timeout=_qdrant_timeout(deadline),
+        )
+        per_query = [[r.payload["blob_sha"] for r in res.points] for res in file_results]
+        paths = _paths_for_blobs(client, repo_id, [sha for shas in per_query for sha in shas], deadline)
+        per_query = [[sha for sha in shas if sha in paths] for shas in per_query]
+
+        # Stage 2: find relevant chunks within those files
+        requests, owners = [], []
+        for qi, shas in enumerate(per_query):
+            per_file = max(1, top_chunks // max(1, len(shas)))
+            for sha in shas:
+                requests.append(PointsQuery(
+                    query=query_embs[qi].tolist(),
+                    filter=Filter(must=[FieldCondition(key="blob_sha", match=MatchValue(value=sha))]),
+                    limit=per_file,
+                    with_payload=True,
+                ))
+                owners.append((qi, sha))
+        chunk_results = client.query_batch_points(
+            collection_name=chunks_coll, requests=requests, timeout=_qdrant_timeout(deadline),
+        ) if requests else []
+        hits = [(qi, sha, r) for (qi, sha), res in zip(owners, chunk_results) for r in res.points]
+    else:
+        # Single stage: best chunks across the repo, files taken from the hits
+        chunk_results = client.query_batch_points(
+            collection_name=chunks_coll,
+            requests=[
+                PointsQuery(query=emb.tolist(), filter=_repo_filter(repo_id), limit=top_chunks,
+                            with_payload=True)
+                for emb in query_embs
+            ],
+            timeout=_qdrant_timeout(deadline),
+        )
+        paths = _paths_for_blobs(client, repo_id,
+                                 [r.payload["blob_sha"] for res in chunk_results for r in res.points], deadline)
+        hits = [(qi, r.payload["blob_sha"], r) for qi, res in enumerate(chunk_results)
+                for r in res.points if r.payload["blob_sha"] in paths]
+        per_query = [list(dict.fromkeys(sha for q, sha, _ in hits if q == qi)) for qi in range(len(query_embs))]
+
+    results: List[Tuple[List[str], List[Dict[str, Any]]]] = [
+        ([paths[sha] for sha in shas], []) for shas in per_query
+    ]
+    for qi, sha, r in hits:
+        meta = {**r.payload, "owner": owner, "repo": repo, "branch": branch, "file_path": paths[sha]}
+        results[qi][1].append({
+            "doc": _chunk_text(meta),
+            "meta": meta,
+            "dist": 1 - r.score,
+        })
+    for _, chunk_hits in results:
         chunk_hits.sort(key=lambda x: x["dist"])
-        top_chunks = chunk_hits[: req.top_chunks]
+    return results
+
+
+_query_batch_pool = ThreadPoolExecutor(max_workers=QUERY_BATCH_CONCURRENCY, thread_name_prefix="query-batch")
 
-        if not top_chunks:
-            print(f"[Query] Files indexed but no chunks for {repo_id}, falling back to context")
-            return _answer_from_context(req.owner, req.repo, req.question)
 
-        context = "\n\n".join(
-            f"[{i+1}] {item['meta']['file_path']}:{item['meta']['start_line']}-{item['meta']['end_line']}\n{item['doc']}"
-            for i, item in enumerate(top_chunks)
+@app.post("/query_batch", response_model=QueryBatchResponse)
+@profiled("query_batch")
+def query_repo_batch(req: QueryBatchRequest):
+    if not req.questions:
+        raise HTTPException(400, "questions must not be empty")
+    if len(req.questions) > QUERY_BATCH_MAX:
+        raise HTTPException(400, f"At most {QUERY_BATCH_MAX} questions per batch")
+    try:
+        branch = req.branch or get_default_branch(req.owner, req.repo)
+        repo_id = get_repo_id(req.owner, req.repo, branch)
+        print(f"[Query] {repo_id}: batch of {len(req.questions)} questions")
+        touch_index(repo_id)
+
+        query_embs = get_embeddings(req.questions)
+        ensure_collections()
+        client = get_qdrant_client()
+        searches = _search_repo_batch(
+            client, req.owner, req.repo, branch, query_embs, req.top_files, req.top_chunks
         )
-        answer = _call_llm(req.question, context)
-
-        seen: set = set()
-        refs: List[Reference] = []
-        for item in top_chunks:
-            m = item["meta"]
-            key = (m["file_path"], m["start_line"], m["end_line"])
-            if key in seen:
-                continue
-            seen.add(key)
-            refs.append(Reference(
-                file_path=m["file_path"],
-                start_line=int(m["start_line"]),
-                end_line=int(m["end_line"]),
-                url=(
-                    f"https://github.com/{m['owner']}/{m['repo']}"
-                    f"/blob/{m['branch']}/{m['file_path']}"
-                    f"#L{m['start_line']}-L{m['end_line']}"
-                ),
-            ))
-
-        print(f"[Query] Done — {len(refs)} references")
-        return QueryResponse(answer=answer, references=refs)
+
+        # Completions run QUERY_BATCH_CONCURRENCY at a time across all batch requests
+        futures = [
+            _query_batch_pool.submit(_answer_from_hits, req.owner, req.repo, branch, question,
+                                     file_paths, chunk_hits, req.top_chunks)
+            for question, (file_paths, chunk_hits) in zip(req.questions, searches)
+        ]
+        results: List[QueryResponse] = []
+        for question, future in zip(req.questions, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"[Query] Batch question failed ({question[:40]}): {e}")
+                results.append(QueryResponse(answer=f"Failed to answer this question: {e}", references=[]))
+        return QueryBatchResponse(results=results)
 
     except HTTPException:
         raise
@@ -600,134 +3420,271 @@ def query_repo(req: QueryRequest):
         raise HTTPException(500, f"Internal server error: {e}")
 
 
-def _answer_from_context(owner: str, repo: str, question: str) -> QueryResponse:
-    """Fast answer (~2-4s) using README + file tree + key config files.
-    Used before indexing completes — works even when there is no README.
-    Returns real Reference objects so citation badges are clickable.
-    """
-    numbered_parts: List[str] = []   # context blocks labelled [1], [2], ...
-    refs: List[Reference] = []        # matching Reference for each block
+def _chunk_reference(m: Dict[str, Any]) -> Reference:
+    return Reference(
+        file_path=m["file_path"],
+        start_line=int(m["start_line"]),
+        end_line=int(m["end_line"]),
+        url=(
+            f"https://github.com/{m['owner']}/{m['repo']}"
+            f"/blob/{m['branch']}/{m['file_path']}"
+            f"#L{m['start_line']}-L{m['end_line']}"
+        ),
+    )
 
-    branch = "main"
-    try:
-        branch = get_default_branch(owner, repo)
-    except Exception:
-        pass
 
-    # [1] README (optional)
+# ─── Repo context bundle ───────────────────────────────────────────────────
+#
+# README excerpt, language stats, top-60 tree and key config files for the
+# pre-index fast path. Upstream calls fan out concurrently under one
+# CONTEXT_DEADLINE_S budget, and complete bundles are cached per
+# (repo, commit) — a commit never changes, so repeated questions about the
+# same HEAD only pay for the LLM call.
+
+_context_cache: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+_ref_cache: Dict[Tuple[str, str, str], Tuple[float, str]] = {}
+_context_lock = threading.Lock()
+_fanout_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="fanout")
+
+_EXT_TO_LANG = {
+    ".py": "Python", ".js": "JavaScript", ".ts": "TypeScript",
+    ".tsx": "TypeScript/React", ".jsx": "JavaScript/React",
+    ".java": "Java", ".go": "Go", ".rs": "Rust",
+    ".cpp": "C++", ".cc": "C++", ".c": "C", ".cs": "C#",
+    ".rb": "Ruby", ".php": "PHP", ".swift": "Swift",
+    ".kt": "Kotlin", ".scala": "Scala", ".r": "R",
+    ".sh": "Shell", ".html": "HTML", ".css": "CSS",
+}
+_CONFIG_PRIORITY = [
+    "package.json", "requirements.txt", "pyproject.toml",
+    "go.mod", "Cargo.toml", "pom.xml", "build.gradle",
+    "Gemfile", "composer.json", "setup.py",
+]
+
+
+def _github_headers(accept: str = "application/vnd.github.v3+json") -> Dict[str, str]:
+    headers = {"Accept": accept}
+    if GITHUB_TOKEN:
+        headers["Authorization"] = f"token {GITHUB_TOKEN}"
+    return headers
+
+
+def _resolve_commit(owner: str, repo: str, branch: str, timeout: float) -> Optional[str]:
+    """HEAD commit SHA of branch, cached for REF_CACHE_TTL_S."""
+    key = (owner, repo, branch)
+    with _context_lock:
+        hit = _ref_cache.get(key)
+    if hit and time.time() - hit[0] < REF_CACHE_TTL_S:
+        return hit[1]
+    local = get_local_repo(owner, repo)
+    if local:
+        return local.resolve(branch)
     try:
         r = http_requests.get(
-            f"https://api.github.com/repos/{owner}/{repo}/readme",
-            headers={"Accept": "application/vnd.github.v3.raw"},
-            timeout=8,
+            f"https://api.github.com/repos/{owner}/{repo}/commits/{branch}",
+            headers=_github_headers("application/vnd.github.sha"), timeout=timeout,
         )
         if r.ok and r.text.strip():
-            idx = len(numbered_parts) + 1
-            numbered_parts.append(f"[{idx}] README.md:\n{r.text[:3000]}")
-            refs.append(Reference(
-                file_path="README.md",
-                start_line=1,
-                end_line=min(100, r.text.count("\n") + 1),
-                url=f"https://github.com/{owner}/{repo}/blob/{branch}/README.md",
-            ))
+            sha = r.text.strip()
+            with _context_lock:
+                _ref_cache[key] = (time.time(), sha)
+            return sha
     except Exception:
         pass
+    return None
+
+
+def _fetch_readme(owner: str, repo: str, ref: str, timeout: float) -> Optional[str]:
+    r = http_requests.get(
+        f"https://api.github.com/repos/{owner}/{repo}/readme",
+        params={"ref": ref}, headers=_github_headers("application/vnd.github.v3.raw"), timeout=timeout,
+    )
+    return r.text if r.ok and r.text.strip() else None
+
+
+def _fetch_tree_blobs(owner: str, repo: str, ref: str, timeout: float) -> Dict[str, str]:
+    """Every blob in ref's tree, complete even when GitHub truncates the recursive listing."""
+    entries = _list_tree_entries(owner, repo, ref, _github_headers(), timeout)
+    return {i["path"]: i.get("sha") for i in entries if i.get("type") == "blob"}
+
+
+def _fetch_config(owner: str, repo: str, ref: str, path: str, sha: Optional[str],
+                  timeout: float) -> Optional[str]:
+    data = blob_get(sha) if sha else None
+    if data is None:
+        r = http_requests.get(f"https://raw.githubusercontent.com/{owner}/{repo}/{ref}/{path}", timeout=timeout)
+        if not r.ok:
+            return None
+        data = r.content
+        blob_put(data)
+    text = data.decode("utf-8", errors="replace")
+    return text if len(text) < 8000 else None
+
+
+def _get_context_bundle(owner: str, repo: str, branch: str,
+                        deadline: Optional[float] = None) -> Dict[str, Any]:
+    deadline = min(time.monotonic() + CONTEXT_DEADLINE_S, deadline or float("inf"))
+    timed_out = False
+
+    def remaining() -> float:
+        return max(0.5, deadline - time.monotonic())
+
+    def result(future):
+        nonlocal timed_out
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FuturesTimeout:
+            timed_out = True
+        except Exception:
+            pass
+        return None
+
+    sha = _resolve_commit(owner, repo, branch, remaining())
+    if sha:
+        with _context_lock:
+            cached = _context_cache.get((f"{owner}/{repo}", sha))
+            if cached is not None:
+                _context_cache.move_to_end((f"{owner}/{repo}", sha))
+                return cached
+    ref = sha or branch
+
+    readme_future = _fanout_pool.submit(_fetch_readme, owner, repo, ref, remaining())
+    tree_future = _fanout_pool.submit(_fetch_tree_blobs, owner, repo, ref, remaining())
+
+    blobs = result(tree_future)
+    items = list(blobs) if blobs is not None else None
+    # Config candidates only depend on the tree; fetch the top few at once and
+    # keep the first two that load, in priority order.
+    candidates: List[str] = []
+    for cfg in _CONFIG_PRIORITY:
+        matches = [p for p in items or [] if os.path.basename(p) == cfg and p.count("/") <= 1]
+        if matches:
+            candidates.append(matches[0])
+    config_futures = [
+        (path, _fanout_pool.submit(_fetch_config, owner, repo, ref, path, blobs.get(path), remaining()))
+        for path in candidates[:4]
+    ]
+
+    readme = result(readme_future)
+    configs: List[Dict[str, Any]] = []
+    for path, future in config_futures:
+        text = result(future)
+        if text and len(configs) < 2:
+            configs.append({"path": path, "text": text[:2000], "lines": text.count("\n") + 1})
+
+    langs: List[str] = []
+    if items is not None:
+        skip_exts = {".md", ".txt", ".json", ".yaml", ".yml", ".toml",
+                     ".lock", ".sum", ".mod", ".gitignore", ".env"}
+        ext_counts: Dict[str, int] = {}
+        for path in items:
+            _, ext = os.path.splitext(path.lower())
+            if ext and ext not in skip_exts:
+                ext_counts[ext] = ext_counts.get(ext, 0) + 1
+        top = sorted(ext_counts.items(), key=lambda x: -x[1])[:6]
+        langs = [_EXT_TO_LANG.get(e, e.lstrip(".").upper()) for e, _ in top if e in _EXT_TO_LANG]
+
+    bundle = {
+        "branch": branch,
+        "readme": readme[:3000] if readme else None,
+        "readme_lines": readme.count("\n") + 1 if readme else 0,
+        "total_files": len(items) if items is not None else None,
+        "languages": langs,
+        "tree": (items or [])[:60],
+        "configs": configs,
+    }
+    # Only cache bundles where every upstream call actually answered.
+    if sha and not timed_out:
+        with _context_lock:
+            _context_cache[(f"{owner}/{repo}", sha)] = bundle
+            while len(_context_cache) > CONTEXT_CACHE_SIZE:
+                _context_cache.popitem(last=False)
+    return bundle
+
+
+def _answer_from_context(owner: str, repo: str, question: str,
+                         numbered_parts: Optional[List[str]] = None,
+                         refs: Optional[List[Reference]] = None,
+                         branch: Optional[str] = None,
+                         deadline: Optional[float] = None,
+                         degraded: Optional[List[str]] = None) -> QueryResponse:
+    """Fast answer (~2-4s, LLM only when the context bundle is cached) using
+    README + file tree + key config files.
+    Used before indexing completes — works even when there is no README.
+    Returns real Reference objects so citation badges are clickable.
+    numbered_parts/refs may carry blocks already retrieved from a partial index;
+    the README/tree/config blocks are numbered after them. With a deadline,
+    the bundle fetch leaves QUERY_LLM_MIN_S for the LLM, and the answer falls
+    back to the references alone if that time is gone.
+    """
+    numbered_parts = numbered_parts if numbered_parts is not None else []   # context blocks labelled [1], [2], ...
+    refs = refs if refs is not None else []                                  # matching Reference for each block
+
+    if branch is None:
+        branch = "main"
+        try:
+            branch = get_default_branch(owner, repo, _time_left(deadline, 15))
+        except Exception:
+            pass
+
+    bundle = _get_context_bundle(owner, repo, branch, deadline - QUERY_LLM_MIN_S if deadline else None)
+
+    # [1] README (optional)
+    if bundle["readme"]:
+        idx = len(numbered_parts) + 1
+        numbered_parts.append(f"[{idx}] README.md:\n{bundle['readme']}")
+        refs.append(Reference(
+            file_path="README.md",
+            start_line=1,
+            end_line=min(100, bundle["readme_lines"]),
+            url=f"https://github.com/{owner}/{repo}/blob/{branch}/README.md",
+        ))
 
     # [next] File tree
-    items: List[str] = []
-    try:
-        headers = {"Accept": "application/vnd.github.v3+json"}
-        if GITHUB_TOKEN:
-            headers["Authorization"] = f"token {GITHUB_TOKEN}"
-        tree_r = http_requests.get(
-            f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1",
-            headers=headers, timeout=10,
+    if bundle["total_files"] is not None:
+        langs = bundle["languages"]
+        idx = len(numbered_parts) + 1
+        numbered_parts.append(
+            f"[{idx}] Repository structure ({owner}/{repo}):\n"
+            f"Total files: {bundle['total_files']}\n"
+            f"Languages: {', '.join(langs) if langs else 'not detected'}\n"
+            f"File tree (first 60):\n" + "\n".join(bundle["tree"])
         )
-        if tree_r.ok:
-            items = [i["path"] for i in tree_r.json().get("tree", []) if i.get("type") == "blob"]
-
-            ext_to_lang = {
-                ".py": "Python", ".js": "JavaScript", ".ts": "TypeScript",
-                ".tsx": "TypeScript/React", ".jsx": "JavaScript/React",
-                ".java": "Java", ".go": "Go", ".rs": "Rust",
-                ".cpp": "C++", ".cc": "C++", ".c": "C", ".cs": "C#",
-                ".rb": "Ruby", ".php": "PHP", ".swift": "Swift",
-                ".kt": "Kotlin", ".scala": "Scala", ".r": "R",
-                ".sh": "Shell", ".html": "HTML", ".css": "CSS",
-            }
-            skip_exts = {".md", ".txt", ".json", ".yaml", ".yml", ".toml",
-                         ".lock", ".sum", ".mod", ".gitignore", ".env"}
-            ext_counts: Dict[str, int] = {}
-            for path in items:
-                _, ext = os.path.splitext(path.lower())
-                if ext and ext not in skip_exts:
-                    ext_counts[ext] = ext_counts.get(ext, 0) + 1
-
-            top = sorted(ext_counts.items(), key=lambda x: -x[1])[:6]
-            langs = [ext_to_lang.get(e, e.lstrip(".").upper()) for e, _ in top if e in ext_to_lang]
-
-            idx = len(numbered_parts) + 1
-            numbered_parts.append(
-                f"[{idx}] Repository structure ({owner}/{repo}):\n"
-                f"Total files: {len(items)}\n"
-                f"Languages: {', '.join(langs) if langs else 'not detected'}\n"
-                f"File tree (first 60):\n" + "\n".join(items[:60])
-            )
-            refs.append(Reference(
-                file_path=f"{owner}/{repo} (file tree)",
-                start_line=1,
-                end_line=1,
-                url=f"https://github.com/{owner}/{repo}",
-            ))
-    except Exception:
-        pass
+        refs.append(Reference(
+            file_path=f"{owner}/{repo} (file tree)",
+            start_line=1,
+            end_line=1,
+            url=f"https://github.com/{owner}/{repo}",
+        ))
 
     # [next+] Config files
-    config_priority = [
-        "package.json", "requirements.txt", "pyproject.toml",
-        "go.mod", "Cargo.toml", "pom.xml", "build.gradle",
-        "Gemfile", "composer.json", "setup.py",
-    ]
-    fetched = 0
-    for cfg in config_priority:
-        if fetched >= 2:
-            break
-        matches = [p for p in items if os.path.basename(p) == cfg and p.count("/") <= 1]
-        if matches:
-            try:
-                cr = http_requests.get(
-                    f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{matches[0]}",
-                    timeout=6,
-                )
-                if cr.ok and len(cr.text) < 8000:
-                    idx = len(numbered_parts) + 1
-                    numbered_parts.append(f"[{idx}] {matches[0]}:\n{cr.text[:2000]}")
-                    refs.append(Reference(
-                        file_path=matches[0],
-                        start_line=1,
-                        end_line=min(80, cr.text.count("\n") + 1),
-                        url=f"https://github.com/{owner}/{repo}/blob/{branch}/{matches[0]}",
-                    ))
-                    fetched += 1
-            except Exception:
-                pass
+    for cfg in bundle["configs"]:
+        idx = len(numbered_parts) + 1
+        numbered_parts.append(f"[{idx}] {cfg['path']}:\n{cfg['text']}")
+        refs.append(Reference(
+            file_path=cfg["path"],
+            start_line=1,
+            end_line=min(80, cfg["lines"]),
+            url=f"https://github.com/{owner}/{repo}/blob/{branch}/{cfg['path']}",
+        ))
 
     if not numbered_parts:
         numbered_parts.append(f"Repository: {owner}/{repo} — no additional information could be retrieved.")
 
-    answer = _call_llm(question, "\n\n---\n\n".join(numbered_parts))
+    if deadline is not None and deadline - time.monotonic() < QUERY_LLM_MIN_S and refs:
+        if degraded is not None:
+            degraded.append("references_only")
+        return _references_answer(refs)
+    answer = _call_llm(question, "\n\n---\n\n".join(numbered_parts), _time_left(deadline, LLM_TIMEOUT_S))
     return QueryResponse(answer=answer, references=refs)
 
 
-def _call_llm(question: str, context: str) -> str:
+def _call_llm(question: str, context: str, timeout: float = LLM_TIMEOUT_S) -> str:
     try:
-        from groq import Groq
-        api_key = GROQ_API_KEY or os.environ.get("API_KEY")
-        if not api_key:
+        if not llm_available():
             return "No LLM API key configured.\n\n" + context
-        client = Groq(api_key=api_key)
-        completion = client.chat.completions.create(
-            messages=[
+        return llm_complete(
+            [
                 {
                     "role": "system",
                     "content": (
@@ -740,26 +3697,32 @@ def _call_llm(question: str, context: str) -> str:
                     "content": f"Context:\n\n{context}\n\nQuestion: {question}\n\nAnswer:",
                 },
             ],
-            model="openai/gpt-oss-120b",
             temperature=0.2,
-            stream=False,
+            timeout=timeout,
         )
-        return completion.choices[0].message.content
     except Exception as e:
         return f"LLM call failed: {e}\n\nRelevant context:\n\n{context}"
 
 
 @app.post("/summarize")
+@profiled("summarize")
 def summarize_repo(info: RepoInfo):
     branch = get_default_branch(info.owner, info.repo)
 
     if not check_if_indexed(info.owner, info.repo, branch):
+        # Wait a bounded time for the first tier; the job keeps running either way
+        repo_id = get_repo_id(info.owner, info.repo, branch)
+        future = submit_index_job(info.owner, info.repo, branch, repo_id)
+        if future is None:
+            print(f"[Summarize] Indexing queue full for {repo_id}, using README fallback")
+            return _fallback_readme_summary(info)
         try:
-            repo_id = get_repo_id(info.owner, info.repo, branch)
-            _indexing_jobs[repo_id] = {"status": "indexing", "message": "Starting...", "started_at": time.time()}
-            _do_build_embeddings(info.owner, info.repo, branch, repo_id)
-        except Exception as e:
-            print(f"[Summarize] Index failed: {e}, using README fallback")
+            future.result(timeout=SUMMARIZE_INDEX_WAIT_S)
+        except FuturesTimeout:
+            print(f"[Summarize] Index of {repo_id} not ready in {SUMMARIZE_INDEX_WAIT_S:.0f}s, using README fallback")
+            return _fallback_readme_summary(info)
+        if _indexing_jobs.get(repo_id, {}).get("status") == "error":
+            print(f"[Summarize] Index failed: {_indexing_jobs[repo_id].get('message')}, using README fallback")
             return _fallback_readme_summary(info)
 
     try:
@@ -775,48 +3738,34 @@ def summarize_repo(info: RepoInfo):
         except Exception:
             pass
 
-        arch_ctx = _query_for_summary(
-            info.owner, info.repo, branch,
-            "What is the main architecture, frameworks, and key technical components?",
-            top_chunks=15,
-        )
-        struct_ctx = _query_for_summary(
-            info.owner, info.repo, branch,
-            "What are the main entry points, file structure, and project organization?",
-            top_chunks=10,
-        )
+        arch_ctx = _query_for_summary(info.owner, info.repo, branch, SUMMARY_ARCH_QUESTION, top_chunks=15)
+        struct_ctx = _query_for_summary(info.owner, info.repo, branch, SUMMARY_STRUCT_QUESTION, top_chunks=10)
 
-        from groq import Groq
-        api_key = GROQ_API_KEY or os.environ.get("API_KEY")
-        if not api_key:
+        if not llm_available():
             return {"summary": "API key not configured", "project_paper": ""}
 
-        client = Groq(api_key=api_key)
-
-        summary = client.chat.completions.create(
-            messages=[{"role": "user", "content": (
+        summary = llm_complete(
+            [{"role": "user", "content": (
                 f"Summarize {info.owner}/{info.repo} in 2-3 paragraphs based on the code analysis.\n\n"
                 f"Description: {info.description}\nREADME: {readme}\n"
                 f"Architecture: {arch_ctx[:3000]}\nStructure: {struct_ctx[:2000]}\n\n"
                 "Be specific and technical. Focus on what it does, main technologies, and architecture."
             )}],
-            model="openai/gpt-oss-120b",
             temperature=0.3,
-            stream=False,
-        ).choices[0].message.content
+            call_class="summarize",
+        )
 
-        project_paper = client.chat.completions.create(
-            messages=[{"role": "user", "content": (
+        project_paper = llm_complete(
+            [{"role": "user", "content": (
                 f"Create a comprehensive one-page overview of {info.owner}/{info.repo}.\n\n"
                 f"Description: {info.description}\nREADME: {readme}\n"
                 f"Architecture: {arch_ctx[:4000]}\nStructure: {struct_ctx[:2500]}\n\n"
                 "Sections: Purpose, Technical Architecture, Key Technologies, Main Features, "
                 "File Structure, How to Run, Development Setup."
             )}],
-            model="openai/gpt-oss-120b",
             temperature=0.3,
-            stream=False,
-        ).choices[0].message.content
+            call_class="summarize",
+        )
 
         return {"summary": summary, "project_paper": project_paper, "indexed": True, "branch": branch}
 
@@ -828,41 +3777,18 @@ def summarize_repo(info: RepoInfo):
 def _query_for_summary(owner: str, repo: str, branch: str, question: str, top_chunks: int = 15) -> str:
     try:
         repo_id = get_repo_id(owner, repo, branch)
-        query_emb = get_embeddings([question])[0]
+        touch_index(repo_id)
+        query_emb = _precomputed_embeddings.get(question)
+        if query_emb is None:
+            query_emb = get_embeddings([question])[0]
         ensure_collections()
         client = get_qdrant_client()
 
-        file_results = client.query_points(
-            collection_name=FILES_COLLECTION,
-            query=query_emb,
-            query_filter=Filter(
-                must=[FieldCondition(key="repo_id", match=MatchValue(value=repo_id))]
-            ),
-            limit=10,
-            with_payload=True,
-        )
-        file_paths = [r.payload["file_path"] for r in file_results.points if r.payload.get("file_path")]
-
-        per_file = max(1, top_chunks // max(1, len(file_paths)))
-        chunks = []
-        for path in file_paths:
-            results = client.query_points(
-                collection_name=CHUNKS_COLLECTION,
-                query=query_emb,
-                query_filter=Filter(
-                    must=[
-                        FieldCondition(key="repo_id", match=MatchValue(value=repo_id)),
-                        FieldCondition(key="file_path", match=MatchValue(value=path)),
-                    ]
-                ),
-                limit=per_file,
-                with_payload=True,
-            )
-            for r in results.points:
-                m = r.payload
-                chunks.append(
-                    f"{m.get('file_path')}:{m.get('start_line')}-{m.get('end_line')}\n{m.get('text', '')}"
-                )
+        _, hits = _search_repo(client, owner, repo, branch, query_emb, 10, top_chunks)
+        chunks = [
+            f"{h['meta']['file_path']}:{h['meta']['start_line']}-{h['meta']['end_line']}\n{h['doc']}"
+            for h in hits
+        ]
 
         return "\n\n".join(chunks[:top_chunks]) or "No relevant code context found."
     except Exception as e:
@@ -882,29 +3808,18 @@ def _fallback_readme_summary(info: RepoInfo):
     except Exception:
         pass
 
-    from groq import Groq
-    api_key = GROQ_API_KEY or os.environ.get("API_KEY")
-    if not api_key:
+    if not llm_available():
         return {"summary": "API key not configured", "project_paper": ""}
 
-    client = Groq(api_key=api_key)
-    summary = client.chat.completions.create(
-        messages=[{"role": "user", "content": (
-            f"Summarize {info.owner}/{info.repo}:\n"
-            f"Description: {info.description}\nREADME: {readme[:2000]}"
-        )}],
-        model="openai/gpt-oss-120b",
-        stream=False,
-    ).choices[0].message.content
-
-    project_paper = client.chat.completions.create(
-        messages=[{"role": "user", "content": (
-            f"Create a project overview for {info.owner}/{info.repo}:\n"
-            f"Description: {info.description}\nREADME: {readme[:4000]}"
-        )}],
-        model="openai/gpt-oss-120b",
-        stream=False,
-    ).choices[0].message.content
+    summary = llm_complete([{"role": "user", "content": (
+        f"Summarize {info.owner}/{info.repo}:\n"
+        f"Description: {info.description}\nREADME: {readme[:2000]}"
+    )}], temperature=1.0, call_class="summarize")
+
+    project_paper = llm_complete([{"role": "user", "content": (
+        f"Create a project overview for {info.owner}/{info.repo}:\n"
+        f"Description: {info.description}\nREADME: {readme[:4000]}"
+    )}], temperature=1.0, call_class="summarize")
 
     return {"summary": summary, "project_paper": project_paper, "indexed": False}
 
@@ -0,0 +1,48 @@
+import index
+
+
+def _handler():
+    # The tree builders only use other methods, never request state
+    return index.handler.__new__(index.handler)
+
+
+def _tree(*paths):
+    return [{"path": p.rstrip("/"), "type": "tree" if p.endswith("/") else "blob"} for p in paths]
+
+
+def test_visible_entries_skips_excluded_dirs_and_their_subtrees():
+    items = _tree("src/", "src/a.py", "node_modules/", "node_modules/x/", "node_modules/x/y.js",
+                  "src/__pycache__/", "src/__pycache__/a.pyc", "README.md")
+    entries = _handler()._visible_entries(items)
+    assert entries == [
+        ("src", "", "src", True),
+        ("src/a.py", "src", "a.py", False),
+        ("README.md", "", "README.md", False),
+    ]
+
+
+def test_visible_entries_synthesises_missing_parents():
+    entries = _handler()._visible_entries(_tree("a/b/c.txt", "a/d.txt"))
+    assert entries == [
+        ("a", "", "a", True),
+        ("a/b", "a", "b", True),
+        ("a/b/c.txt", "a/b", "c.txt", False),
+        ("a/d.txt", "a", "d.txt", False),
+    ]
+
+
+def test_visible_entries_skip_is_case_insensitive_and_dirs_only():
+    entries = _handler()._visible_entries(_tree("Node_Modules/", "Node_Modules/z.js", "node_modules"))
+    # A *file* named node_modules is kept; the directory and its contents are not
+    assert entries == [("node_modules", "", "node_modules", False)]
+
+
+def test_build_compact_tree():
+    tree = _handler()._build_compact_tree("repo", _tree("src/", "src/a.py", "src/b/", "src/b/a.py", ".git/", "x"))
+    assert tree["format"] == "flat-v1"
+    names = [tree["names"][i] for i in tree["name"]]
+    assert names == ["repo", "src", "a.py", "b", "a.py", "x"]
+    assert tree["parent"] == [-1, 0, 1, 1, 3, 0]
+    assert tree["dir"] == [1, 1, 0, 1, 0, 0]
+    # Repeated names are interned once
+    assert tree["names"].count("a.py") == 1
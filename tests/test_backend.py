@@ -0,0 +1,719 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import subprocess
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import backend
+
+
+# ─── Membership grouping ───────────────────────────────────────────────────
+
+class FakeClient:
+    """Just enough of QdrantClient for the membership helpers."""
+
+    def __init__(self, payloads):
+        self.payloads = {backend.make_blob_point_id(p["blob_sha"]): p for p in payloads}
+        self.set_calls = []
+        self.deleted = []
+
+    def retrieve(self, collection_name, ids, with_payload=True):
+        return [SimpleNamespace(payload=self.payloads[i]) for i in ids if i in self.payloads]
+
+    def set_payload(self, collection_name, payload, points, wait=True):
+        shas = points.must[0].match.any
+        self.set_calls.append((collection_name, tuple(payload["repo_ids"]), sorted(shas)))
+
+    def delete(self, collection_name, points_selector):
+        self.deleted.append((collection_name, sorted(points_selector.filter.must[0].match.any)))
+
+
+@pytest.fixture
+def shared_layout(monkeypatch):
+    monkeypatch.setattr(backend, "_repo_collections", lambda repo_id: ("files", "chunks"))
+
+
+def test_add_membership_groups_blobs_by_resulting_repo_ids(shared_layout):
+    client = FakeClient([
+        {"blob_sha": "a", "repo_ids": ["x"]},
+        {"blob_sha": "b", "repo_ids": ["x"]},
+        {"blob_sha": "c", "repo_ids": ["y"]},
+        {"blob_sha": "d", "repo_ids": ["r", "x"]},
+    ])
+    backend._add_membership(client, "r", ["a", "b", "c", "d", "missing"])
+
+    # One set_payload per (collection, resulting repo_ids); chunks before files
+    assert client.set_calls == [
+        ("chunks", ("r", "x"), ["a", "b"]),
+        ("chunks", ("r", "y"), ["c"]),
+        ("files", ("r", "x"), ["a", "b"]),
+        ("files", ("r", "y"), ["c"]),
+    ]
+
+
+def test_remove_membership_keeps_shared_blobs_and_deletes_orphans(shared_layout):
+    client = FakeClient([
+        {"blob_sha": "a", "repo_ids": ["r", "x"]},
+        {"blob_sha": "b", "repo_ids": ["r"]},
+        {"blob_sha": "c", "repo_ids": ["r"]},
+        {"blob_sha": "d", "repo_ids": ["x"]},
+    ])
+    backend._remove_membership(client, "r", ["a", "b", "c", "d"])
+
+    assert client.set_calls == [("chunks", ("x",), ["a"]), ("files", ("x",), ["a"])]
+    assert client.deleted == [("files", ["b", "c"]), ("chunks", ["b", "c"])]
+
+
+class PathsClient:
+    """scroll() over PATHS records, honouring the blob_sha filter and the limit."""
+
+    def __init__(self, records):
+        self.records = records
+        self.calls = 0
+
+    def scroll(self, collection_name, scroll_filter, limit, with_payload, timeout=None):
+        self.calls += 1
+        wanted = set(scroll_filter.must[1].match.any)
+        hits = [SimpleNamespace(payload=r) for r in self.records if r["blob_sha"] in wanted]
+        return hits[:limit], None
+
+
+def test_paths_for_blobs_resolves_blobs_crowded_out_by_a_shared_one():
+    records = [{"blob_sha": "lic", "file_path": f"pkg{i:02}/LICENSE"} for i in range(40)]
+    records += [{"blob_sha": "a", "file_path": "src/a.py"}, {"blob_sha": "b", "file_path": "src/b.py"}]
+    client = PathsClient(records)
+    paths = backend._paths_for_blobs(client, "r", ["lic", "a", "b", "gone"])
+    assert paths == {"lic": "pkg00/LICENSE", "a": "src/a.py", "b": "src/b.py"}
+    assert client.calls == 3  # the shared blob fills page one; a missing blob ends the loop
+
+
+def test_paths_for_blobs_empty():
+    assert backend._paths_for_blobs(PathsClient([]), "r", []) == {}
+
+
+def test_membership_locks_only_block_shared_blobs():
+    import threading
+
+    entered = []
+
+    def hold(shas):
+        with backend._membership_locked(shas):
+            entered.append(shas[0])
+
+    with backend._membership_locked(["a", "b"]):
+        other = threading.Thread(target=hold, args=(["c"],))
+        shared = threading.Thread(target=hold, args=(["b", "d"],))
+        other.start()
+        shared.start()
+        other.join(timeout=2)
+        shared.join(timeout=0.2)
+        assert entered == ["c"]  # disjoint blobs go ahead, the shared one waits
+    shared.join(timeout=2)
+    assert entered == ["c", "b"]
+    assert not backend._membership_held
+
+
+# ─── Vector writer ─────────────────────────────────────────────────────────
+
+def test_vector_writer_batches_split_by_bytes(monkeypatch):
+    monkeypatch.setattr(backend, "QDRANT_PREFER_GRPC", True)
+    monkeypatch.setattr(backend, "WRITE_BATCH_BYTES", 1000)
+    ids = [str(i) for i in range(10)]
+    vectors = np.zeros((10, 32), dtype=np.float32)  # 128 bytes each over gRPC
+    payloads = [{"i": i} for i in range(10)]
+    writer = backend.VectorWriter(client=None)
+    batches = list(writer._batches(ids, vectors, payloads))
+
+    assert [i for b in batches for i in b[0]] == ids
+    assert all(size <= 1000 for *_, size in batches)
+    assert sum(len(b[0]) for b in batches) == 10 and len(batches) == 2
+    for b_ids, b_vectors, b_payloads, _ in batches:
+        assert len(b_ids) == len(b_vectors) == len(b_payloads)
+
+
+def test_vector_writer_batches_oversized_point_alone(monkeypatch):
+    monkeypatch.setattr(backend, "WRITE_BATCH_BYTES", 10)
+    vectors = np.zeros((3, 4), dtype=np.float32)
+    batches = list(backend.VectorWriter(client=None)._batches(["a", "b", "c"], vectors, [{}, {}, {}]))
+    assert [b[0] for b in batches] == [["a"], ["b"], ["c"]]
+
+
+class UpsertRecorder:
+    def __init__(self, shard_number):
+        self.shard_number = shard_number
+        self.upserts = []
+
+    def get_collection(self, name):
+        return SimpleNamespace(config=SimpleNamespace(params=SimpleNamespace(shard_number=self.shard_number)))
+
+    def upsert(self, collection_name, points, wait):
+        self.upserts.append((list(points.ids), wait))
+
+
+@pytest.mark.parametrize("shards,expected", [(1, [False, False, True]), (3, [True, True, True])])
+def test_vector_writer_waits_on_every_batch_when_sharded(monkeypatch, shards, expected):
+    monkeypatch.setattr(backend, "WRITE_BATCH_BYTES", 10)
+    monkeypatch.setattr(backend, "_shard_counts", {})
+    client = UpsertRecorder(shards)
+    writer = backend.VectorWriter(client)
+    writer.write("c", ["a", "b", "c"], np.ones((3, 4), dtype=np.float32), [{}, {}, {}])
+    writer.flush("c")
+    assert sorted(client.upserts) == [(["a"], expected[0]), (["b"], expected[1]), (["c"], expected[2])]
+
+
+# ─── Index budget ──────────────────────────────────────────────────────────
+
+def test_default_budget_caps_requested_limits():
+    assert backend._default_budget() == {
+        "max_files": backend.INDEX_MAX_FILES,
+        "max_bytes": backend.INDEX_MAX_BYTES,
+        "max_tokens": backend.INDEX_MAX_TOKENS,
+    }
+    budget = backend._default_budget(10, backend.INDEX_MAX_BYTES * 10, -5)
+    assert budget == {"max_files": 10, "max_bytes": backend.INDEX_MAX_BYTES, "max_tokens": 1}
+
+
+# ─── LLM routing ───────────────────────────────────────────────────────────
+
+def test_model_route_latency_is_tracked_per_call_class():
+    route = backend._ModelRoute("m", 1)
+    route.last_used_at = {"query": time.time(), "summarize": time.time()}
+    for _ in range(5):
+        route.record_latency("summarize", backend.LLM_FALLBACK_LATENCY_S * 3)
+        route.record_latency("query", 1.0)
+    assert route.slow("summarize")
+    assert not route.slow("query")
+    assert not route.slow("unseen")
+
+
+def test_slow_route_is_probed_again_after_the_interval():
+    route = backend._ModelRoute("m", 1)
+    route.record_latency("query", backend.LLM_FALLBACK_LATENCY_S + 1)
+    route.last_used_at["query"] = time.time() - backend.LLM_PROBE_INTERVAL_S - 1
+    assert not route.slow("query")
+
+
+# ─── Profiling ─────────────────────────────────────────────────────────────
+
+def test_profiled_request_profiles_its_index_job(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(backend, "ADMIN_TOKEN", "t")
+    monkeypatch.setattr(backend, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(backend, "get_default_branch", lambda owner, repo, timeout=15: "main")
+    monkeypatch.setattr(backend, "check_if_indexed", lambda owner, repo, branch: False)
+
+    def no_progress(repo_id):
+        raise RuntimeError("stop after the job started")
+
+    monkeypatch.setattr(backend, "_load_progress", no_progress)
+    response = TestClient(backend.app).post(
+        "/build_embeddings", json={"owner": "o", "repo": "profiled"}, headers={"X-Profile": "t"}
+    )
+    assert response.status_code == 200
+    backend._index_futures["o/profiled@main"].result(timeout=10)
+
+    labels = {p.name.rsplit("-", 1)[0] for p in (tmp_path / response.headers["X-Profile-Id"]).glob("*.json")}
+    assert {"build_embeddings", "build_embeddings_task"} <= labels
+
+
+# ─── Push webhooks ─────────────────────────────────────────────────────────
+
+def _push(**extra):
+    return {"repo_id": "o/r@main", "owner": "o", "repo": "r", "branch": "main", "before": "b" * 40,
+            "after": "a" * 40, "paths": {"x.py"}, "full": False, "first_at": time.time(), **extra}
+
+
+def test_failed_push_is_retried_with_backoff_then_dropped(monkeypatch):
+    def fail(push):
+        raise RuntimeError("commit not fetched yet")
+
+    monkeypatch.setattr(backend, "_apply_push", fail)
+    monkeypatch.setattr(backend, "WEBHOOK_MAX_RETRIES", 2)
+    monkeypatch.setattr(backend, "_pending_pushes", {})
+    push = _push()
+    delays = []
+    for _ in range(2):
+        backend._run_push(push)
+        queued = backend._pending_pushes.pop("o/r@main")
+        delays.append(round(queued["due"] - time.time()))
+    assert delays == [round(backend.WEBHOOK_DEBOUNCE_S), round(2 * backend.WEBHOOK_DEBOUNCE_S)]
+    backend._run_push(push)
+    assert backend._pending_pushes == {}
+
+
+def test_failed_push_merges_into_a_newer_one(monkeypatch):
+    def fail(push):
+        raise RuntimeError("qdrant unavailable")
+
+    monkeypatch.setattr(backend, "_apply_push", fail)
+    newer = _push(before="c" * 40, paths={"y.py"})
+    monkeypatch.setattr(backend, "_pending_pushes", {"o/r@main": newer})
+    backend._run_push(_push())
+    assert newer["before"] == "b" * 40 and newer["paths"] == {"x.py", "y.py"}
+
+
+def test_verify_signature(monkeypatch):
+    monkeypatch.setattr(backend, "GITHUB_WEBHOOK_SECRET", "s3cret")
+    body = b'{"zen": "hi"}'
+    good = "sha256=" + hmac.new(b"s3cret", body, hashlib.sha256).hexdigest()
+    assert backend._verify_signature(body, good)
+    assert not backend._verify_signature(body + b" ", good)
+    assert not backend._verify_signature(body, good.replace("sha256=", "sha1="))
+    assert not backend._verify_signature(body, None)
+    assert not backend._verify_signature(body, "")
+
+
+@pytest.fixture
+def push_env(monkeypatch):
+    """_apply_push with storage, listing and scheduling replaced by recorders."""
+    calls = {"saved": [], "scheduled": [], "submitted": [], "requeued": [], "pruned": []}
+    env = SimpleNamespace(calls=calls, manifest={"commit": "b" * 40}, progress=None, blobs={}, payloads={})
+    monkeypatch.setattr(backend, "get_manifest", lambda repo_id, deadline=None: env.manifest)
+    monkeypatch.setattr(backend, "_index_busy", lambda repo_id: False)
+    monkeypatch.setattr(backend, "_load_progress", lambda repo_id: env.progress)
+    monkeypatch.setattr(backend, "list_repo_blobs", lambda owner, repo, ref: env.blobs)
+    monkeypatch.setattr(backend, "get_qdrant_client", lambda: None)
+    monkeypatch.setattr(backend, "_existing_blobs", lambda client, repo_id, shas: {
+        sha: env.payloads[sha] for sha in shas if sha in env.payloads})
+    monkeypatch.setattr(backend, "_save_progress", lambda progress: calls["saved"].append(dict(progress)))
+    monkeypatch.setattr(backend, "_save_manifest", lambda progress: None)
+    monkeypatch.setattr(backend, "_publish_progress", lambda progress: None)
+    monkeypatch.setattr(backend, "_schedule_backfill", calls["scheduled"].append)
+    monkeypatch.setattr(backend, "_prune_paths", lambda client, repo_id, blobs: calls["pruned"].append(blobs))
+    monkeypatch.setattr(backend, "_requeue_push", lambda push, delay=0: calls["requeued"].append(push))
+
+    def submit(owner, repo, branch, repo_id, budget=None, message=""):
+        calls["submitted"].append((repo_id, budget))
+        return env.submit_result
+
+    env.submit_result = object()
+    monkeypatch.setattr(backend, "submit_index_job", submit)
+    return env
+
+
+def test_push_reindexes_only_touched_paths(push_env):
+    push_env.progress = {
+        "shas": {"a.py": "1", "b.py": "2", "c.py": "3"}, "indexed": ["a.py", "b.py", "c.py"],
+        "done": ["a.py", "b.py", "c.py"], "pending": [], "num_files": 3, "num_chunks": 9, "bytes": 300,
+        "budget": {}, "complete": True, "stopped_reason": None,
+    }
+    push_env.blobs = {"a.py": "1", "b.py": "2b", "d.py": "4"}  # b modified, c removed, d added
+    push_env.payloads = {"2": {"num_chunks": 2, "bytes": 100}, "3": {"num_chunks": 4, "bytes": 50}}
+    backend._apply_push(_push(paths={"b.py", "c.py", "d.py", "a.py"}))
+
+    progress = push_env.calls["saved"][-1]
+    assert progress["pending"] == ["b.py", "d.py"]
+    assert progress["indexed"] == ["a.py"] and progress["done"] == ["a.py"]
+    assert (progress["num_files"], progress["num_chunks"], progress["bytes"]) == (1, 3, 150)
+    assert progress["commit"] == "a" * 40 and progress["files_total"] == 3 and not progress["complete"]
+    assert push_env.calls["scheduled"] == ["o/r@main"]
+    assert push_env.calls["submitted"] == []
+
+
+def test_push_with_only_removals_completes_and_prunes(push_env):
+    push_env.progress = {
+        "shas": {"a.py": "1", "c.py": "3"}, "indexed": ["a.py", "c.py"], "done": ["a.py", "c.py"],
+        "pending": [], "num_files": 2, "num_chunks": 5, "bytes": 80, "budget": {},
+        "complete": True, "stopped_reason": None,
+    }
+    push_env.blobs = {"a.py": "1"}
+    backend._apply_push(_push(paths={"c.py"}))
+    assert push_env.calls["pruned"] == [{"a.py": "1"}]
+    assert push_env.calls["saved"][-1]["complete"] and push_env.calls["scheduled"] == []
+
+
+@pytest.mark.parametrize("push_args", [{"full": True}, {"before": "c" * 40}])
+def test_push_falls_back_to_a_queued_full_reindex(push_env, push_args):
+    push_env.progress = {"budget": {"max_files": 7}, "complete": False}
+    backend._apply_push(_push(**push_args))
+    assert push_env.calls["submitted"] == [("o/r@main", {"max_files": 7})]
+    assert push_env.calls["saved"][-1]["complete"]  # the next job starts from a fresh listing
+
+
+def test_push_is_requeued_when_the_index_queue_is_full(push_env):
+    push_env.submit_result = None
+    backend._apply_push(_push(full=True))
+    assert len(push_env.calls["requeued"]) == 1
+
+
+def test_push_is_ignored_when_not_indexed_or_already_current(push_env):
+    push_env.manifest = None
+    backend._apply_push(_push())
+    push_env.manifest = {"commit": "a" * 40}
+    backend._apply_push(_push())
+    assert push_env.calls == {k: [] for k in push_env.calls}
+
+# ─── Snapshots ─────────────────────────────────────────────────────────────
+
+@pytest.mark.parametrize("quantize", [None, "int8"])
+def test_snapshot_round_trip(tmp_path, quantize):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((5, 16)).astype(np.float32)
+    vectors[2] = 0.0
+    lines = np.arange(10, dtype=np.int32).reshape(5, 2)
+    names = ["a.py", "dir/ü.py", "", "b" * 300, "c.md"]
+
+    writer = backend.SnapshotWriter()
+    writer.add("lines", lines)
+    writer.add_strings("paths", names)
+    writer.add_vectors("vectors", vectors, quantize)
+    path = str(tmp_path / "x.snap")
+    writer.write(path, {"repo_id": "o/r@main"})
+
+    reader = backend.SnapshotReader(path)
+    assert reader.meta["repo_id"] == "o/r@main"
+    assert reader.strings("paths") == names
+    np.testing.assert_array_equal(reader.array("lines"), lines)
+    restored = reader.vectors("vectors", [0, 2, 4])
+    expected = vectors[[0, 2, 4]]
+    if quantize:
+        np.testing.assert_allclose(restored, expected, atol=np.abs(vectors).max() / 127)
+    else:
+        np.testing.assert_array_equal(restored, expected)
+    del restored
+    reader.close()
+
+
+def test_snapshot_reader_rejects_other_files(tmp_path):
+    path = tmp_path / "junk"
+    path.write_bytes(b"not a snapshot at all")
+    with pytest.raises(backend.HTTPException) as e:
+        backend.SnapshotReader(str(path))
+    assert e.value.status_code == 400
+
+
+@pytest.fixture
+def memory_qdrant(monkeypatch):
+    from qdrant_client import QdrantClient
+
+    client = QdrantClient(":memory:")
+    monkeypatch.setattr(backend, "_qdrant_client", client)
+    monkeypatch.setattr(backend, "_collections_ready", False)
+    monkeypatch.setattr(backend, "_manifest_cache", {})
+    monkeypatch.setattr(backend, "_dedicated_repos", set())
+    backend.ensure_collections()
+    return client
+
+
+def test_export_skips_chunks_whose_file_point_never_landed(memory_qdrant, monkeypatch, tmp_path):
+    monkeypatch.setattr(backend, "SNAPSHOT_DIR", str(tmp_path))
+    monkeypatch.setattr(backend, "get_manifest", lambda repo_id, deadline=None: {"repo_id": repo_id})
+    repo_id = "o/r@main"
+    vec = np.ones((1, backend.EMBEDDING_DIM), dtype=np.float32)
+    writer = backend.VectorWriter(memory_qdrant)
+    for sha in ["a" * 40, "b" * 40]:
+        writer.write(backend.CHUNKS_COLLECTION, [backend.make_blob_point_id(sha, 1, 2)], vec,
+                     [{"repo_ids": [repo_id], "blob_sha": sha, "start_line": 1, "end_line": 2, "text": sha[0]}])
+    writer.flush(backend.CHUNKS_COLLECTION)
+    # Only "a" got its file point before the job stopped
+    writer.write(backend.FILES_COLLECTION, [backend.make_blob_point_id("a" * 40)], vec,
+                 [{"repo_ids": [repo_id], "blob_sha": "a" * 40, "bytes": 3, "num_chunks": 1}])
+    writer.flush(backend.FILES_COLLECTION)
+    backend._write_paths(memory_qdrant, repo_id, {"a.py": "a" * 40})
+
+    reader = backend.SnapshotReader(backend.export_snapshot(repo_id))
+    assert reader.strings("chunks.text") == ["a"]
+    assert reader.strings("paths.name") == ["a.py"]
+    reader.close()
+
+
+def test_uploaded_snapshot_is_discarded_after_import(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(backend, "ADMIN_TOKEN", "t")
+    monkeypatch.setattr(backend, "SNAPSHOT_DIR", str(tmp_path / "snaps"))
+    response = TestClient(backend.app).post(
+        "/admin/snapshots/import", headers={"X-Admin-Token": "t"}, content=b"junk" * 300000
+    )
+    assert response.status_code == 400
+    assert list((tmp_path / "snaps").iterdir()) == []
+
+
+# ─── Embedding batches ─────────────────────────────────────────────────────
+
+def _assert_contiguous(batches, n):
+    assert batches[0][0] == 0 and batches[-1][1] == n
+    assert all(a[1] == b[0] for a, b in zip(batches, batches[1:]))
+
+
+def test_embedding_batches_respect_token_budget(monkeypatch):
+    monkeypatch.setattr(backend, "EMBED_BATCH_TOKENS", 100)
+    monkeypatch.setattr(backend, "EMBED_BATCH_MAX_ITEMS", 1000)
+    texts = ["x" * 156] * 10  # 40 estimated tokens each
+    batches = backend._embedding_batches(texts)
+    assert batches == [(0, 2), (2, 4), (4, 6), (6, 8), (8, 10)]
+
+
+def test_embedding_batches_respect_item_limit_and_oversized_texts(monkeypatch):
+    monkeypatch.setattr(backend, "EMBED_BATCH_TOKENS", 100)
+    monkeypatch.setattr(backend, "EMBED_BATCH_MAX_ITEMS", 3)
+    texts = ["a"] * 7 + ["y" * 4000] + ["b"]
+    batches = backend._embedding_batches(texts)
+    _assert_contiguous(batches, len(texts))
+    assert all(end - start <= 3 for start, end in batches)
+    assert (7, 8) in batches  # an oversized text still gets a batch of its own
+
+
+def test_embedding_batches_empty():
+    assert backend._embedding_batches([]) == []
+
+
+# ─── Embedding calls ───────────────────────────────────────────────────────
+
+class JinaResponse:
+    ok = True
+    status_code = 200
+    headers: dict = {}
+    text = ""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def json(self):
+        return {"data": [{"index": i, "embedding": [float(i)] * backend.EMBEDDING_DIM} for i in range(self.rows)]}
+
+
+def test_embed_batch_retries_a_short_response(monkeypatch):
+    responses = [JinaResponse(1), JinaResponse(3)]
+    monkeypatch.setattr(backend.http_requests, "post", lambda *a, **k: responses.pop(0))
+    monkeypatch.setattr(backend, "EMBED_BACKOFF_S", 0.0)
+    out = backend._embed_batch(["a", "b", "c"])
+    assert responses == []
+    np.testing.assert_array_equal(out[:, 0], [0.0, 1.0, 2.0])
+
+
+def test_embed_batch_gives_up_on_repeated_short_responses(monkeypatch):
+    monkeypatch.setattr(backend.http_requests, "post", lambda *a, **k: JinaResponse(2))
+    monkeypatch.setattr(backend, "EMBED_BACKOFF_S", 0.0)
+    monkeypatch.setattr(backend, "EMBED_MAX_RETRIES", 1)
+    with pytest.raises(backend.HTTPException) as e:
+        backend._embed_batch(["a", "b", "c"])
+    assert e.value.status_code == 502 and "2 embeddings for 3 inputs" in e.value.detail
+
+
+# ─── Query deadlines ───────────────────────────────────────────────────────
+
+def test_qdrant_timeout_never_outlasts_the_deadline():
+    assert backend._qdrant_timeout(None) == 30
+    assert backend._qdrant_timeout(time.monotonic() + 100) == 30
+    assert backend._qdrant_timeout(time.monotonic() + 2.7) == 2
+    with pytest.raises(backend.HTTPException) as e:
+        backend._qdrant_timeout(time.monotonic() + 0.3)
+    assert e.value.status_code == 504
+
+
+def test_ensure_collections_waits_only_until_the_deadline(monkeypatch):
+    import threading
+
+    release = threading.Event()
+    calls = []
+
+    def slow_setup():
+        calls.append(1)
+        release.wait(5)
+        backend._collections_ready = True
+
+    monkeypatch.setattr(backend, "_collections_ready", False)
+    monkeypatch.setattr(backend, "_collections_setup", None)
+    monkeypatch.setattr(backend, "_setup_collections", slow_setup)
+    started = time.monotonic()
+    with pytest.raises(backend.HTTPException) as e:
+        backend.ensure_collections(time.monotonic() + 0.2)
+    assert e.value.status_code == 504 and time.monotonic() - started < 1
+    release.set()
+    backend._collections_setup.result(timeout=5)
+    backend.ensure_collections(time.monotonic() + 0.2)  # ready now; setup ran once
+    assert calls == [1]
+
+
+@pytest.fixture
+def query_env(monkeypatch):
+    """/query with every upstream call stubbed; returns the prompts sent to the LLM."""
+    hits = [{"doc": f"chunk {i}", "meta": {"file_path": f"f{i}.py", "start_line": 1, "end_line": 9,
+                                            "owner": "o", "repo": "r", "branch": "main"}}
+            for i in range(6)]
+    prompts = []
+    monkeypatch.setattr(backend, "QUERY_LLM_MIN_S", 1.0)
+    monkeypatch.setattr(backend, "QUERY_TWO_STAGE_MIN_S", 0.5)
+    monkeypatch.setattr(backend, "touch_index", lambda repo_id: None)
+    monkeypatch.setattr(backend, "get_embeddings", lambda texts, deadline=None: np.zeros((len(texts), 4)))
+    monkeypatch.setattr(backend, "ensure_collections", lambda deadline=None: None)
+    monkeypatch.setattr(backend, "get_qdrant_client", lambda: None)
+    monkeypatch.setattr(backend, "_index_is_partial", lambda repo_id, deadline=None: False)
+    monkeypatch.setattr(backend, "_search_repo",
+                        lambda *a, two_stage=True, **kw: (["f.py"], list(hits)))
+    monkeypatch.setattr(backend, "_call_llm",
+                        lambda question, context, timeout=0: prompts.append(context) or "answer")
+    return prompts
+
+
+def _query(**kw):
+    return backend.query_repo(backend.QueryRequest(owner="o", repo="r", question="q", branch="main",
+                                                   top_chunks=6, **kw))
+
+
+def test_query_with_time_to_spare_is_not_degraded(query_env):
+    response = _query(deadline_s=20)
+    assert response.answer == "answer" and response.degraded == []
+    assert query_env[0].count("chunk ") == 6
+
+
+def test_query_short_on_time_sends_fewer_chunks(query_env):
+    response = _query(deadline_s=1.8)
+    assert response.degraded == ["fewer_chunks"]
+    assert query_env[0].count("chunk ") == 3 and len(response.references) == 3
+
+
+def test_query_out_of_time_answers_with_references_only(query_env):
+    token = backend._request_arrived_at.set(time.monotonic() - 30)  # queued past the deadline
+    try:
+        response = _query(deadline_s=20)
+    finally:
+        backend._request_arrived_at.reset(token)
+    assert response.degraded == ["single_stage_search", "references_only"]
+    assert query_env == []
+    assert response.answer.startswith("Ran out of time") and len(response.references) == 6
+
+
+# ─── Repository context ────────────────────────────────────────────────────
+
+def test_fetch_tree_blobs_walks_a_truncated_listing(monkeypatch):
+    trees = {
+        ("main", True): {"truncated": True, "tree": [{"path": "a.py", "type": "blob", "sha": "1"}]},
+        ("main", False): {"tree": [{"path": "a.py", "type": "blob", "sha": "1"},
+                                   {"path": "pkg", "type": "tree", "sha": "t"}]},
+        ("t", True): {"tree": [{"path": "b.py", "type": "blob", "sha": "2"},
+                               {"path": "sub", "type": "tree", "sha": "s"},
+                               {"path": "sub/c.py", "type": "blob", "sha": "3"}]},
+    }
+    monkeypatch.setattr(backend, "_get_tree",
+                        lambda owner, repo, sha, headers, recursive, timeout=20: trees[(sha, recursive)])
+    blobs = backend._fetch_tree_blobs("o", "r", "main", 5)
+    assert blobs == {"a.py": "1", "pkg/b.py": "2", "pkg/sub/c.py": "3"}
+
+
+# ─── Local git checkouts ───────────────────────────────────────────────────
+
+def _git(path, *args):
+    subprocess.run(["git", "-C", str(path), *args], check=True, capture_output=True)
+
+
+@pytest.fixture
+def local_repos(tmp_path, monkeypatch):
+    root = tmp_path / "repos"
+    work = root / "octo" / "demo"
+    (work / "pkg").mkdir(parents=True)
+    (work / "README.md").write_text("hello\n")
+    (work / "pkg" / "mod.py").write_text("x = 1\n")
+    _git(work, "init", "-q", "-b", "main")
+    _git(work, "add", ".")
+    _git(work, "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q", "-m", "init")
+    monkeypatch.setattr(backend, "LOCAL_REPOS_DIR", str(root))
+    monkeypatch.setattr(backend, "_local_repos", {})
+    return root
+
+
+def test_local_repo_reads_checkout(local_repos):
+    local = backend.get_local_repo("octo", "demo")
+    assert local is not None and local.default_branch() == "main"
+    assert len(local.resolve("main")) == 40
+    assert local.resolve("nope") is None
+
+    blobs = local.list_blobs("main")
+    assert set(blobs) == {"README.md", "pkg/mod.py"}
+    assert local.read(blobs["pkg/mod.py"]) == b"x = 1\n"
+    assert local.read("main:README.md") == b"hello\n"
+    assert local.read("0" * 40) is None
+    assert local.read("main:README.md\nHEAD") is None
+    assert backend.get_local_repo("octo", "demo") is local
+
+
+def test_local_repo_rejects_unsafe_refs(local_repos):
+    local = backend.get_local_repo("octo", "demo")
+    for ref in ("--output=/tmp/x", "-n", "main..HEAD", "a//b", "main\nHEAD", ""):
+        assert not backend._safe_ref(ref)
+        assert local.resolve(ref) is None
+    with pytest.raises(backend.HTTPException) as exc:
+        local.list_blobs("--all")
+    assert exc.value.status_code == 400
+    with pytest.raises(backend.HTTPException) as exc:
+        local.list_blobs("missing")
+    assert exc.value.status_code == 404
+
+
+def test_get_local_repo_stays_inside_root(local_repos, tmp_path):
+    outside = tmp_path / "outside"
+    _git(tmp_path, "init", "-q", str(outside))
+    os.symlink(outside, local_repos / "octo" / "escape")
+
+    for owner, repo in [("..", "outside"), ("octo", ".."), (".", "demo"),
+                        ("octo", "../outside"), ("octo", "escape"), ("nobody", "demo")]:
+        assert backend.get_local_repo(owner, repo) is None
+
+
+def test_get_local_repo_disabled(monkeypatch):
+    monkeypatch.setattr(backend, "LOCAL_REPOS_DIR", None)
+    assert backend.get_local_repo("octo", "demo") is None
+
+
+# ─── Admission control ─────────────────────────────────────────────────────
+
+def test_admission_limits_concurrency_and_queues():
+    controller = backend.AdmissionController("query", limit=2, queue_size=1)
+    release = None
+    peak = 0
+
+    async def call_next(request):
+        nonlocal peak
+        peak = max(peak, controller.active)
+        await release.wait()
+        return backend.JSONResponse({"ok": True})
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        running = [asyncio.create_task(controller.run(None, call_next)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert controller.active == 2 and controller.waiting == 1 and controller.busy()
+
+        rejected = await controller.run(None, call_next)
+        assert rejected.status_code == 429 and int(rejected.headers["Retry-After"]) >= 1
+
+        release.set()
+        return await asyncio.gather(*running)
+
+    responses = asyncio.run(scenario())
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert peak == 2 and not controller.busy()
+    stats = controller.stats()
+    assert (stats["admitted"], stats["rejected"], stats["timed_out"]) == (3, 1, 0)
+    assert stats["active"] == stats["waiting"] == 0
+
+
+def test_admission_times_out_long_waits(monkeypatch):
+    monkeypatch.setattr(backend, "ADMISSION_MAX_WAIT_S", 0.05)
+    controller = backend.AdmissionController("summarize", limit=1, queue_size=5)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def call_next(request):
+            await release.wait()
+            return backend.JSONResponse({})
+
+        holder = asyncio.create_task(controller.run(None, call_next))
+        await asyncio.sleep(0.01)
+        waited = await controller.run(None, call_next)
+        release.set()
+        await holder
+        return waited
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 503 and "Retry-After" in response.headers
+    assert controller.stats()["timed_out"] == 1 and controller.waiting == 0